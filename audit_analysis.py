@@ -0,0 +1,301 @@
+import glob
+import json
+import os
+from datetime import datetime, timezone
+
+# Número máximo de elementos de cada hallazgo que se muestran en el resumen
+summary_sample_size = 10
+
+# Estados de usuario de IAM que se consideran activos
+active_user_statuses = {"ACTIVE"}
+
+# Días mínimos de logs de auditoría cubiertos (acumulados entre ejecuciones) para
+# señalar usuarios y tokens sin actividad
+min_coverage_days = 30
+
+# Leer los registros de varios NDJSON de uno en uno
+def _iter_records(paths):
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+# Normalizar un email (o identificador de actor) para comparar
+def _normalize(value):
+    return str(value).strip().lower() if value else None
+
+# Convertir una fecha ISO 8601 o epoch en milisegundos a epoch en milisegundos
+def _timestamp_ms(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+# Fecha legible a partir de epoch en milisegundos
+def _format_ms(value):
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# Leer el índice de última actividad por actor de las ejecuciones anteriores
+def load_activity_index(path):
+    """
+    Returns:
+        dict: {"coverage": {"from", "to"} en epoch ms o None, "actors": {actor normalizado: {"actor", "user_type", "last"}}}
+    """
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            return {"coverage": index.get("coverage"), "actors": index.get("actors") or {}}
+        except (OSError, ValueError):
+            pass
+    return {"coverage": None, "actors": {}}
+
+# Guardar el índice de última actividad por actor
+def save_activity_index(path, index):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Combinar la actividad de esta ejecución con el índice acumulado
+def _merge_activity_index(index, activity, coverage):
+    actors = index["actors"]
+    for actor, entry in activity.items():
+        known = actors.get(actor)
+        if known is None:
+            actors[actor] = {"actor": entry["actor"], "user_type": entry["user_type"], "last": entry["last"]}
+        elif entry["last"] is not None and (known.get("last") is None or entry["last"] > known["last"]):
+            known["last"] = entry["last"]
+    previous = index["coverage"]
+    if coverage is not None:
+        if previous is not None:
+            coverage = {"from": min(previous["from"], coverage["from"]), "to": max(previous["to"], coverage["to"])}
+        index["coverage"] = coverage
+    return index
+
+# Identificadores de los grupos de un usuario (lista de UUID o de objetos de grupo)
+def _group_ids(user):
+    groups = user.get("groups") or []
+    return [g.get("uuid") or g.get("groupId") if isinstance(g, dict) else g for g in groups]
+
+# Cruzar usuarios, grupos, tokens y logs de auditoría
+def analyze(users_paths, groups_paths, token_paths, auditlog_paths, activity_index=None, coverage=None):
+    """
+    Construye índices hash de usuarios (por email), grupos (por UUID), tokens (por
+    ID) y actores de los logs de auditoría, y los cruza en una sola pasada por cada
+    origen, con coste lineal en el número de registros. Los usuarios y tokens sin
+    actividad se juzgan con la última actividad acumulada de todas las ejecuciones
+    (activity_index) y solo si el rango cubierto alcanza min_coverage_days.
+
+    Args:
+        users_paths (list): NDJSON de /iam/v1/accounts/{id}/users
+        groups_paths (list): NDJSON de /iam/v1/accounts/{id}/groups
+        token_paths (list): NDJSON de /api/v2/apiTokens
+        auditlog_paths (list): NDJSON de /api/v2/auditlogs
+        activity_index (dict, optional): Índice de load_activity_index, que se actualiza con esta ejecución
+        coverage (dict, optional): Rango consultado de los logs ({"from", "to"} en epoch ms);
+            por defecto, el de los eventos leídos
+
+    Returns:
+        dict: Estadísticas de los índices y hallazgos
+    """
+    users = {}
+    for user in _iter_records(users_paths):
+        email = _normalize(user.get("email"))
+        if email:
+            users[email] = user
+
+    groups = {group.get("uuid"): group for group in _iter_records(groups_paths) if group.get("uuid")}
+
+    tokens = {}
+    tokens_by_owner = {}
+    for token in _iter_records(token_paths):
+        token_id = token.get("id")
+        if not token_id:
+            continue
+        tokens[token_id] = token
+        owner = _normalize(token.get("owner"))
+        if owner:
+            tokens_by_owner.setdefault(owner, []).append(token_id)
+
+    # Actividad por actor: número de eventos, último evento y eventos fallidos
+    token_ids = {_normalize(token_id): token_id for token_id in tokens}
+    activity = {}
+    audit_rows = 0
+    first_event = last_event = None
+    for log in _iter_records(auditlog_paths):
+        audit_rows += 1
+        actor = _normalize(log.get("user"))
+        if not actor:
+            continue
+        entry = activity.get(actor)
+        if entry is None:
+            entry = activity[actor] = {"actor": log.get("user"), "events": 0, "failed": 0, "last": None,
+                                       "user_type": log.get("userType")}
+        entry["events"] += 1
+        if log.get("success") is False:
+            entry["failed"] += 1
+        timestamp = _timestamp_ms(log.get("timestamp"))
+        if timestamp is not None:
+            if entry["last"] is None or timestamp > entry["last"]:
+                entry["last"] = timestamp
+            first_event = timestamp if first_event is None else min(first_event, timestamp)
+            last_event = timestamp if last_event is None else max(last_event, timestamp)
+
+    # Rango cubierto: el consultado o, si no se conoce, el de los eventos leídos
+    if coverage is None and first_event is not None:
+        coverage = {"from": first_event, "to": last_event}
+    activity_index = _merge_activity_index(activity_index or {"coverage": None, "actors": {}}, activity, coverage)
+    seen_actors = activity_index["actors"]
+    covered = activity_index["coverage"]
+    covered_days = (covered["to"] - covered["from"]) / 86400000 if covered else 0
+    activity_findings = covered_days >= min_coverage_days
+
+    findings = {
+        "tokens_owned_by_deleted_users": [],
+        "tokens_owned_by_inactive_users": [],
+        "inactive_users": [],
+        "unknown_audit_actors": [],
+        "enabled_tokens_without_activity": [],
+        "group_fanout": []
+    }
+
+    # Tokens cuyo propietario ya no existe en IAM o no está activo
+    for owner, owned in tokens_by_owner.items():
+        user = users.get(owner)
+        for token_id in owned:
+            token = tokens[token_id]
+            record = {"id": token_id, "name": token.get("name"), "owner": token.get("owner"), "enabled": token.get("enabled")}
+            if user is None:
+                findings["tokens_owned_by_deleted_users"].append(record)
+            elif user.get("userStatus") and user.get("userStatus") not in active_user_statuses:
+                findings["tokens_owned_by_inactive_users"].append({**record, "userStatus": user.get("userStatus")})
+
+    # Sin suficientes días de logs de auditoría no se puede saber qué usuarios y
+    # tokens no tienen actividad: esos hallazgos se omiten
+    if not activity_findings:
+        del findings["inactive_users"]
+        del findings["enabled_tokens_without_activity"]
+
+    # Usuarios sin actividad en todo el rango cubierto
+    for email, user in users.items():
+        if activity_findings and email not in seen_actors:
+            findings["inactive_users"].append({
+                "uid": user.get("uid"), "email": user.get("email"), "userStatus": user.get("userStatus"),
+                "tokens": len(tokens_by_owner.get(email, []))
+            })
+
+    # Actores de los logs que no son usuarios de IAM ni tokens conocidos
+    for actor, entry in activity.items():
+        if actor not in users and actor not in token_ids:
+            findings["unknown_audit_actors"].append({
+                "actor": entry["actor"], "userType": entry["user_type"], "events": entry["events"],
+                "failed": entry["failed"], "last": _format_ms(entry["last"])
+            })
+
+    # Tokens habilitados sin eventos en todo el rango cubierto
+    for normalized_id, token_id in token_ids.items():
+        token = tokens[token_id]
+        if activity_findings and token.get("enabled") and normalized_id not in seen_actors:
+            findings["enabled_tokens_without_activity"].append({
+                "id": token_id, "name": token.get("name"), "owner": token.get("owner"),
+                "lastUsedDate": token.get("lastUsedDate")
+            })
+
+    # Alcance de cada grupo: miembros por permisos (si los datos incluyen pertenencias y permisos)
+    members = {}
+    memberships_available = False
+    for user in users.values():
+        for group_id in _group_ids(user):
+            memberships_available = True
+            members[group_id] = members.get(group_id, 0) + 1
+    for group_id, group in groups.items():
+        permissions = group.get("permissions")
+        member_count = members.get(group_id, 0) if memberships_available else None
+        permission_count = len(permissions) if isinstance(permissions, list) else None
+        fanout = member_count * permission_count if member_count is not None and permission_count is not None else None
+        findings["group_fanout"].append({
+            "uuid": group_id, "name": group.get("name"), "members": member_count,
+            "permissions": permission_count, "fanout": fanout
+        })
+    findings["group_fanout"].sort(key=lambda g: (g["fanout"] or 0, g["members"] or 0), reverse=True)
+
+    findings["unknown_audit_actors"].sort(key=lambda a: a["events"], reverse=True)
+
+    top_actors = sorted(activity.items(), key=lambda item: item[1]["events"], reverse=True)[:summary_sample_size]
+    return {
+        "indexes": {
+            "users": len(users), "groups": len(groups), "tokens": len(tokens),
+            "audit_log_rows": audit_rows, "audit_log_actors": len(activity),
+            "group_memberships_available": memberships_available
+        },
+        "activity_coverage": {
+            "from": _format_ms(covered["from"]) if covered else None,
+            "to": _format_ms(covered["to"]) if covered else None,
+            "days": round(covered_days, 1),
+            "minimum_days": min_coverage_days,
+            "inactivity_findings": activity_findings,
+            "known_actors": len(seen_actors)
+        },
+        "top_actors": [
+            {"actor": entry["actor"], "events": entry["events"], "failed": entry["failed"], "last": _format_ms(entry["last"])}
+            for _, entry in top_actors
+        ],
+        "findings": findings
+    }
+
+# Cruzar los NDJSON de una auditoría y guardar los hallazgos
+def analyze_audit(ndjson_dir, findings_path, account_ndjson_dir=None, activity_index_path=None, coverage=None):
+    """
+    Localiza los NDJSON de usuarios, grupos, tokens y logs de auditoría, los cruza
+    y guarda el resultado completo en findings_path. La última actividad de cada
+    actor y el rango de logs cubierto se acumulan en activity_index_path.
+
+    Args:
+        ndjson_dir (str): Carpeta con los NDJSON del entorno
+        findings_path (str): Archivo JSON de destino
+        account_ndjson_dir (str, optional): Carpeta con los NDJSON de la Account Management API
+            (por defecto, la misma que la del entorno)
+        activity_index_path (str, optional): Índice de actividad por actor (por defecto,
+            dynatrace_actor_activity.json junto a findings_path)
+        coverage (dict, optional): Rango consultado de los logs en esta ejecución ({"from", "to"} en epoch ms)
+
+    Returns:
+        dict: Resumen con el tamaño de los índices, el número de hallazgos de cada
+        tipo y una muestra de cada uno (None si no hay datos de IAM ni de tokens)
+    """
+    account_ndjson_dir = account_ndjson_dir or ndjson_dir
+    users_paths = sorted(glob.glob(os.path.join(account_ndjson_dir, "iam_v1_accounts_*_users.ndjson")))
+    groups_paths = sorted(glob.glob(os.path.join(account_ndjson_dir, "iam_v1_accounts_*_groups.ndjson")))
+    token_paths = sorted(glob.glob(os.path.join(ndjson_dir, "api_v2_apiTokens.ndjson")))
+    auditlog_paths = sorted(glob.glob(os.path.join(ndjson_dir, "api_v2_auditlogs*.ndjson")))
+    if not users_paths and not token_paths:
+        return None
+
+    activity_index_path = activity_index_path or os.path.join(os.path.dirname(findings_path), "dynatrace_actor_activity.json")
+    activity_index = load_activity_index(activity_index_path)
+    result = analyze(users_paths, groups_paths, token_paths, auditlog_paths, activity_index=activity_index, coverage=coverage)
+    with open(findings_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    save_activity_index(activity_index_path, activity_index)
+
+    return {
+        "indexes": result["indexes"],
+        "activity_coverage": result["activity_coverage"],
+        "findings": {
+            name: {"total": len(items), "muestra": items[:summary_sample_size]}
+            for name, items in result["findings"].items()
+        },
+        "top_actors": result["top_actors"]
+    }
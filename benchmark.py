@@ -0,0 +1,451 @@
+import argparse
+import base64
+import hashlib
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# resource solo existe en sistemas POSIX; en Windows no se informa el pico de memoria
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import dynatrace_api_audit as audit
+
+# Endpoints paginados del entorno que emula el servidor, con la clave de su lista
+ENVIRONMENT_LISTS = {
+    "/api/v2/apiTokens": "apiTokens",
+    "/api/v2/activeGates": "activeGates",
+    "/api/v2/activeGateTokens": "activeGateTokens",
+    "/api/v2/auditlogs": "auditLogs",
+    "/api/v2/credentials": "credentials",
+    "/api/v2/tags": "tags",
+    "/api/config/v1/dashboards": "dashboards",
+    "/api/config/v1/applications/mobile": "values",
+    "/api/v1/synthetic/monitors": "monitors",
+    "/api/config/v1/applications/web": "values",
+    "/api/v2/slo": "slo",
+    "/api/config/v1/managementZones": "values"
+}
+
+# Configuración por defecto del servidor simulado
+DEFAULT_MOCK_CONFIG = {
+    "entity_types": 20,          # Tipos devueltos por /api/v2/entityTypes
+    "entities_per_type": 1000,   # Entidades de cada tipo
+    "empty_types": 0,            # Últimos tipos de la lista sin ninguna entidad
+    "items_per_endpoint": 100,   # Elementos de cada endpoint paginado y de IAM
+    "auditlog_events_per_hour": 60,  # Densidad de los logs de auditoría (se filtran por from/to)
+    "max_page_size": 500,        # Tamaño de página máximo que acepta el servidor
+    "latency": 0.02,             # Latencia añadida a cada respuesta (segundos)
+    "path_latency": {},          # Latencia propia de las rutas que empiezan por cada clave
+    "throttle_rate": 0.0,        # Fracción de peticiones respondidas con HTTP 429
+    "retry_after": 0.1,          # Valor de Retry-After en las respuestas 429
+    "payload_bytes": 200,        # Relleno de properties en cada entidad
+    "seed": 42
+}
+
+# Servidor HTTP local que emula la API de Dynatrace
+class MockDynatraceServer:
+    """
+    Emula /api/v2/entityTypes, /api/v2/entities, los endpoints paginados de
+    configuración, el endpoint de tokens de SSO y los endpoints de IAM y
+    suscripciones, con número de páginas, latencia, throttling (HTTP 429) y
+    tamaño de respuesta configurables. Cuenta las peticiones recibidas.
+    """
+
+    # Latencia de una ruta: la del prefijo más largo de path_latency o la general
+    def _latency_for(self, path):
+        prefixes = [prefix for prefix in self.config["path_latency"] if path.startswith(prefix)]
+        if prefixes:
+            return self.config["path_latency"][max(prefixes, key=len)]
+        return self.config["latency"]
+
+    def __init__(self, **config):
+        self.config = {**DEFAULT_MOCK_CONFIG, **config}
+        self.random = random.Random(self.config["seed"])
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.pages = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = self.pages = self.throttled = self.bytes_sent = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _should_throttle(self):
+        with self.lock:
+            self.requests += 1
+            throttle = self.random.random() < self.config["throttle_rate"]
+            if throttle:
+                self.throttled += 1
+            return throttle
+
+    def _record_page(self, size):
+        with self.lock:
+            self.pages += 1
+            self.bytes_sent += size
+
+    # Página de una lista de total elementos generados con make_item
+    def _page(self, stream, total, query, list_key, make_item, fields=None):
+        next_page_key = query.get("nextPageKey", [None])[0]
+        if next_page_key:
+            state = json.loads(base64.urlsafe_b64decode(next_page_key.encode()).decode())
+            start, page_size = state["start"], state["size"]
+        else:
+            start = 0
+            page_size = min(int(query.get("pageSize", [self.config["max_page_size"]])[0]), self.config["max_page_size"])
+        end = min(start + page_size, total)
+        page = {"totalCount": total, "pageSize": page_size, list_key: [make_item(i) for i in range(start, end)]}
+        if end < total:
+            state = json.dumps({"stream": stream, "start": end, "size": page_size, "fields": fields or []})
+            page["nextPageKey"] = base64.urlsafe_b64encode(state.encode()).decode()
+        return page
+
+    # Entidad con los campos solicitados en "fields", como hace la API
+    def _entity(self, entity_type, i, fields):
+        entity = {
+            "entityId": f"{entity_type}-{i:016X}",
+            "type": entity_type,
+            "displayName": f"{entity_type.lower()}-{i}",
+            "firstSeenTms": 1700000000000 + i,
+            "lastSeenTms": 1700000000000 + i * 1000
+        }
+        properties = {"osType": "LINUX", "padding": "x" * self.config["payload_bytes"]}
+        if "+properties" in fields:
+            entity["properties"] = properties
+        else:
+            requested = {f[len("+properties."):] for f in fields if f.startswith("+properties.")}
+            if requested:
+                entity["properties"] = {k: v for k, v in properties.items() if k in requested}
+        if "+tags" in fields:
+            entity["tags"] = [{"context": "CONTEXTLESS", "key": "env", "value": "prod", "stringRepresentation": "env:prod"}]
+        if "+managementZones" in fields:
+            entity["managementZones"] = [{"id": str(i % 5), "name": f"zone-{i % 5}"}]
+        # Cada entidad pertenece a la primera de su bloque de 10 del mismo tipo
+        parent = {"id": f"{entity_type}-{i - i % 10:016X}", "type": entity_type}
+        if "+fromRelationships" in fields and i % 10:
+            entity["fromRelationships"] = {"isPartOf": [parent]}
+        if "+toRelationships" in fields and not i % 10:
+            entity["toRelationships"] = {"isPartOf": [
+                {"id": f"{entity_type}-{j:016X}", "type": entity_type}
+                for j in range(i + 1, min(i + 10, self.config["entities_per_type"]))
+            ]}
+        return entity
+
+    def _response_for(self, method, path, query):
+        items = self.config["items_per_endpoint"]
+        if method == "POST":
+            return 200, {"access_token": "mock-" + "t" * 40, "token_type": "Bearer", "expires_in": 300}
+        if path == "/api/v2/entityTypes":
+            types = [
+                {"type": f"TYPE_{i}", "properties": [{"id": "osType", "type": "Enum"}, {"id": "padding", "type": "String"}]}
+                for i in range(self.config["entity_types"])
+            ]
+            return 200, self._page(path, len(types), query, "types", lambda i: types[i])
+        if path == "/api/v2/entities":
+            if "nextPageKey" in query:
+                state = json.loads(base64.urlsafe_b64decode(query["nextPageKey"][0].encode()).decode())
+                entity_type, fields = state["stream"], state.get("fields", [])
+            else:
+                fields = query.get("fields", [""])[0].split(",")
+                # parse_qs ya decodifica el selector una vez, como la API real
+                selector = query.get("entitySelector", [""])[0]
+                match = re.search(r'type\("([^"]+)"\)', selector)
+                entity_type = match.group(1) if match else "UNKNOWN"
+            suffix = entity_type.rsplit("_", 1)[-1]
+            empty = suffix.isdigit() and int(suffix) >= self.config["entity_types"] - self.config["empty_types"]
+            total = 0 if empty else self.config["entities_per_type"]
+            return 200, self._page(entity_type, total, query, "entities",
+                                   lambda i: self._entity(entity_type, i, fields), fields=fields)
+        # Tokens, logs de auditoría y usuarios relacionados entre sí: parte de los tokens
+        # pertenecen a usuarios que no existen y los logs mezclan usuarios, tokens y desconocidos
+        if path == "/api/v2/apiTokens":
+            return 200, self._page(path, items, query, "apiTokens", lambda i: {
+                "id": f"dt0c01.TOKEN{i}", "name": f"token-{i}", "enabled": i % 3 != 0,
+                "owner": f"user{i * 2}@example.com", "creationDate": "2024-01-01T00:00:00Z"
+            })
+        if path == "/api/v2/auditlogs":
+            # Un evento cada `interval` ms; la página se calcula sobre los eventos de [from, to)
+            interval = max(1, 3600000 // self.config["auditlog_events_per_hour"])
+            if "nextPageKey" in query:
+                stream = json.loads(base64.urlsafe_b64decode(query["nextPageKey"][0].encode()).decode())["stream"]
+            else:
+                now = int(time.time() * 1000)
+                start = int(query.get("from", [now - 14 * 86400000])[0])
+                end = int(query.get("to", [now])[0])
+                stream = f"auditlogs:{-(-start // interval)}:{-(-end // interval)}"
+            _, first, last = stream.split(":")
+            first, last = int(first), int(last)
+            return 200, self._page(stream, max(last - first, 0), query, "auditLogs", lambda i: {
+                "logId": f"{first + i}", "eventType": "UPDATE", "category": "CONFIG", "success": (first + i) % 7 != 0,
+                "user": f"user{(first + i) % (items // 2 or 1)}@example.com" if (first + i) % 4 else f"dt0c01.TOKEN{(first + i) % 10}",
+                "userType": "USER_NAME" if (first + i) % 4 else "PUBLIC_TOKEN_IDENTIFIER", "timestamp": (first + i) * interval
+            })
+        if path in ENVIRONMENT_LISTS:
+            return 200, self._page(path, items, query, ENVIRONMENT_LISTS[path],
+                                   lambda i: {"id": f"{i}", "name": f"item-{i}", "timestamp": 1700000000000 + i})
+        if path.startswith("/iam/v1/accounts/") and path.endswith("/users"):
+            return 200, self._page(path, items, query, "items", lambda i: {
+                "uid": f"u{i}", "email": f"user{i}@example.com", "name": "User", "surname": f"{i}",
+                "userStatus": "ACTIVE" if i % 5 else "INACTIVE"
+            })
+        if path.startswith("/iam/v1/accounts/") and path.endswith("/groups"):
+            return 200, self._page(path, items, query, "items",
+                                   lambda i: {"uuid": f"g{i}", "name": f"group-{i}", "owner": "LOCAL"})
+        if path.startswith("/sub/v2/accounts/"):
+            return 200, self._page(path, items, query, "data", lambda i: {"uuid": f"s{i}", "name": f"sub-{i}"})
+        return 404, {"error": {"code": 404, "message": f"Endpoint no emulado: {path}"}}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self, method):
+                if method == "POST":
+                    length = int(self.headers.get("Content-Length", 0))
+                    self.rfile.read(length)
+                time.sleep(server._latency_for(urllib.parse.urlsplit(self.path).path))
+                if server._should_throttle():
+                    return self._send(429, {"error": {"code": 429, "message": "Too many requests"}},
+                                      {"Retry-After": str(server.config["retry_after"])})
+                parsed = urllib.parse.urlsplit(self.path)
+                try:
+                    status, body = server._response_for(method, parsed.path, urllib.parse.parse_qs(parsed.query))
+                except (ValueError, KeyError):
+                    # nextPageKey ilegible o caducado, como responde la API real
+                    status, body = 400, {"error": {"code": 400, "message": "Invalid nextPageKey"}}
+                self._send(status, body, {"X-RateLimit-Remaining": "1000"})
+
+            def _send(self, status, body, headers):
+                payload = json.dumps(body).encode("utf-8")
+                # ETag del contenido para las revalidaciones con If-None-Match
+                if status == 200:
+                    etag = '"' + hashlib.sha256(payload).hexdigest()[:16] + '"'
+                    headers = {**headers, "ETag": etag}
+                    if self.headers.get("If-None-Match") == etag:
+                        status, payload = 304, b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                if status == 200:
+                    server._record_page(len(payload))
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        return Handler
+
+# Pico de memoria residente de todo el proceso en MB (no baja entre ejecuciones)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa en KB y macOS en bytes
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+# Restablecer el estado global de la auditoría entre repeticiones
+def _reset_audit_state():
+    audit.token_manager = None
+    audit.rate_limiters.clear()
+    audit.circuit_breakers.clear()
+    audit.checkpoint_counter = 0
+
+# Ejecutar main() con las variables globales indicadas y medir el tiempo
+def _run_client(overrides, verbose=False):
+    for name, value in overrides.items():
+        setattr(audit, name, value)
+    _reset_audit_state()
+    start = time.perf_counter()
+    if verbose:
+        exit_code = audit.main()
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exit_code = audit.main()
+    return exit_code, time.perf_counter() - start
+
+# Ejecutar el cliente en un proceso nuevo y devolver también su pico de memoria
+def _run_client_isolated(overrides, verbose=False):
+    exit_code, elapsed = _run_client(overrides, verbose)
+    return exit_code, elapsed, peak_rss_mb()
+
+# Ejecutar main() contra el servidor simulado y medir el rendimiento
+def run_benchmark(server, settings=None, verbose=False, isolated=False, output_dir=None):
+    """
+    Ejecuta la auditoría completa contra el servidor simulado
+
+    Args:
+        server (MockDynatraceServer): Servidor en ejecución
+        settings (dict, optional): Variables globales de dynatrace_api_audit a sobrescribir
+        verbose (bool, optional): Mostrar la salida de la auditoría
+        isolated (bool, optional): Ejecutar el cliente en un proceso propio (spawn), de modo
+            que peak_rss_mb mide solo el cliente en esa ejecución; sin aislar, el estado de
+            la auditoría queda en el módulo y solo se informa process_peak_rss_mb, el pico
+            de todo el proceso del benchmark (incluido el servidor simulado)
+        output_dir (str, optional): Directorio de salida que se conserva al terminar
+            (por defecto, uno temporal que se borra)
+
+    Returns:
+        dict: Métricas de la ejecución
+    """
+    keep_output = output_dir is not None
+    output_dir = output_dir or tempfile.mkdtemp(prefix="dynatrace_benchmark_")
+    overrides = {
+        "environment_base_url": server.url,
+        "account_api_base_url": server.url,
+        "sso_token_url": f"{server.url}/sso/oauth2/token",
+        "output_dir": output_dir,
+        "output_path": os.path.join(output_dir, "dynatrace_api_results.txt"),
+        "log_path": os.path.join(output_dir, "dynatrace_api_log.txt"),
+        "token_cache_enabled": False,
+        **(settings or {})
+    }
+    server.reset_counters()
+
+    client_peak = None
+    try:
+        if isolated:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                exit_code, elapsed, client_peak = executor.submit(_run_client_isolated, overrides, verbose).result()
+        else:
+            exit_code, elapsed = _run_client(overrides, verbose)
+    finally:
+        if not keep_output:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    result = {
+        "exit_code": exit_code,
+        "seconds": round(elapsed, 3),
+        "requests": server.requests,
+        "pages": server.pages,
+        "throttled": server.throttled,
+        "megabytes": round(server.bytes_sent / (1024 * 1024), 2),
+        "requests_per_second": round(server.requests / elapsed, 1),
+        "pages_per_second": round(server.pages / elapsed, 1)
+    }
+    if isolated:
+        result["peak_rss_mb"] = client_peak
+    else:
+        result["process_peak_rss_mb"] = peak_rss_mb()
+    return result
+
+# Leer argumentos de línea de comandos
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de dynatrace_api_audit contra un servidor Dynatrace simulado")
+    parser.add_argument("--types", type=int, default=DEFAULT_MOCK_CONFIG["entity_types"], help="tipos de entidad")
+    parser.add_argument("--empty-types", type=int, default=DEFAULT_MOCK_CONFIG["empty_types"], help="tipos sin entidades")
+    parser.add_argument("--entities-per-type", type=int, default=DEFAULT_MOCK_CONFIG["entities_per_type"], help="entidades por tipo")
+    parser.add_argument("--items", type=int, default=DEFAULT_MOCK_CONFIG["items_per_endpoint"], help="elementos por endpoint paginado")
+    parser.add_argument("--max-page-size", type=int, default=DEFAULT_MOCK_CONFIG["max_page_size"], help="tamaño de página máximo del servidor")
+    parser.add_argument("--latency", type=float, default=DEFAULT_MOCK_CONFIG["latency"], help="latencia por respuesta (segundos)")
+    parser.add_argument("--throttle-rate", type=float, default=DEFAULT_MOCK_CONFIG["throttle_rate"], help="fracción de respuestas HTTP 429")
+    parser.add_argument("--payload-bytes", type=int, default=DEFAULT_MOCK_CONFIG["payload_bytes"], help="relleno por entidad (bytes)")
+    parser.add_argument("--workers", type=int, default=None, help="valor de entity_type_workers")
+    parser.add_argument("--async", dest="async_engine", action="store_true", help="usar el motor asíncrono")
+    parser.add_argument("--profile", default=None, help="perfil de auditoría")
+    parser.add_argument("--cache", action="store_true", help="usar la caché de respuestas (compartida entre repeticiones)")
+    parser.add_argument("--repeat", type=int, default=1, help="número de repeticiones")
+    parser.add_argument("--in-process", action="store_true",
+                        help="ejecutar el cliente en el proceso del benchmark (más rápido de arrancar, pero el pico RSS incluye el servidor y no baja entre repeticiones)")
+    parser.add_argument("--json", metavar="ARCHIVO", help="guardar los resultados en un archivo JSON")
+    parser.add_argument("--verbose", action="store_true", help="mostrar la salida de la auditoría")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    settings = {}
+    if args.workers is not None:
+        settings["entity_type_workers"] = args.workers
+    if args.async_engine:
+        settings["async_engine"] = True
+    if args.profile:
+        settings["audit_profile"] = args.profile
+
+    mock_config = {
+        "entity_types": args.types,
+        "entities_per_type": args.entities_per_type,
+        "empty_types": args.empty_types,
+        "items_per_endpoint": args.items,
+        "max_page_size": args.max_page_size,
+        "latency": args.latency,
+        "throttle_rate": args.throttle_rate,
+        "payload_bytes": args.payload_bytes
+    }
+    cache_dir = None
+    if args.cache:
+        cache_dir = tempfile.mkdtemp(prefix="dynatrace_benchmark_cache_")
+        settings.update(response_cache_enabled=True, response_cache_dir=cache_dir)
+    
+    results = []
+    with MockDynatraceServer(**mock_config) as server:
+        for run in range(1, args.repeat + 1):
+            result = run_benchmark(server, settings=settings, verbose=args.verbose, isolated=not args.in_process)
+            results.append(result)
+            memory = (f"pico RSS del cliente {result['peak_rss_mb']} MB" if "peak_rss_mb" in result
+                      else f"pico RSS del proceso del benchmark {result['process_peak_rss_mb']} MB")
+            print(f"Ejecución {run}/{args.repeat}: {result['seconds']:.2f} s, "
+                  f"{result['requests']} peticiones ({result['requests_per_second']}/s), "
+                  f"{result['pages']} páginas ({result['pages_per_second']}/s), "
+                  f"{result['throttled']} HTTP 429, {result['megabytes']} MB, "
+                  f"{memory}, código de salida {result['exit_code']}")
+
+    if cache_dir:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        settings.pop("response_cache_dir")
+    
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"config": mock_config, "settings": settings, "results": results}, f, indent=2)
+        print(f"Resultados guardados en {args.json}")
+    return 0 if all(r["exit_code"] == 0 for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import glob
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+
+# pyarrow es opcional: solo se necesita para la exportación columnar
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Número de registros por row group de Parquet
+batch_size = 10000
+
+# Compresión de los archivos Parquet
+compression = "zstd"
+
+# Convertir una fecha ISO 8601 (o epoch en milisegundos) a datetime en UTC
+def _parse_timestamp(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+# Serializar un valor anidado heterogéneo como texto JSON
+def _to_json(value):
+    return None if value is None else json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+# Campo de un registro
+def _field(name):
+    return lambda record: record.get(name)
+
+# Campo de fecha de un registro
+def _timestamp_field(name):
+    return lambda record: _parse_timestamp(record.get(name))
+
+# Campo anidado serializado como JSON
+def _json_field(name):
+    return lambda record: _to_json(record.get(name))
+
+# Resto de campos no incluidos en el esquema, como JSON
+def _extra_fields(known):
+    def extract(record):
+        extra = {k: v for k, v in record.items() if k not in known}
+        return _to_json(extra) if extra else None
+    return extract
+
+# Definición de los conjuntos de datos: patrón de los NDJSON de origen y columnas
+# (nombre, tipo Arrow, función de extracción)
+def _dataset_specs():
+    tag_type = pa.list_(pa.struct([
+        ("context", pa.string()),
+        ("key", pa.string()),
+        ("value", pa.string()),
+        ("stringRepresentation", pa.string())
+    ]))
+    zone_type = pa.list_(pa.struct([("id", pa.string()), ("name", pa.string())]))
+    timestamp_type = pa.timestamp("ms", tz="UTC")
+
+    def columns(*spec, extra=True):
+        spec = list(spec)
+        if extra:
+            spec.append(("extra", pa.string(), _extra_fields({name for name, _, _ in spec})))
+        return spec
+
+    return {
+        "entities": {
+            "pattern": "entities_*.ndjson",
+            "columns": columns(
+                ("entityId", pa.string(), _field("entityId")),
+                ("type", pa.string(), _field("type")),
+                ("displayName", pa.string(), _field("displayName")),
+                ("firstSeenTms", timestamp_type, _timestamp_field("firstSeenTms")),
+                ("lastSeenTms", timestamp_type, _timestamp_field("lastSeenTms")),
+                ("tags", tag_type, lambda r: [
+                    {k: (None if t.get(k) is None else str(t.get(k))) for k in ("context", "key", "value", "stringRepresentation")}
+                    for t in r.get("tags") or []
+                ]),
+                ("managementZones", zone_type, lambda r: [
+                    {"id": str(z.get("id")), "name": z.get("name")} for z in r.get("managementZones") or []
+                ]),
+                ("properties", pa.string(), _json_field("properties"))
+            )
+        },
+        "users": {
+            "pattern": "iam_v1_accounts_*_users.ndjson",
+            "columns": columns(
+                ("uid", pa.string(), _field("uid")),
+                ("email", pa.string(), _field("email")),
+                ("name", pa.string(), _field("name")),
+                ("surname", pa.string(), _field("surname")),
+                ("userStatus", pa.string(), _field("userStatus"))
+            )
+        },
+        "groups": {
+            "pattern": "iam_v1_accounts_*_groups.ndjson",
+            "columns": columns(
+                ("uuid", pa.string(), _field("uuid")),
+                ("name", pa.string(), _field("name")),
+                ("owner", pa.string(), _field("owner")),
+                ("description", pa.string(), _field("description")),
+                ("hidden", pa.bool_(), _field("hidden")),
+                ("createdAt", timestamp_type, _timestamp_field("createdAt")),
+                ("updatedAt", timestamp_type, _timestamp_field("updatedAt"))
+            )
+        },
+        "api_tokens": {
+            "pattern": "api_v2_apiTokens.ndjson",
+            "columns": columns(
+                ("id", pa.string(), _field("id")),
+                ("name", pa.string(), _field("name")),
+                ("enabled", pa.bool_(), _field("enabled")),
+                ("owner", pa.string(), _field("owner")),
+                ("creationDate", timestamp_type, _timestamp_field("creationDate")),
+                ("expirationDate", timestamp_type, _timestamp_field("expirationDate")),
+                ("lastUsedDate", timestamp_type, _timestamp_field("lastUsedDate")),
+                ("scopes", pa.list_(pa.string()), _field("scopes"))
+            )
+        },
+        "audit_logs": {
+            "pattern": "api_v2_auditlogs*.ndjson",
+            "columns": columns(
+                ("logId", pa.string(), _field("logId")),
+                ("eventType", pa.string(), _field("eventType")),
+                ("category", pa.string(), _field("category")),
+                ("entityId", pa.string(), _field("entityId")),
+                ("environmentId", pa.string(), _field("environmentId")),
+                ("user", pa.string(), _field("user")),
+                ("userType", pa.string(), _field("userType")),
+                ("userOrigin", pa.string(), _field("userOrigin")),
+                ("timestamp", timestamp_type, _timestamp_field("timestamp")),
+                ("success", pa.bool_(), _field("success")),
+                ("message", pa.string(), _field("message")),
+                ("patch", pa.string(), _json_field("patch"))
+            )
+        }
+    }
+
+# Leer un NDJSON en lotes de registros
+def _iter_batches(paths, size):
+    batch = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    batch.append(json.loads(line))
+                    if len(batch) >= size:
+                        yield batch
+                        batch = []
+    if batch:
+        yield batch
+
+# Ajustar un valor al tipo de su columna (la API no siempre devuelve el mismo tipo)
+def _coerce(value, arrow_type):
+    if value is None:
+        return None
+    if pa.types.is_string(arrow_type) and not isinstance(value, str):
+        return _to_json(value) if isinstance(value, (dict, list)) else str(value)
+    if pa.types.is_boolean(arrow_type) and not isinstance(value, bool):
+        return str(value).lower() == "true"
+    return value
+
+# Convertir un lote de registros en una tabla Arrow con el esquema del conjunto de datos
+def _batch_to_table(records, columns, schema):
+    arrays = [
+        pa.array([_coerce(extract(record), arrow_type) for record in records], type=arrow_type)
+        for _, arrow_type, extract in columns
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+# Exportar un conjunto de datos a Parquet
+def export_dataset(name, spec, ndjson_dir, export_dir, index=None):
+    """
+    Escribe los NDJSON que coinciden con el patrón del conjunto de datos en un único
+    archivo Parquet, en row groups de batch_size registros
+
+    Args:
+        name (str): Nombre del conjunto de datos
+        spec (dict): Patrón de origen y columnas
+        ndjson_dir (str): Carpeta con los NDJSON de la auditoría
+        export_dir (str): Carpeta de destino
+        index (sqlite3.Connection, optional): Índice donde registrar la posición de cada entityId
+
+    Returns:
+        int: Número de registros exportados (None si no hay datos de origen)
+    """
+    paths = sorted(glob.glob(os.path.join(ndjson_dir, spec["pattern"])))
+    if not paths:
+        return None
+
+    columns = spec["columns"]
+    schema = pa.schema([(column, arrow_type) for column, arrow_type, _ in columns])
+    path = os.path.join(export_dir, f"{name}.parquet")
+    row_count = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for row_group, records in enumerate(_iter_batches(paths, batch_size)):
+            writer.write_table(_batch_to_table(records, columns, schema))
+            if index is not None:
+                index.executemany(
+                    "INSERT OR REPLACE INTO entity_index VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (record.get("entityId"), record.get("type"), f"{name}.parquet", row_group, offset)
+                        for offset, record in enumerate(records) if record.get("entityId")
+                    )
+                )
+            row_count += len(records)
+    return row_count
+
+# Exportar todos los conjuntos de datos de una auditoría
+def export_datasets(ndjson_dir, export_dir):
+    """
+    Exporta entidades, usuarios, grupos, tokens y logs de auditoría a archivos
+    Parquet comprimidos (uno por conjunto de datos) y crea entity_index.sqlite,
+    que asocia cada entityId con su archivo, row group y fila dentro del row group
+    (pq.ParquetFile(archivo).read_row_group(row_group).slice(row, 1))
+
+    Args:
+        ndjson_dir (str): Carpeta con los NDJSON de la auditoría
+        export_dir (str): Carpeta de destino
+
+    Returns:
+        dict: Número de registros exportados por conjunto de datos
+    """
+    if pa is None:
+        raise ImportError("La exportación columnar requiere pyarrow (pip install pyarrow)")
+
+    os.makedirs(export_dir, exist_ok=True)
+    index_path = os.path.join(export_dir, "entity_index.sqlite")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = sqlite3.connect(index_path)
+    index.execute("""
+        CREATE TABLE entity_index (
+            entity_id TEXT PRIMARY KEY,
+            type TEXT,
+            file TEXT,
+            row_group INTEGER,
+            row INTEGER
+        )
+    """)
+
+    results = {}
+    try:
+        for name, spec in _dataset_specs().items():
+            count = export_dataset(name, spec, ndjson_dir, export_dir, index=index if name == "entities" else None)
+            if count is not None:
+                results[name] = count
+        index.execute("CREATE INDEX entity_index_type ON entity_index (type)")
+        index.commit()
+    finally:
+        index.close()
+    return results
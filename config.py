@@ -1,4 +1,5 @@
 import os
+import json
 
 class DynatraceConfig:
     def __init__(self, 
@@ -6,7 +7,11 @@ class DynatraceConfig:
                  account_id=None, 
                  client_id=None, 
                  client_secret=None, 
-                 output_path=r"C:\Users\TI724\Downloads"):
+                 output_path=None,
+                 environments_file=None,
+                 api_token=None,
+                 base_url=None,
+                 profile=None):
         """
         Configuración de credenciales y parámetros para Dynatrace API
         
@@ -15,23 +20,48 @@ class DynatraceConfig:
         :param client_id: ID del cliente OAuth2
         :param client_secret: Secreto del cliente OAuth2
         :param output_path: Ruta de salida para informes
+        :param environments_file: Archivo JSON con la lista de entornos para auditorías multi-entorno
+        :param api_token: Token de la Environment API
+        :param base_url: URL base del entorno (Managed o dominio propio)
+        :param profile: Perfil de auditoría
         """
         self.environment_id = environment_id or os.getenv('DYNATRACE_ENV_ID')
         self.account_id = account_id or os.getenv('DYNATRACE_ACCOUNT_ID')
         self.client_id = client_id or os.getenv('DYNATRACE_CLIENT_ID')
         self.client_secret = client_secret or os.getenv('DYNATRACE_CLIENT_SECRET')
-        self.output_path = output_path
+        self.output_path = output_path or os.getenv('OUTPUT_PATH')
+        self.environments_file = environments_file or os.getenv('DYNATRACE_ENVIRONMENTS_FILE')
+        self.api_token = api_token or os.getenv('DYNATRACE_API_TOKEN')
+        self.base_url = base_url or os.getenv('DYNATRACE_BASE_URL')
+        self.profile = profile or os.getenv('DYNATRACE_AUDIT_PROFILE')
 
-    def validate(self):
+    @classmethod
+    def from_env(cls, env_file=".env", **kwargs):
+        """
+        Crea la configuración a partir de los argumentos, las variables de entorno y
+        el archivo .env, por este orden de prioridad (el .env no sustituye variables
+        ya definidas). python-dotenv solo se importa si el archivo existe.
+        
+        :param env_file: Ruta del archivo .env
+        :return: DynatraceConfig
+        """
+        if env_file and os.path.exists(env_file):
+            try:
+                from dotenv import load_dotenv
+            except ImportError:
+                raise ImportError("Para leer el archivo .env se necesita python-dotenv (pip install python-dotenv)")
+            load_dotenv(env_file, override=False)
+        return cls(**kwargs)
+
+    def validate(self, account=True):
         """
         Valida que todos los parámetros necesarios estén configurados
+        
+        :param account: Si también se consulta la Account Management API
         """
-        required_params = [
-            'environment_id', 
-            'account_id', 
-            'client_id', 
-            'client_secret'
-        ]
+        required_params = ['environment_id', 'api_token']
+        if account:
+            required_params += ['account_id', 'client_id', 'client_secret']
         
         missing_params = [
             param for param in required_params 
@@ -43,8 +73,53 @@ class DynatraceConfig:
         
         return True
 
-    def get_base_url(self):
+    def get_base_url(self, environment_id=None):
         """
         Obtiene la URL base para las llamadas a la API
+        
+        :param environment_id: ID de otro entorno (por defecto, el configurado)
+        """
+        if environment_id is None and self.base_url:
+            return self.base_url.rstrip('/')
+        return f"https://{environment_id or self.environment_id}.live.dynatrace.com"
+
+    def get_environments(self):
+        """
+        Obtiene la lista de entornos a auditar desde environments_file
+        """
+        if not self.environments_file:
+            return []
+        return self.load_environments(self.environments_file)
+
+    @staticmethod
+    def load_environments(path):
         """
-        return f"https://{self.environment_id}.live.dynatrace.com"
\ No newline at end of file
+        Carga la lista de entornos desde un archivo JSON con el formato
+        [{"name": "prod", "environment_id": "abc12345", "api_token": "dt0c01..."}].
+        En lugar de "api_token" se puede indicar "api_token_env" con el nombre de
+        la variable de entorno que contiene el token, y "base_url" para entornos
+        Managed o con dominio propio.
+        
+        :param path: Ruta del archivo JSON
+        :return: Lista de diccionarios con name, environment_id, api_token y base_url
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+
+        environments = []
+        for entry in entries:
+            environment = {
+                "name": entry.get("name") or entry.get("environment_id"),
+                "environment_id": entry.get("environment_id"),
+                "api_token": entry.get("api_token") or os.getenv(entry.get("api_token_env", "")),
+                "base_url": entry.get("base_url")
+            }
+            missing_params = [
+                param for param in ("environment_id", "api_token")
+                if not environment[param]
+            ]
+            if missing_params:
+                raise ValueError(f"Parámetros faltantes en el entorno {environment['name']}: {', '.join(missing_params)}")
+            environments.append(environment)
+
+        return environments
\ No newline at end of file
@@ -1,11 +1,32 @@
-import requests
 import json
 import os
 import time
 import urllib.parse
 import getpass
 import sys
-from datetime import datetime
+import threading
+import atexit
+import argparse
+import hashlib
+import sqlite3
+import random
+import multiprocessing
+import tempfile
+import shutil
+import fnmatch
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timezone
+from config import DynatraceConfig
+
+# requests y asyncio se importan al usarse por primera vez, para que --help,
+# --dry-run y --plan arranquen sin cargarlos
+
+# orjson es opcional: si está instalado se usa como serializador JSON más rápido
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Configuraciones generales
 account_id = "xxxxxxxxx"
@@ -19,36 +40,396 @@ client_id = "xxxxxx"
 client_secret = "xxxxxxx"
 api_token = "xxxxxxx"
 
+# URL base del entorno; None usa https://{environment_id}.live.dynatrace.com
+environment_base_url = None
+
+# URLs de la Account Management API y del endpoint de tokens de SSO
+account_api_base_url = "https://api.dynatrace.com"
+sso_token_url = "https://sso.dynatrace.com/sso/oauth2/token"
+
+# Auditoría multi-entorno: número de entornos auditados a la vez (un proceso por
+# entorno) y límite global de hilos de consulta repartido entre los procesos
+environment_workers = 4
+multi_env_max_concurrency = 16
+
+# Número de tipos de entidad consultados en paralelo (1 = modo secuencial)
+entity_type_workers = 8
+
+# Fragmentación opcional de los tipos de entidad más grandes: cada tipo indicado se
+# divide en selectores disjuntos que se consultan en paralelo (shard_workers hilos)
+# Ejemplo: {"SERVICE_METHOD": {"strategy": "managementZone"},
+#           "PROCESS_GROUP_INSTANCE": {"strategy": "tag", "tags": ["env:prod", "env:dev"]}}
+sharded_entity_types = {}
+shard_workers = 4
+
+# Perfiles de auditoría: cada perfil elige los endpoints del entorno, si se consulta
+# la Account Management API, los campos y el tamaño de página de las entidades, los
+# tipos incluidos o excluidos (patrones fnmatch) y ajustes por tipo. Las claves que
+# no se indican toman el valor de audit_profile_defaults
+audit_profile_defaults = {
+    "endpoints": None,  # None = todos los paginated_endpoints
+    "account": True,
+    "page_size": 500,
+    "entity_types": None,  # None = todos los tipos devueltos por /api/v2/entityTypes
+    "exclude_entity_types": [],
+    "entity_fields": "+properties,+tags,+managementZones",
+    "entity_properties": None,  # Lista de propiedades concretas en lugar de +properties
+    "type_overrides": {},  # {"TIPO": {"entity_fields": ..., "page_size": ...}}
+    "skip_empty_types": False
+}
+audit_profiles = {
+    "full": {},
+    "security": {
+        "endpoints": ["/api/v2/apiTokens", "/api/v2/activeGateTokens", "/api/v2/auditlogs", "/api/v2/credentials"],
+        "entity_types": ["HOST", "PROCESS_GROUP", "SERVICE", "APPLICATION", "KUBERNETES_CLUSTER"],
+        "entity_fields": "+tags,+managementZones",
+        "entity_properties": ["softwareTechnologies", "osType", "monitoringMode", "agentVersion"],
+        "skip_empty_types": True
+    },
+    "inventory": {
+        "endpoints": ["/api/v2/activeGates", "/api/v2/tags", "/api/config/v1/applications/mobile",
+                      "/api/config/v1/applications/web", "/api/v1/synthetic/monitors"],
+        "account": False,
+        "entity_fields": "+tags,+managementZones",
+        "exclude_entity_types": ["SERVICE_METHOD", "SERVICE_METHOD_GROUP", "*_INSTANCE"],
+        "skip_empty_types": True
+    }
+}
+audit_profile = "full"
+
+# Tipos de entidad vacíos en ejecuciones anteriores: con skip_empty_types se omiten
+# hasta que pasan empty_type_recheck_hours horas desde la última comprobación
+entity_type_counts_path = None  # Por defecto: output_dir/dynatrace_entity_type_counts.json
+empty_type_recheck_hours = 24
+
+# Limitador de tasa adaptativo: reintentos ante HTTP 429 y margen de peticiones
+# restantes a partir del cual se empiezan a espaciar las consultas
+max_throttle_retries = 5
+rate_limit_low_watermark = 5
+
+# Pool de conexiones HTTP por host (keep-alive y compresión gzip)
+http_pool_connections = 4
+http_pool_maxsize = 16
+http_timeout = (10, 120)  # (conexión, lectura) en segundos
+
+# Reintentos ante errores transitorios (5xx, timeouts, conexiones cortadas) con
+# espera exponencial con jitter, y circuito por host: tras circuit_failure_threshold
+# fallos consecutivos las peticiones a ese host fallan de inmediato durante
+# circuit_reset_timeout segundos para no bloquear el resto del recorrido
+max_request_retries = 4
+retry_backoff_base = 0.5
+retry_backoff_max = 30.0
+retryable_status_codes = (500, 502, 503, 504)
+circuit_failure_threshold = 10
+circuit_reset_timeout = 60.0
+
+# Salida en streaming: los elementos de cada endpoint se escriben página a página
+# en archivos NDJSON (output_dir/ndjson) en lugar de combinarse en memoria
+ndjson_output = True
+
+# Con ndjson_output, el archivo de resultados solo recibe una línea de resumen por
+# página; True vuelve a volcar cada página completa (cada elemento se serializa dos veces)
+full_page_results = False
+
+# Escritura con buffer de los archivos de resultados y log: tamaño máximo del
+# buffer (caracteres) e intervalo máximo entre volcados (segundos)
+output_buffer_size = 1024 * 1024
+output_flush_interval = 5.0
+
+# Serialización JSON del archivo de resultados: True mantiene el formato con
+# sangría; False usa el formato compacto (más rápido y más pequeño)
+pretty_json = True
+
+# Auditoría incremental: guarda en SQLite ETags, hashes y la fecha de la última
+# ejecución de cada endpoint para consultar después solo lo que ha cambiado
+incremental_mode = False
+state_db_path = None  # Por defecto: output_dir/dynatrace_audit_state.sqlite
+
+# Horas entre consultas completas (sin "from") de cada tipo de entidad en modo
+# incremental; solo en ellas se detectan las entidades que han desaparecido
+incremental_entity_full_scan_hours = 24
+
+# Endpoints que admiten el filtro temporal "from" en modo incremental
+incremental_time_filtered_endpoints = ["/api/v2/auditlogs"]
+
+# Reanudación: el progreso del recorrido (flujos completados y nextPageKey en curso)
+# se guarda en un archivo JSON para continuar con --resume tras una interrupción
+resume_mode = False
+crawl_checkpoint_path = None  # Por defecto: output_dir/dynatrace_crawl_checkpoint.json
+checkpoint_save_interval = 5.0  # Segundos mínimos entre guardados del progreso de un flujo
+
+# Exportación columnar (Parquet, requiere pyarrow) de los NDJSON al terminar la auditoría
+columnar_export_enabled = False
+
+# Inventario de entidades en memoria (entity_store.EntityStore) para analizarlo al
+# terminar la ejecución: registros compactos con índices por tipo, etiqueta y zona
+entity_store_enabled = False
+
+# Cruce de usuarios y grupos de IAM con los tokens y los logs de auditoría del
+# entorno al terminar la auditoría (hallazgos en output_dir/dynatrace_findings.json)
+cross_reference_enabled = True
+
+# Días mínimos de logs de auditoría cubiertos (acumulados entre ejecuciones en
+# output_dir/dynatrace_actor_activity.json) para señalar usuarios y tokens sin actividad
+inactivity_min_coverage_days = 30
+
+# Caché del Bearer Token de SSO y margen (segundos) para renovarlo antes de que caduque
+token_cache_enabled = True
+token_cache_path = None  # Por defecto: output_dir/.dynatrace_token_cache.json
+token_refresh_margin = 60
+
+# Logs de auditoría por ventanas de tiempo: el rango pedido se divide en ventanas de
+# auditlog_window_hours horas que se consultan en paralelo (auditlog_workers hilos) y
+# se escriben en orden cronológico. La marca de agua (fin del último rango completo)
+# se guarda para que la siguiente ejecución pida solo los eventos nuevos; la primera
+# ejecución consulta los últimos auditlog_lookback_days días
+auditlog_windowed = True
+auditlog_window_hours = 24
+auditlog_workers = 4
+auditlog_lookback_days = 14
+auditlog_ingest_delay = 60  # Segundos de margen para eventos que aún no son visibles
+auditlog_watermark_path = None  # Por defecto: output_dir/dynatrace_auditlog_watermark.json
+auditlog_from = None  # Rango explícito (ISO 8601); no modifica la marca de agua
+auditlog_to = None
+
+# Caché en disco de respuestas de endpoints que cambian poco (--cache): cada flujo
+# se reutiliza mientras su primera página no supere el TTL de su endpoint (patrones
+# fnmatch sobre la ruta); después se revalida con If-None-Match / If-Modified-Since.
+# Los cuerpos se guardan por su hash y se expulsan por LRU al superar el tamaño máximo
+response_cache_enabled = False
+response_cache_dir = None  # Por defecto: output_dir/.response_cache
+response_cache_max_bytes = 512 * 1024 * 1024
+response_cache_ttls = {
+    "/api/v2/entityTypes": 24 * 3600,
+    "/api/config/v1/dashboards": 3600,
+    "/api/config/v1/applications/web": 3600,
+    "/api/config/v1/applications/mobile": 3600,
+    "/iam/v1/accounts/*/groups": 3600
+}
+
+# Métricas por petición (tiempo hasta la cabecera, descarga, bytes, estado, reintentos
+# y pausas) agregadas por endpoint y tipo de entidad, exportadas al terminar en
+# formato Prometheus (textfile collector) y como perfil JSON de la ejecución
+metrics_enabled = True
+metrics_textfile_path = None  # Por defecto: output_dir/dynatrace_audit.prom
+run_profile_path = None  # Por defecto: output_dir/dynatrace_run_profile.json
+metrics_duration_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Motor asíncrono (--async): los endpoints del entorno, las entidades de cada tipo y
+# la Account Management API se consultan como tareas concurrentes, con un máximo de
+# async_max_concurrency flujos simultáneos sobre el pool de conexiones compartido.
+# Las ventanas del audit log (auditlog_workers) y los fragmentos de un tipo
+# (shard_workers) abren sus propios hilos dentro de su flujo y no cuentan en ese
+# límite: un flujo que ocupa un hueco esperaría a sus subtareas y, con todos los
+# huecos ocupados, se bloquearía. El pool HTTP se dimensiona para la suma
+async_engine = False
+async_max_concurrency = 16
+
 # Inicializar contador de puntos de control
 checkpoint_counter = 0
+checkpoint_lock = threading.Lock()
+
+# Salida diferida por hilo: mientras un hilo tiene un buffer activo, los
+# resultados y checkpoints se acumulan en él en lugar de ir a los archivos
+_output_capture = threading.local()
+
+# Tamaño (caracteres) a partir del cual la salida capturada pasa de memoria a disco
+capture_spool_size = 8 * 1024 * 1024
+
+# Salida capturada de un hilo, en el orden en que se produjo
+class CapturedOutput:
+    """
+    Los bloques de resultados se guardan en un archivo temporal que solo pasa a
+    disco al superar capture_spool_size, para que la salida de un tipo de entidad
+    muy grande no se acumule en memoria mientras espera su turno.
+    """
+    
+    def __init__(self):
+        self.entries = []
+        self.spool = tempfile.SpooledTemporaryFile(max_size=capture_spool_size, mode='w+', encoding='utf-8')
+    
+    def add_result(self, text):
+        self.spool.write(text)
+        self.entries.append(("result", len(text), None))
+    
+    def add_checkpoint(self, message, timestamp):
+        self.entries.append(("checkpoint", message, timestamp))
+    
+    def replay(self):
+        """
+        Produce las entradas capturadas en orden y libera el archivo temporal
+        """
+        self.spool.seek(0)
+        try:
+            for kind, payload, timestamp in self.entries:
+                if kind == "result":
+                    yield kind, self.spool.read(payload), None
+                else:
+                    yield kind, payload, timestamp
+        finally:
+            self.spool.close()
+            self.entries = []
+
+# Función para iniciar la captura de salida en el hilo actual
+def start_output_capture():
+    _output_capture.buffer = CapturedOutput()
+
+# Función para detener la captura y devolver la salida acumulada
+def stop_output_capture():
+    buffer = getattr(_output_capture, "buffer", None)
+    _output_capture.buffer = None
+    return buffer or CapturedOutput()
+
+# Función para volcar a los archivos la salida capturada por un hilo
+def flush_captured_output(captured):
+    # Si el hilo actual también está capturando, la salida pasa a su propio buffer
+    buffer = getattr(_output_capture, "buffer", None)
+    for kind, payload, timestamp in captured.replay():
+        if buffer is not None:
+            if kind == "checkpoint":
+                buffer.add_checkpoint(payload, timestamp)
+            else:
+                buffer.add_result(payload)
+        elif kind == "checkpoint":
+            log_checkpoint(payload, timestamp=timestamp)
+        else:
+            write_to_results(payload)
 
 # Función para registrar punto de control
-def log_checkpoint(message):
+def log_checkpoint(message, timestamp=None):
     global checkpoint_counter
-    checkpoint_counter += 1
-    checkpoint_msg = f"CHECKPOINT #{checkpoint_counter}: {message} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    timestamp = timestamp or datetime.now()
+    
+    # Si el hilo está capturando salida, diferir el checkpoint para numerarlo en orden
+    buffer = getattr(_output_capture, "buffer", None)
+    if buffer is not None:
+        buffer.add_checkpoint(message, timestamp)
+        return
     
-    print(checkpoint_msg)
+    with checkpoint_lock:
+        checkpoint_counter += 1
+        checkpoint_msg = f"CHECKPOINT #{checkpoint_counter}: {message} - {timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
+        
+        print(checkpoint_msg)
+        
+        # Registrar en archivo de log
+        get_writer(log_path).write(checkpoint_msg + "\n")
+        
+        # También añadir al archivo de resultados
+        get_writer(output_path).write(f"# {checkpoint_msg}\n\n")
+
+# Escritor con buffer que mantiene abierto un archivo de salida
+class OutputWriter:
+    """
+    Mantiene abierto el archivo y acumula las escrituras en memoria. El buffer se
+    vuelca al superar output_buffer_size caracteres, cuando han pasado más de
+    output_flush_interval segundos desde el último volcado, o al cerrar. Un
+    temporizador vuelca el buffer aunque no lleguen más escrituras (por ejemplo,
+    mientras los hilos esperan al limitador de tasa).
+    """
+    
+    def __init__(self, path, mode='a'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, mode, encoding='utf-8')
+        self.buffer = []
+        self.buffered_chars = 0
+        self.last_flush = time.time()
+        self.timer = None
+    
+    def write(self, text):
+        with self.lock:
+            self.buffer.append(text)
+            self.buffered_chars += len(text)
+            if self.buffered_chars >= output_buffer_size or time.time() - self.last_flush >= output_flush_interval:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(output_flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
     
-    # Registrar en archivo de log
-    with open(log_path, 'a', encoding='utf-8') as f:
-        f.write(checkpoint_msg + "\n")
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer.clear()
+            self.buffered_chars = 0
+        self.file.flush()
+        self.last_flush = time.time()
     
-    # También añadir al archivo de resultados
-    with open(output_path, 'a', encoding='utf-8') as f:
-        f.write(f"# {checkpoint_msg}\n\n")
+    def flush(self):
+        with self.lock:
+            if not self.file.closed:
+                self._flush()
+    
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self._flush()
+                self.file.close()
+
+# Escritores abiertos, por ruta de archivo
+output_writers = {}
+output_writers_lock = threading.Lock()
+
+# Obtener el escritor de un archivo; con mode='w' se trunca y se reabre
+def get_writer(path, mode='a'):
+    with output_writers_lock:
+        writer = output_writers.get(path)
+        if writer is None or mode == 'w':
+            if writer is not None:
+                writer.close()
+            writer = OutputWriter(path, mode)
+            output_writers[path] = writer
+        return writer
+
+# Volcar todos los buffers pendientes
+def flush_writers():
+    with output_writers_lock:
+        writers = list(output_writers.values())
+    for writer in writers:
+        writer.flush()
+
+# Cerrar todos los escritores (también se ejecuta al terminar el proceso)
+def close_writers():
+    with output_writers_lock:
+        writers = list(output_writers.values())
+        output_writers.clear()
+    for writer in writers:
+        writer.close()
+
+atexit.register(close_writers)
+
+# Serializar datos a JSON, usando orjson si está disponible
+def dumps_json(data, pretty=False):
+    if orjson is not None:
+        try:
+            option = orjson.OPT_INDENT_2 if pretty else 0
+            return orjson.dumps(data, option=option).decode("utf-8")
+        except TypeError:
+            # orjson no admite algunos tipos (p. ej. enteros de más de 64 bits)
+            pass
+    if pretty:
+        return json.dumps(data, indent=2)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
 
 # Crear archivo de resultados
-def create_result_file():
+def create_result_file(resume=False):
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(f"Dynatrace API Results - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("="*100 + "\n\n")
+        # Al reanudar se conservan los archivos de la ejecución interrumpida
+        mode = 'a' if resume else 'w'
+        header = "Reanudación" if resume else "Dynatrace API Results"
+        get_writer(output_path, mode).write(
+            f"{header} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n" + "="*100 + "\n\n"
+        )
         
         # Crear o limpiar archivo de log
-        with open(log_path, 'w', encoding='utf-8') as f:
-            f.write(f"Dynatrace API Execution Log - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write("="*100 + "\n\n")
+        header = "Reanudación" if resume else "Dynatrace API Execution Log"
+        get_writer(log_path, mode).write(
+            f"{header} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n" + "="*100 + "\n\n"
+        )
         
         log_checkpoint("Archivos de resultados y log creados correctamente")
         return True
@@ -56,25 +437,610 @@ def create_result_file():
         print(f"ERROR al crear archivos: {str(e)}")
         return False
 
+# Dar formato a un bloque de resultados
+def format_result(title, data):
+    text = f"{title}\n" + "-"*100 + "\n"
+    if isinstance(data, dict) or isinstance(data, list):
+        text += dumps_json(data, pretty=pretty_json) + "\n\n"
+    else:
+        text += str(data) + "\n\n"
+    return text
+
+# Escribir un bloque ya formateado en el archivo de resultados
+def write_to_results(text):
+    get_writer(output_path).write(text)
+
 # Añadir resultados al archivo
 def append_to_file(title, data):
     try:
-        with open(output_path, 'a', encoding='utf-8') as f:
-            f.write(f"{title}\n")
-            f.write("-"*100 + "\n")
-            if isinstance(data, dict) or isinstance(data, list):
-                f.write(json.dumps(data, indent=2) + "\n\n")
-            else:
-                f.write(str(data) + "\n\n")
-        return True
+        return append_text_to_file(format_result(title, data))
     except Exception as e:
         print(f"ERROR al escribir en archivo: {str(e)}")
         return False
 
-# Obtener token de Dynatrace SSO
-def get_bearer_token():
-    log_checkpoint("Solicitando Bearer Token desde Dynatrace SSO")
+# Añadir un bloque de texto ya formateado al archivo de resultados
+def append_text_to_file(text):
+    # Si el hilo está capturando salida, guardar el bloque ya serializado
+    buffer = getattr(_output_capture, "buffer", None)
+    if buffer is not None:
+        buffer.add_result(text)
+        return True
+    
+    write_to_results(text)
+    return True
+
+# Limitador de tasa adaptativo compartido por todas las consultas a un mismo host
+class RateLimiter:
+    """
+    Planificador de peticiones adaptativo que usa las cabeceras X-RateLimit-* y
+    Retry-After de Dynatrace. Mientras hay presupuesto disponible no introduce
+    pausas; ante un HTTP 429 bloquea el host hasta que expira Retry-After y
+    duplica el intervalo entre peticiones una sola vez por episodio (los 429 que
+    llegan mientras el host sigue bloqueado no lo vuelven a duplicar). Con cada
+    respuesta correcta el intervalo se multiplica por recovery_factor hasta
+    desaparecer. Los hilos no reservan turnos por adelantado: cada uno espera a
+    que haya pasado el intervalo vigente desde la última petición del host y
+    vuelve a comprobarlo cuando el intervalo cambia, de modo que tras un bloqueo
+    los turnos no se acumulan.
+    """
+    
+    def __init__(self, max_interval=30.0, recovery_factor=0.5, min_interval=0.01, low_watermark=None):
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.interval = 0.0
+        self.max_interval = max_interval
+        self.recovery_factor = recovery_factor
+        self.min_interval = min_interval
+        self.low_watermark = rate_limit_low_watermark if low_watermark is None else low_watermark
+        self.last_request = 0.0
+        self.blocked_until = 0.0
+        self.remaining = None
+        self.reset_at = None
+        self.throttled_count = 0
+        self.total_sleep = 0.0
+    
+    def acquire(self):
+        """
+        Espera al siguiente turno de petición del host
+        
+        Returns:
+            float: segundos esperados
+        """
+        start = time.time()
+        with self.condition:
+            while True:
+                now = time.time()
+                spacing = self.interval
+                slot = self.blocked_until
+                
+                # Si queda poco presupuesto, repartir las peticiones restantes hasta el reinicio
+                if self.remaining is not None and self.reset_at and self.reset_at > now:
+                    if self.remaining <= 0:
+                        slot = max(slot, self.reset_at)
+                    elif self.remaining <= self.low_watermark:
+                        spacing = max(spacing, (self.reset_at - now) / self.remaining)
+                
+                slot = max(slot, self.last_request + spacing)
+                if slot <= now:
+                    break
+                self.condition.wait(slot - now)
+            
+            self.last_request = now
+            if self.remaining is not None:
+                self.remaining -= 1
+            wait = now - start
+            self.total_sleep += wait
+        return wait
+    
+    def update(self, response):
+        """
+        Ajusta el ritmo según las cabeceras de la respuesta
+        
+        Returns:
+            float: segundos a esperar antes de reintentar si la respuesta fue un 429, 0 en otro caso
+        """
+        headers = response.headers or {}
+        now = time.time()
+        
+        with self.lock:
+            remaining = _parse_int_header(headers.get("X-RateLimit-Remaining"))
+            reset_at = _parse_reset_header(headers.get("X-RateLimit-Reset"))
+            if remaining is not None:
+                self.remaining = remaining
+            if reset_at is not None:
+                self.reset_at = reset_at
+            
+            if response.status_code == 429:
+                self.throttled_count += 1
+                retry_after = _parse_retry_after(headers.get("Retry-After"), now)
+                if retry_after is None:
+                    retry_after = max((self.reset_at or now) - now, 1.0)
+                # Reducir la tasa solo una vez por episodio de throttling
+                if now >= self.blocked_until:
+                    self.interval = min(max(self.interval * 2, 0.5), self.max_interval)
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                return retry_after
+            
+            # Recuperación multiplicativa de la tasa; los hilos en espera recalculan su turno
+            if self.interval:
+                self.interval *= self.recovery_factor
+                if self.interval < self.min_interval:
+                    self.interval = 0.0
+                self.condition.notify_all()
+            return 0.0
+
+# Leer una cabecera numérica entera
+def _parse_int_header(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+# Leer X-RateLimit-Reset (Dynatrace lo envía en microsegundos desde epoch)
+def _parse_reset_header(value):
+    reset = _parse_int_header(value)
+    if reset is None:
+        return None
+    if reset > 10**14:
+        return reset / 1_000_000
+    if reset > 10**11:
+        return reset / 1000
+    return float(reset)
+
+# Leer Retry-After, que puede venir en segundos o como fecha HTTP
+def _parse_retry_after(value, now):
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - now, 0.0)
+    except (TypeError, ValueError):
+        return None
+
+# Limitadores por host
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# Obtener (o crear) el limitador de tasa para el host de una URL
+def get_rate_limiter(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with rate_limiters_lock:
+        if host not in rate_limiters:
+            rate_limiters[host] = RateLimiter()
+        return rate_limiters[host]
+
+# Sesiones HTTP por host
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+# Obtener (o crear) la sesión HTTP con pool de conexiones para el host de una URL
+def get_session(url):
+    """
+    Devuelve una requests.Session reutilizable para el host de la URL, de modo que
+    las páginas sucesivas reutilizan la conexión TCP+TLS (keep-alive) en lugar de
+    abrir una nueva en cada consulta.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    host = urllib.parse.urlsplit(url).netloc
+    with http_sessions_lock:
+        session = http_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=http_pool_connections,
+                pool_maxsize=max(http_pool_maxsize, entity_type_workers + shard_workers,
+                                 async_max_concurrency + shard_workers + auditlog_workers if async_engine else 0,
+                                 auditlog_workers)
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive"
+            })
+            http_sessions[host] = session
+        return session
+
+# Cerrar todas las sesiones HTTP abiertas
+def close_sessions():
+    with http_sessions_lock:
+        for session in http_sessions.values():
+            session.close()
+        http_sessions.clear()
+
+# Excepciones de red que se consideran transitorias
+def retryable_exceptions():
+    import requests
+    return (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError
+    )
+
+# Error lanzado cuando el circuito de un host está abierto
+class CircuitOpenError(Exception):
+    pass
+
+# Circuito por host para dejar de consultar un host que falla repetidamente
+class CircuitBreaker:
+    """
+    Cuenta los fallos consecutivos de un host. Al alcanzar circuit_failure_threshold
+    el circuito se abre y las peticiones fallan de inmediato; pasado
+    circuit_reset_timeout se deja pasar una única petición de prueba, que cierra el
+    circuito si tiene éxito o lo vuelve a abrir si termina de cualquier otra forma
+    (error, HTTP 429 tras agotar los reintentos o excepción).
+    """
+    
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.retries = 0
+        self.opened_at = None
+        self.probing = False
+        self.probe_thread = None
+    
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.time() - self.opened_at >= circuit_reset_timeout:
+                self.probing = True
+                self.probe_thread = threading.get_ident()
+                return True
+            return False
+    
+    def release_probe(self):
+        """
+        Vuelve a abrir el circuito si la petición de prueba de este hilo terminó
+        sin registrar un éxito ni un fallo
+        """
+        with self.lock:
+            pending = self.probing and self.probe_thread == threading.get_ident()
+        if pending:
+            self.record_failure()
+    
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+    
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                print(f"  - Circuito de {self.host} cerrado de nuevo")
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probing = False
+    
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            if self.probing or (self.opened_at is None and self.consecutive_failures >= circuit_failure_threshold):
+                print(f"  - Circuito de {self.host} abierto tras {self.consecutive_failures} fallos consecutivos")
+                self.opened_at = time.time()
+                self.probing = False
+
+# Circuitos por host
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+# Obtener (o crear) el circuito para el host de una URL
+def get_circuit_breaker(url):
+    host = urllib.parse.urlsplit(url).netloc
+    with circuit_breakers_lock:
+        if host not in circuit_breakers:
+            circuit_breakers[host] = CircuitBreaker(host)
+        return circuit_breakers[host]
+
+# Espera exponencial con jitter completo para el reintento número `retry`
+def retry_backoff(retry):
+    return random.uniform(0, min(retry_backoff_max, retry_backoff_base * (2 ** retry)))
+
+# Métricas de las peticiones HTTP de una ejecución
+class RequestMetrics:
+    """
+    Acumula, por endpoint y tipo de entidad, cada intento de petición HTTP: estado,
+    tiempo hasta recibir las cabeceras (incluye DNS, conexión y TLS, que requests
+    no expone por separado), tiempo de descarga del cuerpo, bytes, reintentos y
+    tiempo en pausa por el limitador de tasa o las esperas entre reintentos.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        self.phases = {}
+        self.started = time.time()
+
+    def record(self, endpoint, entity_type, status, ttfb, download, size, sleep, retry):
+        duration = ttfb + download
+        with self.lock:
+            stats = self.series.get((endpoint, entity_type))
+            if stats is None:
+                stats = self.series[(endpoint, entity_type)] = {
+                    "requests": 0, "attempts": 0, "retries": 0, "status": {},
+                    "ttfb_seconds": 0.0, "download_seconds": 0.0, "sleep_seconds": 0.0,
+                    "bytes": 0, "max_seconds": 0.0, "buckets": [0] * len(metrics_duration_buckets)
+                }
+            stats["attempts"] += 1
+            if retry:
+                stats["retries"] += 1
+            else:
+                stats["requests"] += 1
+            stats["status"][str(status)] = stats["status"].get(str(status), 0) + 1
+            stats["ttfb_seconds"] += ttfb
+            stats["download_seconds"] += download
+            stats["sleep_seconds"] += sleep
+            stats["bytes"] += size
+            stats["max_seconds"] = max(stats["max_seconds"], duration)
+            for i, bound in enumerate(metrics_duration_buckets):
+                if duration <= bound:
+                    stats["buckets"][i] += 1
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = round(self.phases.get(name, 0.0) + seconds, 3)
+
+    def aggregate(self, key_index):
+        """
+        Agrupa las series por endpoint (key_index=0) o por tipo de entidad (key_index=1)
+
+        Returns:
+            list: Grupos ordenados por tiempo total descendente
+        """
+        groups = {}
+        with self.lock:
+            for key, stats in self.series.items():
+                name = key[key_index]
+                if name is None:
+                    continue
+                group = groups.setdefault(name, {"name": name, "requests": 0, "retries": 0, "errors": 0,
+                                                 "ttfb_seconds": 0.0, "download_seconds": 0.0,
+                                                 "sleep_seconds": 0.0, "bytes": 0, "max_seconds": 0.0})
+                group["requests"] += stats["requests"]
+                group["retries"] += stats["retries"]
+                group["errors"] += sum(n for s, n in stats["status"].items() if not s.startswith(("2", "304")))
+                for field in ("ttfb_seconds", "download_seconds", "sleep_seconds", "bytes"):
+                    group[field] += stats[field]
+                group["max_seconds"] = max(group["max_seconds"], stats["max_seconds"])
+        for group in groups.values():
+            group["total_seconds"] = group["ttfb_seconds"] + group["download_seconds"] + group["sleep_seconds"]
+            for field in ("ttfb_seconds", "download_seconds", "sleep_seconds", "max_seconds", "total_seconds"):
+                group[field] = round(group[field], 3)
+        return sorted(groups.values(), key=lambda g: g["total_seconds"], reverse=True)
+
+    def write_prometheus(self, path, environment):
+        """
+        Escribe las métricas en formato de exposición de Prometheus para el textfile
+        collector de node_exporter (se sustituye el archivo de forma atómica)
+        """
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        def labels(endpoint, entity_type, **extra):
+            pairs = {"environment": environment, "endpoint": endpoint, "entity_type": entity_type or "", **extra}
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs.items()) + "}"
+
+        metrics = [
+            ("dynatrace_audit_http_requests_total", "counter", "Intentos de petición HTTP por código de estado"),
+            ("dynatrace_audit_http_retries_total", "counter", "Reintentos por errores transitorios, HTTP 429 o HTTP 401"),
+            ("dynatrace_audit_http_response_bytes_total", "counter", "Bytes recibidos en el cuerpo de las respuestas"),
+            ("dynatrace_audit_http_ttfb_seconds_total", "counter", "Tiempo hasta recibir las cabeceras de la respuesta"),
+            ("dynatrace_audit_http_download_seconds_total", "counter", "Tiempo de descarga del cuerpo de la respuesta"),
+            ("dynatrace_audit_http_sleep_seconds_total", "counter", "Tiempo en pausa por el limitador de tasa y los reintentos"),
+            ("dynatrace_audit_http_request_duration_seconds", "histogram", "Duración de cada intento de petición HTTP")
+        ]
+        with self.lock:
+            series = sorted(self.series.items(), key=lambda item: (item[0][0], item[0][1] or ""))
+            lines = []
+            for name, kind, help_text in metrics:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (endpoint, entity_type), stats in series:
+                    if name == "dynatrace_audit_http_requests_total":
+                        for status, count in sorted(stats["status"].items()):
+                            lines.append(f"{name}{labels(endpoint, entity_type, status=status)} {count}")
+                    elif kind == "histogram":
+                        for bound, count in zip(metrics_duration_buckets, stats["buckets"]):
+                            lines.append(f"{name}_bucket{labels(endpoint, entity_type, le=bound)} {count}")
+                        lines.append(f"{name}_bucket{labels(endpoint, entity_type, le='+Inf')} {stats['attempts']}")
+                        lines.append(f"{name}_sum{labels(endpoint, entity_type)} {stats['ttfb_seconds'] + stats['download_seconds']:.6f}")
+                        lines.append(f"{name}_count{labels(endpoint, entity_type)} {stats['attempts']}")
+                    else:
+                        field = name[len("dynatrace_audit_http_"):-len("_total")]
+                        value = stats["bytes"] if field == "response_bytes" else stats[field]
+                        lines.append(f"{name}{labels(endpoint, entity_type)} {value if isinstance(value, int) else f'{value:.6f}'}")
+
+        lines.append("# HELP dynatrace_audit_run_duration_seconds Duración total de la ejecución")
+        lines.append("# TYPE dynatrace_audit_run_duration_seconds gauge")
+        lines.append(f'dynatrace_audit_run_duration_seconds{{environment="{escape(environment)}"}} {time.time() - self.started:.3f}')
+        lines.append("# HELP dynatrace_audit_run_timestamp_seconds Fin de la ejecución (epoch)")
+        lines.append("# TYPE dynatrace_audit_run_timestamp_seconds gauge")
+        lines.append(f'dynatrace_audit_run_timestamp_seconds{{environment="{escape(environment)}"}} {time.time():.0f}')
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def write_profile(self, path, run_info):
+        """
+        Escribe el perfil JSON de la ejecución: fases, totales y desglose por endpoint
+        y por tipo de entidad ordenados por tiempo total
+        """
+        by_endpoint = self.aggregate(0)
+        profile = {
+            **run_info,
+            "duration_seconds": round(time.time() - self.started, 3),
+            "phases": dict(self.phases),
+            "totals": {
+                field: round(sum(g[field] for g in by_endpoint), 3)
+                for field in ("requests", "retries", "errors", "bytes", "ttfb_seconds", "download_seconds", "sleep_seconds")
+            },
+            "by_endpoint": by_endpoint,
+            "by_entity_type": self.aggregate(1)
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(profile, f, indent=2, ensure_ascii=False)
+        return profile
+
+# Métricas de la ejecución en curso
+request_metrics = RequestMetrics()
+
+# Registrar un intento de petición en las métricas de la ejecución
+def record_request_metrics(labels, url, status, ttfb=0.0, download=0.0, size=0, sleep=0.0, retry=False):
+    if not metrics_enabled:
+        return
+    endpoint, entity_type = labels if labels else (urllib.parse.urlsplit(url).path, None)
+    request_metrics.record(endpoint, entity_type, status, ttfb, download, size, sleep, retry)
+
+# Exportar las métricas y el perfil de la ejecución
+def export_run_metrics():
+    if not metrics_enabled:
+        return
+    textfile_path = metrics_textfile_path or os.path.join(output_dir, "dynatrace_audit.prom")
+    profile_path = run_profile_path or os.path.join(output_dir, "dynatrace_run_profile.json")
+    try:
+        request_metrics.write_prometheus(textfile_path, environment_id)
+        profile = request_metrics.write_profile(profile_path, {"environment_id": environment_id})
+    except OSError as e:
+        print(f"ERROR al exportar las métricas: {str(e)}")
+        return
+
+    print(f"Métricas Prometheus guardadas en {textfile_path}")
+    print(f"Perfil de la ejecución guardado en {profile_path}")
+    for title, groups in (("endpoints", profile["by_endpoint"]), ("tipos de entidad", profile["by_entity_type"])):
+        if groups:
+            print(f"Top {title} por tiempo total:")
+            for group in groups[:5]:
+                print(f"  - {group['name']}: {group['total_seconds']:.2f}s ({group['requests']} peticiones, "
+                      f"{group['retries']} reintentos, {group['sleep_seconds']:.2f}s en pausa, {group['bytes'] / (1024 * 1024):.1f} MB)")
+    log_checkpoint(f"Métricas exportadas: {profile['totals']['requests']} peticiones en {profile['duration_seconds']:.2f} segundos")
+
+# Realizar una petición HTTP respetando el limitador de tasa del host
+def api_request(method, url, metrics_labels=None, **kwargs):
+    """
+    Ejecuta una petición a través del limitador de tasa del host. Ante un HTTP 429
+    espera lo indicado por Retry-After y reintenta hasta max_throttle_retries veces.
+    Las peticiones con Bearer Token usan el token vigente del token_manager y, ante
+    un HTTP 401, se reintentan una vez con un token renovado. Los errores 5xx y de
+    red se reintentan hasta max_request_retries veces con espera exponencial, y si
+    el circuito del host está abierto se lanza CircuitOpenError sin consultar.
+    
+    Args:
+        method (str): Método HTTP ("GET" o "POST")
+        url (str): URL de la petición
+        metrics_labels (tuple, optional): (endpoint, tipo de entidad) con que se registran las
+            métricas; por defecto, la ruta de la URL
+        **kwargs: Argumentos adicionales para requests (headers, data, timeout...)
+    
+    Returns:
+        requests.Response: última respuesta recibida
+    """
+    limiter = get_rate_limiter(url)
+    breaker = get_circuit_breaker(url)
+    session = get_session(url)
+    kwargs.setdefault("timeout", http_timeout)
+    uses_bearer = _uses_bearer_token(kwargs)
+    if uses_bearer:
+        # Usar siempre el token vigente aunque los headers se crearan con uno anterior
+        kwargs["headers"] = {**kwargs["headers"], "Authorization": f"Bearer {token_manager.get_token()}"}
+    try:
+        return _api_request_attempts(method, url, metrics_labels, limiter, breaker, session, uses_bearer, kwargs)
+    finally:
+        # La petición de prueba de un circuito medio abierto siempre se resuelve
+        breaker.release_probe()
+
+# Bucle de intentos de api_request
+def _api_request_attempts(method, url, metrics_labels, limiter, breaker, session, uses_bearer, kwargs):
+    attempt = 0
+    retries = 0
+    auth_retried = False
+    backoff_sleep = 0.0
+    is_retry = False
+    while True:
+        if not breaker.allow_request():
+            raise CircuitOpenError(f"Circuito abierto para {breaker.host}: demasiados fallos consecutivos")
+        
+        sleep = limiter.acquire() + backoff_sleep
+        backoff_sleep = 0.0
+        request_start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except retryable_exceptions() as e:
+            record_request_metrics(metrics_labels, url, "error", ttfb=time.perf_counter() - request_start,
+                                   sleep=sleep, retry=is_retry)
+            is_retry = True
+            # Error de red transitorio: reintentar la misma URL (mismo nextPageKey)
+            breaker.record_failure()
+            if retries >= max_request_retries:
+                raise
+            retries += 1
+            breaker.record_retry()
+            wait = retry_backoff(retries)
+            print(f"  - {type(e).__name__} en {url.split('?')[0]}, reintentando en {wait:.1f}s (reintento {retries}/{max_request_retries})")
+            time.sleep(wait)
+            backoff_sleep = wait
+            continue
+        # Sin stream=True el cuerpo ya está descargado: lo que excede a elapsed es la descarga
+        total = time.perf_counter() - request_start
+        ttfb = min(response.elapsed.total_seconds(), total)
+        record_request_metrics(metrics_labels, url, response.status_code, ttfb=ttfb, download=total - ttfb,
+                               size=len(response.content or b""), sleep=sleep, retry=is_retry)
+        is_retry = True
+        retry_after = limiter.update(response)
+        
+        # Ante un 401 con Bearer Token, renovar el token y reintentar una sola vez
+        if response.status_code == 401 and uses_bearer and not auth_retried:
+            auth_retried = True
+            print(f"  - HTTP 401 en {url.split('?')[0]}, renovando Bearer Token y reintentando")
+            kwargs["headers"] = {**kwargs["headers"], "Authorization": f"Bearer {token_manager.refresh(force=True)}"}
+            continue
+        
+        # Errores 5xx transitorios: reintentar con espera exponencial
+        if response.status_code in retryable_status_codes:
+            breaker.record_failure()
+            if retries < max_request_retries:
+                retries += 1
+                breaker.record_retry()
+                wait = retry_backoff(retries)
+                print(f"  - HTTP {response.status_code} en {url.split('?')[0]}, reintentando en {wait:.1f}s (reintento {retries}/{max_request_retries})")
+                time.sleep(wait)
+                backoff_sleep = wait
+                continue
+            return response
+        
+        if response.status_code != 429:
+            breaker.record_success()
+            return response
+        if attempt >= max_throttle_retries:
+            return response
+        attempt += 1
+        print(f"  - HTTP 429 en {url.split('?')[0]}, reintentando en {retry_after:.1f}s (intento {attempt}/{max_throttle_retries})")
+
+# Indica si la petición se autentica con el Bearer Token gestionado por token_manager
+def _uses_bearer_token(kwargs):
+    headers = kwargs.get("headers") or {}
+    return token_manager is not None and str(headers.get("Authorization", "")).startswith("Bearer ")
+
+# Petición GET a la API
+def api_get(url, headers=None, **kwargs):
+    return api_request("GET", url, headers=headers, **kwargs)
+
+# Solicitar un token nuevo a Dynatrace SSO
+def request_sso_token():
+    """
+    Realiza la petición client_credentials a Dynatrace SSO
     
+    Returns:
+        tuple: (access_token, segundos de validez)
+    """
     # Define scopes, organized by category (reduced for testing)
     scopes_array = [
         # Account-related scopes
@@ -88,7 +1054,7 @@ def get_bearer_token():
     scopes = " ".join(scopes_array)
 
     # API endpoint for token request
-    token_url = "https://sso.dynatrace.com/sso/oauth2/token"
+    token_url = sso_token_url
 
     # Prepare the request body with URL-encoded parameters
     body = {
@@ -101,19 +1067,148 @@ def get_bearer_token():
 
     # Convert body to URL-encoded string
     request_body = "&".join(f"{key}={value}" for key, value in body.items())
-    print(f"Request Body: {request_body}")  # Debugging
+    # Log the request without its body: it contains the client secret
+    print(f"Solicitando Bearer Token a {token_url} para el cliente {client_id}")
 
     # Make the POST request to get the token
+    response = api_request(
+        "POST",
+        token_url,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+        data=request_body
+    )
+    response.raise_for_status()  # Raise exception for bad status codes
+    token_data = response.json()
+    return token_data.get("access_token"), int(token_data.get("expires_in", 300))
+
+# Gestor del Bearer Token con caché y renovación anticipada
+class TokenManager:
+    """
+    Mantiene el Bearer Token de Dynatrace SSO en memoria y, opcionalmente, en un
+    archivo de caché junto con su caducidad y su duración. Un temporizador en
+    segundo plano renueva el token antes de que caduque, de modo que los recorridos
+    largos no fallan a mitad de ejecución. El margen de renovación se calcula sobre
+    la duración con que se emitió el token, no sobre el tiempo que le queda.
+    """
+    
+    def __init__(self, fetch_token, cache_path=None, cache_key=""):
+        self.fetch_token = fetch_token
+        self.cache_path = cache_path
+        self.cache_key = hashlib.sha256(cache_key.encode("utf-8")).hexdigest()
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+        self.expires_in = None
+        self.issued_at = None
+        self.source = None
+        self.timer = None
+        self._load_cache()
+    
+    def _refresh_margin(self):
+        # Sin la duración de emisión (caché antigua) se usa el margen completo
+        if not self.expires_in:
+            return token_refresh_margin
+        return min(token_refresh_margin, self.expires_in * 0.2)
+    
+    def _is_valid(self):
+        return self.token is not None and self.expires_at - time.time() > self._refresh_margin()
+    
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get("key") == self.cache_key:
+                self.token = cached.get("access_token")
+                self.expires_at = float(cached.get("expires_at", 0))
+                self.expires_in = cached.get("expires_in")
+                self.issued_at = cached.get("issued_at")
+                self.source = "caché"
+        except (OSError, ValueError):
+            pass
+    
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            # El archivo contiene un secreto: crearlo solo con permisos para el usuario
+            fd = os.open(self.cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"key": self.cache_key, "access_token": self.token, "expires_at": self.expires_at,
+                           "expires_in": self.expires_in, "issued_at": self.issued_at}, f)
+        except OSError as e:
+            print(f"No se pudo guardar la caché del token: {str(e)}")
+    
+    def _schedule_refresh(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = max(self.expires_at - time.time() - self._refresh_margin(), 1.0)
+        self.timer = threading.Timer(delay, self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+    
+    def _background_refresh(self):
+        try:
+            self.refresh(force=True)
+            print("Bearer Token renovado en segundo plano")
+        except Exception as e:
+            # Si falla, se volverá a intentar bajo demanda en la siguiente petición
+            print(f"Error al renovar el Bearer Token en segundo plano: {str(e)}")
+    
+    def refresh(self, force=False):
+        """
+        Obtiene un token nuevo de SSO (o reutiliza el vigente si force es False)
+        """
+        with self.lock:
+            if not force and self._is_valid():
+                return self.token
+            token, expires_in = self.fetch_token()
+            self.token = token
+            self.issued_at = time.time()
+            self.expires_in = expires_in
+            self.expires_at = self.issued_at + expires_in
+            self.source = "SSO"
+            self._save_cache()
+            self._schedule_refresh()
+            return self.token
+    
+    def get_token(self):
+        """
+        Devuelve un token vigente, usando la caché si todavía es válido
+        """
+        with self.lock:
+            if self._is_valid():
+                if self.timer is None:
+                    self._schedule_refresh()
+                return self.token
+        return self.refresh()
+    
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+# Gestor del Bearer Token de la ejecución (None hasta la primera solicitud)
+token_manager = None
+
+# Obtener token de Dynatrace SSO
+def get_bearer_token():
+    import requests
+    global token_manager
+    log_checkpoint("Solicitando Bearer Token desde Dynatrace SSO")
+    
+    if token_manager is None:
+        cache_path = None
+        if token_cache_enabled:
+            cache_path = token_cache_path or os.path.join(output_dir, ".dynatrace_token_cache.json")
+        token_manager = TokenManager(request_sso_token, cache_path=cache_path,
+                                     cache_key=f"{client_id}|{account_id}")
+    
     try:
-        response = requests.post(
-            token_url,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            data=request_body
-        )
-        response.raise_for_status()  # Raise exception for bad status codes
-        bearer_token = response.json().get("access_token")
+        bearer_token = token_manager.get_token()
         append_to_file("Bearer Token obtenido", f"Token: {bearer_token[:30]}...truncado")
-        log_checkpoint("Bearer Token obtenido correctamente")
+        log_checkpoint(f"Bearer Token obtenido correctamente (origen: {token_manager.source})")
         return bearer_token
     except requests.exceptions.RequestException as e:
         error_details = str(e)
@@ -127,248 +1222,1776 @@ def get_bearer_token():
         log_checkpoint(f"Error al obtener Bearer Token: {error_details}")
         return None
 
-# Función mejorada para manejar consultas paginadas
-def paginated_api_request(url, headers, endpoint_name, base_url=None, params=None):
+# Destino genérico para las páginas de una consulta paginada
+class PageSink:
+    """
+    Recibe las páginas de una consulta paginada a medida que llegan. Las
+    subclases deciden qué hacer con cada página (combinarla en memoria,
+    escribirla en disco, etc.).
     """
-    Realiza consultas paginadas a la API de Dynatrace, procesando automáticamente el nextPageKey
     
-    Args:
-        url (str): URL inicial para la consulta
-        headers (dict): Headers para la consulta
-        endpoint_name (str): Nombre del endpoint para el registro
-        base_url (str, optional): URL base para construir URLs con nextPageKey
-        params (dict, optional): Parámetros adicionales para la consulta inicial
+    def write_page(self, endpoint_name, page_number, data):
+        raise NotImplementedError
     
-    Returns:
-        tuple: (éxito, fallo, datos combinados)
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Destino que combina todas las páginas en un único objeto en memoria
+class CombinedDataSink(PageSink):
+    def __init__(self):
+        self.data = None
+    
+    def write_page(self, endpoint_name, page_number, data):
+        # Inicializar datos combinados con la primera página
+        if self.data is None:
+            self.data = data.copy() if isinstance(data, dict) else data
+            return
+        
+        # Combinar datos si es posible
+        if isinstance(self.data, dict) and isinstance(data, dict):
+            for key, value in data.items():
+                if key in self.data and isinstance(value, list) and isinstance(self.data[key], list) and key not in ["links", "metadata"]:
+                    # Extender la lista con los nuevos elementos
+                    self.data[key].extend(value)
+                elif key != "nextPageKey":  # No copiar nextPageKey
+                    # Para otros tipos, simplemente actualizar
+                    self.data[key] = value
+
+# Destino que escribe cada elemento de cada página como una línea JSON (NDJSON)
+class NDJSONSink(PageSink):
+    def __init__(self, path, append=False):
+        self.path = path
+        self.mode = 'a' if append else 'w'
+        self.file = None
+        self.item_count = 0
+    
+    def write_page(self, endpoint_name, page_number, data):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.file = open(self.path, self.mode, encoding='utf-8', buffering=1024 * 1024)
+        
+        lists = list(page_item_lists(data))
+        if not lists and isinstance(data, dict):
+            # Respuesta sin listas de elementos: guardar el objeto completo
+            self.file.write(dumps_json(data) + "\n")
+            self.item_count += 1
+        for _, items in lists:
+            for item in items:
+                self.file.write(dumps_json(item) + "\n")
+            self.item_count += len(items)
+    
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+    
+    def size(self):
+        """
+        Returns:
+            int: Bytes del archivo ya volcados a disco
+        """
+        if self.file is not None:
+            return os.fstat(self.file.fileno()).st_size
+        return os.path.getsize(self.path) if self.mode == 'a' and os.path.exists(self.path) else 0
+    
+    def truncate(self, size):
+        """
+        Descarta lo escrito después de los primeros size bytes (páginas recibidas
+        después del último progreso guardado de una ejecución interrumpida)
+        """
+        if self.file is None and os.path.exists(self.path) and os.path.getsize(self.path) > size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(size)
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Obtener las listas de elementos de una página (ignorando links y metadata)
+def page_item_lists(data):
+    if isinstance(data, list):
+        yield None, data
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, list) and key not in ["links", "metadata"]:
+                yield key, value
+
+# Ruta del archivo NDJSON para un endpoint o conjunto de datos
+def ndjson_path_for(name):
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name.strip("/"))
+    return os.path.join(output_dir, "ndjson", f"{safe_name}.ndjson")
+
+# Crear un destino NDJSON si la salida en streaming está activada
+def open_ndjson_sink(name, append=False):
+    return NDJSONSink(ndjson_path_for(name), append=append) if ndjson_output else None
+
+# Destino que calcula un hash del contenido de las páginas (sin nextPageKey)
+class HashSink(PageSink):
+    def __init__(self):
+        self.digest = hashlib.sha256()
+        self.item_count = 0
+    
+    def write_page(self, endpoint_name, page_number, data):
+        for _, items in page_item_lists(data):
+            self.item_count += len(items)
+            for item in items:
+                self.digest.update(dumps_json(item).encode("utf-8"))
+    
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+# Destino que recoge los entityId de las páginas de /api/v2/entities
+class EntityIdSink(PageSink):
+    def __init__(self):
+        self.ids = set()
+    
+    def write_page(self, endpoint_name, page_number, data):
+        if isinstance(data, dict):
+            for entity in data.get("entities", []):
+                if "entityId" in entity:
+                    self.ids.add(entity["entityId"])
+
+# Destino que añade las entidades de cada página al inventario en memoria
+class EntityStoreSink(PageSink):
+    def __init__(self, store):
+        self.store = store
+    
+    def write_page(self, endpoint_name, page_number, data):
+        self.store.add_page(data)
+
+# Inventario de entidades de la ejecución en curso (con entity_store_enabled)
+entity_store = None
+
+# Almacén de estado local para las auditorías incrementales
+class AuditState:
+    """
+    Base de datos SQLite con el estado de la última ejecución de cada flujo
+    (endpoint o tipo de entidad): ETag, Last-Modified, hash del contenido,
+    número de elementos y fecha de la consulta, junto con los entityId conocidos
+    de cada tipo para calcular las altas y bajas entre ejecuciones.
     """
-    successful_requests = 0
-    failed_requests = 0
-    combined_data = None
-    page_count = 1
-    total_items = 0
     
-    # Si hay parámetros, agregarlos a la URL inicial
-    if params:
-        param_str = "&".join([f"{k}={urllib.parse.quote(str(v))}" for k, v in params.items()])
-        if "?" in url:
-            url = f"{url}&{param_str}"
-        else:
-            url = f"{url}?{param_str}"
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.run_started_ms = int(time.time() * 1000)
+        self.changes = {"endpoints": {}, "entities": {}}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS stream_state (
+                    stream TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    item_count INTEGER,
+                    last_run_ms INTEGER
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS entity_ids (
+                    entity_type TEXT,
+                    entity_id TEXT,
+                    PRIMARY KEY (entity_type, entity_id)
+                )
+            """)
     
-    # Consulta inicial
-    print(f"Consultando {endpoint_name} (página {page_count})...")
-    try:
-        response = requests.get(url, headers=headers)
+    def get_stream(self, stream):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_hash, item_count, last_run_ms FROM stream_state WHERE stream = ?",
+                (stream,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(["etag", "last_modified", "content_hash", "item_count", "last_run_ms"], row))
+    
+    def save_stream(self, stream, etag=None, last_modified=None, content_hash=None, item_count=None):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stream_state VALUES (?, ?, ?, ?, ?, ?)",
+                (stream, etag, last_modified, content_hash, item_count, self.run_started_ms)
+            )
+    
+    def diff_entities(self, entity_type, seen_ids, full=True):
+        """
+        Compara los entityId vistos en esta ejecución con los conocidos y guarda
+        los nuevos como conocidos. Una consulta filtrada con "from" solo devuelve
+        las entidades con actividad reciente, así que en ese caso los ids vistos se
+        añaden a los conocidos y no se calculan las bajas.
         
-        if response.status_code == 200:
-            data = response.json()
-            append_to_file(f"Resultado de {endpoint_name} (página {page_count})", data)
-            successful_requests += 1
-            
-            # Inicializar datos combinados
-            combined_data = data.copy() if isinstance(data, dict) else data
-            
-            # Contar elementos si existe una lista de resultados
-            if isinstance(data, dict):
-                for key, value in data.items():
-                    if isinstance(value, list) and key not in ["links", "metadata"]:
-                        total_items += len(value)
-                        print(f"  - Encontrados {len(value)} elementos en la clave '{key}'")
-            
-            # Verificar si hay más páginas
-            next_page_key = data.get("nextPageKey")
+        Args:
+            entity_type (str): Tipo de entidad
+            seen_ids (set): entityId recibidos en esta ejecución
+            full (bool, optional): La consulta devolvió el inventario completo del tipo
+        
+        Returns:
+            tuple: (ids nuevos, ids sin actividad desde la última consulta completa)
+        """
+        with self.lock, self.conn:
+            known_ids = {
+                row[0] for row in self.conn.execute(
+                    "SELECT entity_id FROM entity_ids WHERE entity_type = ?", (entity_type,)
+                )
+            }
+            added = sorted(seen_ids - known_ids)
+            removed = []
+            if full:
+                removed = sorted(known_ids - seen_ids)
+                self.conn.execute("DELETE FROM entity_ids WHERE entity_type = ?", (entity_type,))
+                new_ids = seen_ids
+            else:
+                new_ids = added
+            self.conn.executemany(
+                "INSERT INTO entity_ids VALUES (?, ?)",
+                ((entity_type, entity_id) for entity_id in new_ids)
+            )
+        return added, removed
+    
+    def record_endpoint_change(self, stream, status, item_count):
+        with self.lock:
+            self.changes["endpoints"][stream] = {"estado": status, "elementos": item_count}
+    
+    def record_entity_change(self, entity_type, added, removed):
+        with self.lock:
+            self.changes["entities"][entity_type] = {"nuevas": added, "sin_actividad": removed}
+    
+    def write_delta_report(self, path):
+        """
+        Escribe el informe de cambios en JSON y devuelve un resumen con los totales
+        """
+        with self.lock:
+            report = {
+                "generado": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "endpoints": self.changes["endpoints"],
+                "entidades": self.changes["entities"]
+            }
+            summary = {
+                "endpoints_modificados": sorted(
+                    stream for stream, change in self.changes["endpoints"].items()
+                    if change["estado"] not in ("sin cambios", "sin cambios (304)")
+                ),
+                "entidades_nuevas": sum(len(c["nuevas"]) for c in self.changes["entities"].values()),
+                "entidades_sin_actividad": sum(len(c["sin_actividad"]) for c in self.changes["entities"].values())
+            }
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(dumps_json(report, pretty=True))
+        return summary
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Estado de la auditoría incremental (None si el modo incremental está desactivado)
+audit_state = None
+
+# Abrir el almacén de estado para el modo incremental
+def open_audit_state():
+    global audit_state
+    path = state_db_path or os.path.join(output_dir, "dynatrace_audit_state.sqlite")
+    audit_state = AuditState(path)
+    log_checkpoint(f"Modo incremental activado (estado en {path})")
+    return audit_state
+
+# Escribir el informe de cambios y cerrar el almacén de estado
+def close_audit_state():
+    global audit_state
+    if audit_state is None:
+        return
+    report_path = os.path.join(output_dir, "dynatrace_delta_report.json")
+    summary = audit_state.write_delta_report(report_path)
+    append_to_file("Resumen de cambios (modo incremental)", summary)
+    log_checkpoint(f"Informe de cambios guardado en {report_path}")
+    audit_state.close()
+    audit_state = None
+
+# Progreso del recorrido para poder reanudarlo tras una interrupción
+class CrawlCheckpoint:
+    """
+    Guarda en un archivo JSON los flujos (endpoints y tipos de entidad) ya
+    completados, con sus contadores, y el nextPageKey pendiente de los flujos en
+    curso junto con el tamaño de sus NDJSON en ese punto. El archivo se reescribe
+    de forma atómica como mucho cada checkpoint_save_interval segundos por flujo
+    y siempre al completar un flujo.
+    """
+    
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.last_saved = {}
+        self.state = {"completed": {}, "in_flight": {}}
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+        self._save()
+    
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(dumps_json(self.state))
+        os.replace(tmp_path, self.path)
+    
+    def completed_result(self, stream):
+        """
+        Returns:
+            tuple: (éxito, fallo) del flujo si ya estaba completado, o None
+        """
+        with self.lock:
+            result = self.state["completed"].get(stream)
+        return tuple(result) if result else None
+    
+    def in_flight(self, stream):
+        with self.lock:
+            return self.state["in_flight"].get(stream)
+    
+    def save_due(self, stream):
+        with self.lock:
+            return time.time() - self.last_saved.get(stream, 0) >= checkpoint_save_interval
+    
+    def page_done(self, stream, page_number, next_page_key, successful, files=None):
+        """
+        Args:
+            files (dict, optional): Tamaño en bytes de cada NDJSON del flujo tras esta página
+        """
+        with self.lock:
+            self.last_saved[stream] = time.time()
+            if next_page_key:
+                self.state["in_flight"][stream] = {
+                    "next_page_key": next_page_key,
+                    "page": page_number + 1,
+                    "successful": successful,
+                    "files": files or {}
+                }
+            self._save()
+    
+    def discard_in_flight(self, stream):
+        """
+        Olvida el nextPageKey guardado de un flujo para que se recorra de nuevo
+        desde la primera página
+        """
+        with self.lock:
+            self.state["in_flight"].pop(stream, None)
+            self.last_saved.pop(stream, None)
+            self._save()
+    
+    def mark_completed(self, stream, successful, failed):
+        with self.lock:
+            self.state["in_flight"].pop(stream, None)
+            self.state["completed"][stream] = [successful, failed]
+            self._save()
+    
+    def finish(self):
+        """
+        Elimina el archivo de progreso cuando el recorrido termina sin errores
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+# Progreso del recorrido en curso
+crawl_checkpoint = None
+
+# Abrir el archivo de progreso del recorrido
+def open_crawl_checkpoint(resume=False):
+    global crawl_checkpoint
+    path = crawl_checkpoint_path or os.path.join(output_dir, "dynatrace_crawl_checkpoint.json")
+    crawl_checkpoint = CrawlCheckpoint(path, resume=resume)
+    if resume:
+        completed = len(crawl_checkpoint.state["completed"])
+        in_flight = len(crawl_checkpoint.state["in_flight"])
+        log_checkpoint(f"Reanudando recorrido: {completed} flujos completados, {in_flight} en curso")
+    return crawl_checkpoint
+
+# Devolver el resultado guardado si un flujo ya se completó en la ejecución interrumpida
+def skip_completed_stream(stream):
+    if crawl_checkpoint is None:
+        return None
+    result = crawl_checkpoint.completed_result(stream)
+    if result is not None:
+        print(f"{stream} ya completado en la ejecución anterior, se omite")
+    return result
+
+# Caché de respuestas en disco direccionada por contenido
+class ResponseCache:
+    """
+    Índice SQLite de las páginas guardadas (URL completa, hash del cuerpo,
+    cabeceras de validación, fecha de descarga y último acceso) y cuerpos en
+    archivos nombrados por su hash SHA-256, compartidos entre páginas idénticas.
+    Las páginas de un mismo flujo forman un grupo identificado por su primera
+    página, que se valida, renueva y expulsa como una unidad para no mezclar
+    nextPageKey de descargas distintas. Un grupo solo se reutiliza cuando está
+    completo, es decir, cuando se guardó hasta su última página.
+    """
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.blob_dir = os.path.join(path, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+        self.conn = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    root TEXT,
+                    url TEXT,
+                    blob TEXT,
+                    size INTEGER,
+                    headers TEXT,
+                    stored_at REAL,
+                    last_access REAL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS responses_root ON responses (root)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS complete_groups (root TEXT PRIMARY KEY)")
+    
+    @staticmethod
+    def key_for(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+    
+    def ttl_for(self, url):
+        """
+        Returns:
+            float: TTL en segundos del endpoint de la URL, o None si no se guarda en caché
+        """
+        path = urllib.parse.urlsplit(url).path
+        for pattern, ttl in response_cache_ttls.items():
+            if fnmatch.fnmatchcase(path, pattern):
+                return ttl
+        return None
+    
+    def _blob_path(self, blob):
+        return os.path.join(self.blob_dir, blob[:2], blob)
+    
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT blob, headers, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self._blob_path(row[0]), 'rb') as f:
+                body = f.read()
+        except OSError:
+            return None
+        return {"body": body, "headers": json.loads(row[1]), "stored_at": row[2]}
+    
+    def put(self, key, root, url, response):
+        body = response.content
+        blob = hashlib.sha256(body).hexdigest()
+        blob_path = self._blob_path(blob)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, blob_path)
+        headers = {name: response.headers[name] for name in ("ETag", "Last-Modified", "Content-Type") if name in response.headers}
+        now = time.time()
+        with self.lock, self.conn:
+            # Una primera página nueva sustituye a todas las páginas del flujo anterior
+            if key == root:
+                self.conn.execute("DELETE FROM responses WHERE root = ?", (root,))
+                self.conn.execute("DELETE FROM complete_groups WHERE root = ?", (root,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, root, url, blob, len(body), json.dumps(headers), now, now)
+            )
+    
+    def mark_complete(self, root):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO complete_groups VALUES (?)", (root,))
+    
+    def is_complete(self, root):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM complete_groups WHERE root = ?", (root,)).fetchone() is not None
+    
+    def drop(self, root):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE root = ?", (root,))
+            self.conn.execute("DELETE FROM complete_groups WHERE root = ?", (root,))
+    
+    def touch(self, root, revalidated=False):
+        now = time.time()
+        with self.lock, self.conn:
+            if revalidated:
+                self.conn.execute("UPDATE responses SET stored_at = ?, last_access = ? WHERE root = ?", (now, now, root))
+            else:
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE root = ?", (now, root))
+    
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+    
+    @staticmethod
+    def response_from(entry, url):
+        import requests
+        response = requests.Response()
+        response.status_code = 200
+        response._content = entry["body"]
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response.url = url
+        response.encoding = "utf-8"
+        return response
+    
+    def evict(self):
+        """
+        Expulsa los flujos usados hace más tiempo hasta que el tamaño de los cuerpos
+        guardados no supera max_bytes, y borra los cuerpos que ya no se usan
+        
+        Returns:
+            int: Número de flujos expulsados
+        """
+        evicted = 0
+        with self.lock, self.conn:
+            def total_size():
+                return self.conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM responses GROUP BY blob)"
+                ).fetchone()[0]
             
-            # Procesar páginas adicionales si existen
-            while next_page_key:
-                # Pausa para no sobrecargar la API
-                time.sleep(1)
-                
-                page_count += 1
-                print(f"Consultando {endpoint_name} (página {page_count})...")
-                
-                # Construir URL para la siguiente página
-                if "?" in url and not base_url:
-                    # Si la URL original ya tiene parámetros, usar esa como base
-                    base_endpoint = url.split("?")[0]
-                    next_url = f"{base_endpoint}?nextPageKey={urllib.parse.quote(next_page_key)}"
-                elif base_url:
-                    # Si se proporcionó un base_url específico, usarlo
-                    next_url = f"{base_url}?nextPageKey={urllib.parse.quote(next_page_key)}"
-                else:
-                    # Caso simple: agregar nextPageKey a la URL original
-                    next_url = f"{url}?nextPageKey={urllib.parse.quote(next_page_key)}"
-                
-                try:
-                    next_response = requests.get(next_url, headers=headers)
-                    
-                    if next_response.status_code == 200:
-                        next_data = next_response.json()
-                        append_to_file(f"Resultado de {endpoint_name} (página {page_count})", next_data)
-                        successful_requests += 1
-                        
-                        # Combinar datos si es posible
-                        if isinstance(combined_data, dict) and isinstance(next_data, dict):
-                            # Combinar listas de elementos
-                            for key, value in next_data.items():
-                                if key in combined_data and isinstance(value, list) and isinstance(combined_data[key], list) and key not in ["links", "metadata"]:
-                                    # Extender la lista con los nuevos elementos
-                                    combined_data[key].extend(value)
-                                    total_items += len(value)
-                                    print(f"  - Agregados {len(value)} elementos más en la clave '{key}' (total: {len(combined_data[key])})")
-                                elif key != "nextPageKey":  # No copiar nextPageKey
-                                    # Para otros tipos, simplemente actualizar
-                                    combined_data[key] = value
-                        
-                        # Actualizar la clave de siguiente página
-                        next_page_key = next_data.get("nextPageKey")
-                    else:
-                        error_msg = f"Código de estado: {next_response.status_code}, Mensaje: {next_response.text}"
-                        append_to_file(f"Error en {endpoint_name} (página {page_count})", error_msg)
-                        failed_requests += 1
+            if total_size() > self.max_bytes:
+                roots = self.conn.execute(
+                    "SELECT root FROM responses GROUP BY root ORDER BY MAX(last_access)"
+                ).fetchall()
+                for (root,) in roots:
+                    self.conn.execute("DELETE FROM responses WHERE root = ?", (root,))
+                    self.conn.execute("DELETE FROM complete_groups WHERE root = ?", (root,))
+                    evicted += 1
+                    if total_size() <= self.max_bytes:
                         break
-                except Exception as e:
-                    error_msg = f"Error en consulta de página {page_count}: {str(e)}"
-                    print(error_msg)
-                    append_to_file(f"Excepción en {endpoint_name} (página {page_count})", error_msg)
-                    failed_requests += 1
-                    break
+            referenced = {row[0] for row in self.conn.execute("SELECT DISTINCT blob FROM responses")}
+        
+        for folder, _, files in os.walk(self.blob_dir):
+            for name in files:
+                if name not in referenced:
+                    os.remove(os.path.join(folder, name))
+        return evicted
+    
+    def close(self):
+        evicted = self.evict()
+        with self.lock:
+            self.conn.close()
+        return evicted
+
+# Caché de respuestas de la ejecución en curso (None si está desactivada)
+response_cache = None
+
+# Abrir la caché de respuestas
+def open_response_cache():
+    global response_cache
+    path = response_cache_dir or os.path.join(output_dir, ".response_cache")
+    response_cache = ResponseCache(path, response_cache_max_bytes)
+    log_checkpoint(f"Caché de respuestas activada (en {path})")
+    return response_cache
+
+# Aplicar el límite de tamaño y cerrar la caché de respuestas
+def close_response_cache():
+    global response_cache
+    if response_cache is None:
+        return
+    cache, response_cache = response_cache, None
+    evicted = cache.close()
+    stats = cache.stats
+    log_checkpoint(f"Caché de respuestas: {stats['hits']} flujos servidos desde caché, {stats['revalidated']} revalidados (HTTP 304), "
+                   f"{stats['misses']} descargados, {evicted} expulsados por tamaño")
+
+# Obtener una página a través de la caché de respuestas
+def fetch_page_cached(page_url, headers, root_url, ttl, replaying, metrics_labels=None):
+    """
+    La primera página de un flujo se sirve desde la caché si no ha superado el TTL;
+    si lo ha superado se revalida con If-None-Match / If-Modified-Since. Cuando la
+    primera página procede de la caché, las siguientes se leen de la misma copia.
+    Los grupos incompletos (una descarga anterior se interrumpió) no se reutilizan:
+    el flujo se descarga de nuevo desde la primera página.
+    
+    Args:
+        page_url (str): URL de la página
+        headers (dict): Headers para la consulta
+        root_url (str): URL de la primera página del flujo
+        ttl (float): TTL del endpoint en segundos
+        replaying (bool): Si la primera página del flujo se sirvió desde la caché
+        metrics_labels (tuple, optional): Etiquetas de métricas de la petición
+    
+    Returns:
+        tuple: (respuesta, la página procede de la caché)
+    """
+    cache = response_cache
+    key = cache.key_for(page_url)
+    root = cache.key_for(root_url)
+    entry = cache.get(key)
+    
+    if page_url != root_url:
+        if replaying:
+            if entry is not None:
+                return cache.response_from(entry, page_url), True
+            # Nunca se consulta en directo con un nextPageKey de la copia guardada
+            cache.drop(root)
+            raise RuntimeError("página no encontrada en la caché de respuestas; el flujo se descargará completo en la próxima consulta")
+        response = api_get(page_url, headers=headers, metrics_labels=metrics_labels)
+        if response.status_code == 200:
+            cache.put(key, root, page_url, response)
+        return response, False
+    
+    if entry is not None and not cache.is_complete(root):
+        entry = None
+    if entry is not None and time.time() - entry["stored_at"] < ttl:
+        cache.touch(root)
+        cache.count("hits")
+        return cache.response_from(entry, page_url), True
+    
+    conditional = {}
+    if entry is not None:
+        if entry["headers"].get("ETag"):
+            conditional["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            conditional["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+    response = api_get(page_url, headers={**headers, **conditional}, metrics_labels=metrics_labels)
+    if conditional and response.status_code == 304:
+        cache.touch(root, revalidated=True)
+        cache.count("revalidated")
+        return cache.response_from(entry, page_url), True
+    
+    cache.count("misses")
+    if response.status_code == 200:
+        cache.put(key, root, page_url, response)
+    return response, False
+
+# Agregar parámetros a una URL
+def build_url_with_params(url, params=None):
+    if not params:
+        return url
+    param_str = "&".join([f"{k}={urllib.parse.quote(str(v))}" for k, v in params.items()])
+    if "?" in url:
+        return f"{url}&{param_str}"
+    return f"{url}?{param_str}"
+
+# Construir la URL de la siguiente página a partir del nextPageKey
+def build_next_page_url(url, base_url, next_page_key):
+    if "?" in url and not base_url:
+        # Si la URL original ya tiene parámetros, usar esa como base
+        base_endpoint = url.split("?")[0]
+        return f"{base_endpoint}?nextPageKey={urllib.parse.quote(next_page_key)}"
+    elif base_url:
+        # Si se proporcionó un base_url específico, usarlo
+        return f"{base_url}?nextPageKey={urllib.parse.quote(next_page_key)}"
+    else:
+        # Caso simple: agregar nextPageKey a la URL original
+        return f"{url}?nextPageKey={urllib.parse.quote(next_page_key)}"
+
+# Generador de páginas de una consulta paginada
+def iter_api_pages(url, headers, endpoint_name, base_url=None, params=None, stats=None, conditional_headers=None,
+                   start_page_key=None, start_page=1, entity_type=None):
+    """
+    Recorre las páginas de una consulta a la API de Dynatrace siguiendo el nextPageKey
+    y las produce de una en una, sin retener las anteriores en memoria. Los errores
+    se registran en el archivo de resultados y terminan la iteración.
+    
+    Args:
+        url (str): URL inicial para la consulta
+        headers (dict): Headers para la consulta
+        endpoint_name (str): Nombre del endpoint para el registro
+        base_url (str, optional): URL base para construir URLs con nextPageKey
+        params (dict, optional): Parámetros adicionales para la consulta inicial
+        stats (dict, optional): Diccionario donde se acumulan 'successful', 'failed' y 'pages'
+        conditional_headers (dict, optional): If-None-Match / If-Modified-Since para la primera página;
+            si el servidor responde 304 no se produce ninguna página y stats['not_modified'] es True
+        start_page_key (str, optional): nextPageKey desde el que continuar un recorrido interrumpido
+        start_page (int, optional): Número de la página correspondiente a start_page_key
+        entity_type (str, optional): Tipo de entidad consultado, para agrupar las métricas
+    
+    Yields:
+        tuple: (número de página, datos de la página)
+    """
+    stats = stats if stats is not None else {}
+    stats.setdefault("successful", 0)
+    stats.setdefault("failed", 0)
+    stats.setdefault("pages", 0)
+    
+    url = build_url_with_params(url, params)
+    page_url = url
+    page_count = 1
+    metrics_labels = (urllib.parse.urlsplit(url).path, entity_type)
+    
+    # Caché de respuestas: solo endpoints con TTL y recorridos completos no condicionales
+    cache_ttl = None
+    if response_cache is not None and not conditional_headers and not start_page_key:
+        cache_ttl = response_cache.ttl_for(url)
+    replaying = False
+    if start_page_key:
+        page_url = build_next_page_url(url, base_url, start_page_key)
+        page_count = start_page
+    
+    while page_url:
+        page_label = endpoint_name if page_count == 1 else f"{endpoint_name} (página {page_count})"
+        print(f"Consultando {endpoint_name} (página {page_count})...")
+        try:
+            request_headers = headers
+            if page_url == url and conditional_headers:
+                request_headers = {**headers, **conditional_headers}
+            if cache_ttl is not None:
+                response, replaying = fetch_page_cached(page_url, request_headers, url, cache_ttl, replaying,
+                                                        metrics_labels=metrics_labels)
+            else:
+                response = api_get(page_url, headers=request_headers, metrics_labels=metrics_labels)
+            if page_url == url and response.status_code == 304:
+                print(f"  - {endpoint_name} sin cambios desde la última ejecución (HTTP 304)")
+                stats["successful"] += 1
+                stats["not_modified"] = True
+                return
+            if response.status_code != 200:
+                error_msg = f"Código de estado: {response.status_code}, Mensaje: {response.text}"
+                append_to_file(f"Error en {page_label}", error_msg)
+                stats["failed"] += 1
+                stats["error_status"] = response.status_code
+                stats["error_page"] = page_count
+                return
+            data = response.json()
+        except Exception as e:
+            if page_count == 1:
+                error_msg = f"Error general en consulta: {str(e)}"
+            else:
+                error_msg = f"Error en consulta de página {page_count}: {str(e)}"
+            print(error_msg)
+            append_to_file(f"Excepción en {page_label}", error_msg)
+            stats["failed"] += 1
+            return
+        
+        stats["successful"] += 1
+        stats["pages"] = page_count
+        if page_count == 1:
+            stats["etag"] = response.headers.get("ETag")
+            stats["last_modified"] = response.headers.get("Last-Modified")
+        yield page_count, data
+        
+        # Verificar si hay más páginas
+        next_page_key = data.get("nextPageKey") if isinstance(data, dict) else None
+        if not next_page_key:
+            # El flujo descargado ya está guardado entero y se puede reutilizar
+            if cache_ttl is not None and not replaying:
+                response_cache.mark_complete(response_cache.key_for(url))
+            return
+        page_count += 1
+        page_url = build_next_page_url(url, base_url, next_page_key)
+
+# Función mejorada para manejar consultas paginadas
+def paginated_api_request(url, headers, endpoint_name, base_url=None, params=None, sink=None, collect=True,
+                          stats=None, conditional_headers=None, stream=None, entity_type=None):
+    """
+    Realiza consultas paginadas a la API de Dynatrace, procesando automáticamente el nextPageKey
+    
+    Args:
+        url (str): URL inicial para la consulta
+        headers (dict): Headers para la consulta
+        endpoint_name (str): Nombre del endpoint para el registro
+        base_url (str, optional): URL base para construir URLs con nextPageKey
+        params (dict, optional): Parámetros adicionales para la consulta inicial
+        sink (PageSink o list, optional): Destino(s) adicional(es) al que se envía cada página
+        collect (bool, optional): Si es False no se combinan las páginas en memoria
+        stats (dict, optional): Diccionario donde se devuelven las estadísticas de iter_api_pages
+        conditional_headers (dict, optional): Cabeceras condicionales para la primera página
+        stream (str, optional): Identificador del flujo para guardar el progreso y poder reanudarlo
+        entity_type (str, optional): Tipo de entidad consultado, para agrupar las métricas
+    
+    Returns:
+        tuple: (éxito, fallo, datos combinados o None si collect es False)
+    """
+    stats = stats if stats is not None else {}
+    combined = CombinedDataSink() if collect else None
+    extra_sinks = sink if isinstance(sink, (list, tuple)) else [sink]
+    sinks = [s for s in [combined, *extra_sinks] if s is not None]
+    key_totals = {}
+    total_items = 0
+    
+    # Continuar desde el nextPageKey guardado si el flujo quedó a medias
+    checkpoint = crawl_checkpoint if stream else None
+    resume_state = checkpoint.in_flight(stream) if checkpoint is not None else None
+    start_page_key, start_page = None, 1
+    if resume_state:
+        start_page_key, start_page = resume_state["next_page_key"], resume_state["page"]
+        stats["successful"] = resume_state["successful"]
+        stats["resumed"] = True
+        conditional_headers = None
+        print(f"Reanudando {endpoint_name} desde la página {start_page}")
+        # Descartar lo que los NDJSON recibieron después del progreso guardado
+        for page_sink in sinks:
+            if isinstance(page_sink, NDJSONSink) and page_sink.path in resume_state.get("files", {}):
+                page_sink.truncate(resume_state["files"][page_sink.path])
+        append_text_to_file(f"Resultado de {endpoint_name} (páginas 1 a {start_page - 1}): recibidas en la ejecución interrumpida\n")
+    
+    try:
+        for page_count, data in iter_api_pages(url, headers, endpoint_name, base_url=base_url, params=params,
+                                               stats=stats, conditional_headers=conditional_headers,
+                                               start_page_key=start_page_key, start_page=start_page,
+                                               entity_type=entity_type):
+            # Contar elementos si existe una lista de resultados
+            page_items = {}
+            if isinstance(data, dict):
+                for key, value in page_item_lists(data):
+                    page_items[key] = len(value)
+                    total_items += len(value)
+                    if page_count == 1:
+                        print(f"  - Encontrados {len(value)} elementos en la clave '{key}'")
+                    else:
+                        print(f"  - Agregados {len(value)} elementos más en la clave '{key}' (total: {key_totals.get(key, 0) + len(value)})")
+                    key_totals[key] = key_totals.get(key, 0) + len(value)
             
-            # Si hubo más de una página, guardar los datos combinados
-            if page_count > 1:
-                append_to_file(f"Resultado combinado de {endpoint_name} ({page_count} páginas, {total_items} elementos)", combined_data)
-                log_checkpoint(f"Consulta paginada a {endpoint_name} completada: {page_count} páginas procesadas, {total_items} elementos encontrados")
+            # Con salida NDJSON los elementos ya están en disco: basta una línea de resumen
+            if full_page_results or not ndjson_output:
+                append_to_file(f"Resultado de {endpoint_name} (página {page_count})", data)
+            else:
+                items = ", ".join(f"{count} en '{key}'" for key, count in page_items.items()) or "sin listas de elementos"
+                more = "hay más páginas" if isinstance(data, dict) and data.get("nextPageKey") else "última página"
+                append_text_to_file(f"Resultado de {endpoint_name} (página {page_count}): {items}; {more}\n")
             
-        else:
-            error_msg = f"Código de estado: {response.status_code}, Mensaje: {response.text}"
-            append_to_file(f"Error en {endpoint_name}", error_msg)
-            failed_requests += 1
+            for page_sink in sinks:
+                page_sink.write_page(endpoint_name, page_count, data)
             
+            # Guardar el progreso (como mucho cada checkpoint_save_interval segundos)
+            # solo cuando la página ya está en disco, también en el archivo de resultados
+            if checkpoint is not None and checkpoint.save_due(stream):
+                for page_sink in sinks:
+                    page_sink.flush()
+                flush_writers()
+                next_page_key = data.get("nextPageKey") if isinstance(data, dict) else None
+                files = {s.path: s.size() for s in sinks if isinstance(s, NDJSONSink)}
+                checkpoint.page_done(stream, page_count, next_page_key, stats["successful"], files)
+    except Exception as e:
+        error_msg = f"Error general en consulta: {str(e)}"
+        print(error_msg)
+        append_to_file(f"Excepción en {endpoint_name}", error_msg)
+        stats["failed"] = stats.get("failed", 0) + 1
+    
+    # Si la API rechaza el nextPageKey guardado (p. ej. porque ha caducado), el flujo
+    # no se puede reanudar: se descarta lo recibido y se recorre desde la primera página
+    error_status = stats.get("error_status") or 0
+    if resume_state and stats.get("error_page") == start_page and 400 <= error_status < 500 and error_status != 429:
+        log_checkpoint(f"El nextPageKey guardado de {endpoint_name} fue rechazado (HTTP {error_status}); "
+                       f"se consulta de nuevo desde la primera página")
+        checkpoint.discard_in_flight(stream)
+        for page_sink in sinks:
+            if isinstance(page_sink, NDJSONSink):
+                page_sink.truncate(0)
+        stats.clear()
+        return paginated_api_request(url, headers, endpoint_name, base_url=base_url, params=params, sink=sink,
+                                     collect=collect, stats=stats, stream=stream, entity_type=entity_type)
+    
+    # Si hubo más de una página, guardar los datos combinados
+    page_count = stats.get("pages", 0)
+    if page_count > 1:
+        if combined is not None:
+            append_to_file(f"Resultado combinado de {endpoint_name} ({page_count} páginas, {total_items} elementos)", combined.data)
+        log_checkpoint(f"Consulta paginada a {endpoint_name} completada: {page_count} páginas procesadas, {total_items} elementos encontrados")
+    
+    # Un flujo con errores queda pendiente para reintentarlo al reanudar
+    if checkpoint is not None and stats.get("failed", 0) == 0:
+        for page_sink in sinks:
+            page_sink.flush()
+        flush_writers()
+        checkpoint.mark_completed(stream, stats.get("successful", 0), 0)
+    
+    return stats.get("successful", 0), stats.get("failed", 0), combined.data if combined is not None else None
+
+# Consultar un endpoint paginado enviando sus elementos al NDJSON si está activado
+def fetch_paginated_endpoint(endpoint_url, headers, endpoint_name, params=None):
+    completed = skip_completed_stream(endpoint_name)
+    if completed is not None:
+        return completed[0], completed[1], None
+    
+    stats = {}
+    conditional_headers = None
+    hash_sink = None
+    previous_state = None
+    
+    # En modo incremental, usar el estado de la ejecución anterior
+    if audit_state is not None:
+        hash_sink = HashSink()
+        previous_state = audit_state.get_stream(endpoint_name)
+        if previous_state:
+            if endpoint_name in incremental_time_filtered_endpoints:
+                params = {**(params or {}), "from": previous_state["last_run_ms"]}
+            else:
+                conditional_headers = {}
+                if previous_state["etag"]:
+                    conditional_headers["If-None-Match"] = previous_state["etag"]
+                if previous_state["last_modified"]:
+                    conditional_headers["If-Modified-Since"] = previous_state["last_modified"]
+    
+    # Los elementos filtrados con "from" se guardan aparte y se añaden al NDJSON
+    # acumulado solo si la consulta se completa
+    delta = params is not None and "from" in params
+    resuming = crawl_checkpoint is not None and crawl_checkpoint.in_flight(endpoint_name) is not None
+    sink = open_ndjson_sink(f"delta{endpoint_name}" if delta else endpoint_name, append=resuming)
+    try:
+        result = paginated_api_request(endpoint_url, headers, endpoint_name, base_url=endpoint_url, params=params,
+                                       sink=[sink, hash_sink], collect=sink is None,
+                                       stats=stats, conditional_headers=conditional_headers, stream=endpoint_name)
+    finally:
+        if sink is not None:
+            sink.close()
+    if sink is not None and delta and result[1] == 0:
+        append_ndjson(sink.path, ndjson_path_for(endpoint_name))
+    
+    # El hash de un flujo reanudado solo cubre parte de las páginas
+    if audit_state is not None and result[1] == 0 and not stats.get("resumed"):
+        update_endpoint_state(endpoint_name, previous_state, stats, hash_sink)
+    return result
+
+# Añadir un NDJSON parcial al final de otro y eliminarlo
+def append_ndjson(source_path, target_path):
+    if not os.path.exists(source_path):
+        return
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    with open(source_path, 'r', encoding='utf-8') as source, open(target_path, 'a', encoding='utf-8') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(source_path)
+
+# Guardar el estado de un endpoint y registrar si ha cambiado
+def update_endpoint_state(endpoint_name, previous_state, stats, hash_sink):
+    if stats.get("not_modified"):
+        audit_state.save_stream(
+            endpoint_name,
+            etag=previous_state["etag"],
+            last_modified=previous_state["last_modified"],
+            content_hash=previous_state["content_hash"],
+            item_count=previous_state["item_count"]
+        )
+        audit_state.record_endpoint_change(endpoint_name, "sin cambios (304)", previous_state["item_count"])
+        return
+    
+    content_hash = hash_sink.hexdigest()
+    if previous_state is None:
+        status = "nuevo"
+    elif endpoint_name in incremental_time_filtered_endpoints:
+        status = "nuevos registros" if hash_sink.item_count else "sin cambios"
+    elif previous_state["content_hash"] == content_hash:
+        status = "sin cambios"
+    else:
+        status = "modificado"
+    audit_state.save_stream(
+        endpoint_name,
+        etag=stats.get("etag"),
+        last_modified=stats.get("last_modified"),
+        content_hash=content_hash,
+        item_count=hash_sink.item_count
+    )
+    audit_state.record_endpoint_change(endpoint_name, status, hash_sink.item_count)
+
+# Destino que descarta los logs de auditoría fuera de su ventana de tiempo
+class AuditLogWindowSink(PageSink):
+    """
+    Deja pasar solo los eventos con timestamp en [start, end), de modo que un
+    evento en el límite entre dos ventanas no se escribe dos veces, y registra
+    el timestamp más reciente recibido
+    """
+    
+    def __init__(self, sinks, start, end):
+        self.sinks = [s for s in sinks if s is not None]
+        self.start = start
+        self.end = end
+        self.item_count = 0
+        self.last_event = None
+    
+    def write_page(self, endpoint_name, page_number, data):
+        logs = []
+        for log in data.get("auditLogs", []) if isinstance(data, dict) else []:
+            timestamp = log.get("timestamp")
+            if isinstance(timestamp, (int, float)) and not self.start <= timestamp < self.end:
+                continue
+            logs.append(log)
+            if isinstance(timestamp, (int, float)) and (self.last_event is None or timestamp > self.last_event):
+                self.last_event = int(timestamp)
+        self.item_count += len(logs)
+        page = {**data, "auditLogs": logs} if isinstance(data, dict) else data
+        for page_sink in self.sinks:
+            page_sink.write_page(endpoint_name, page_number, page)
+    
+    def flush(self):
+        for page_sink in self.sinks:
+            page_sink.flush()
+
+# Fecha legible de un epoch en milisegundos
+def format_epoch_ms(value):
+    return datetime.fromtimestamp(value / 1000).strftime('%Y-%m-%d %H:%M:%S')
+
+# Convertir una fecha ISO 8601 (o epoch en milisegundos) a epoch en milisegundos
+def parse_epoch_ms(value):
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+# Leer el estado de la marca de agua de los logs de auditoría del entorno
+def load_auditlog_watermark_state():
+    path = auditlog_watermark_path or os.path.join(output_dir, "dynatrace_auditlog_watermark.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Una marca de agua de otro entorno no sirve
+    if state.get("environment_id") != environment_id:
+        return None
+    return state
+
+# Leer la marca de agua de los logs de auditoría del entorno
+def load_auditlog_watermark():
+    state = load_auditlog_watermark_state()
+    return state.get("high_water_mark") if state else None
+
+# Guardar la marca de agua de los logs de auditoría (con el rango y el número de
+# eventos de la última consulta, para estimar el volumen de la siguiente). Nunca
+# avanza más allá de ahora menos auditlog_ingest_delay: los eventos posteriores
+# pueden no estar indexados todavía y se perderían
+def save_auditlog_watermark(high_water_mark, last_event, start_ms=None, events=None):
+    path = auditlog_watermark_path or os.path.join(output_dir, "dynatrace_auditlog_watermark.json")
+    high_water_mark = min(high_water_mark, int((time.time() - auditlog_ingest_delay) * 1000))
+    state = {
+        "environment_id": environment_id,
+        "high_water_mark": high_water_mark,
+        "last_event": last_event,
+        "range_start": start_ms,
+        "events": events,
+        "updated": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(dumps_json(state, pretty=True))
+    os.replace(tmp_path, path)
+
+# Dividir un rango de tiempo en ventanas consecutivas
+def plan_auditlog_windows(start_ms, end_ms):
+    size = int(auditlog_window_hours * 3600 * 1000)
+    windows = []
+    window_start = start_ms
+    while window_start < end_ms:
+        windows.append((window_start, min(window_start + size, end_ms)))
+        window_start += size
+    return windows
+
+# Rango de los logs de auditoría a consultar: el indicado explícitamente o desde la
+# marca de agua (o los últimos auditlog_lookback_days días) hasta ahora
+def auditlog_range():
+    """
+    Con auditlog_from o auditlog_to el rango es explícito y no usa ni modifica la
+    marca de agua: sin auditlog_from empieza auditlog_lookback_days días antes del
+    final y sin auditlog_to termina ahora menos auditlog_ingest_delay.
+    
+    Returns:
+        tuple: (inicio en epoch ms, fin en epoch ms, es un rango explícito)
+    """
+    explicit_range = auditlog_from is not None or auditlog_to is not None
+    end_ms = parse_epoch_ms(auditlog_to) if auditlog_to else int((time.time() - auditlog_ingest_delay) * 1000)
+    if auditlog_from:
+        start_ms = parse_epoch_ms(auditlog_from)
+    elif explicit_range:
+        start_ms = end_ms - int(auditlog_lookback_days * 86400 * 1000)
+    else:
+        start_ms = load_auditlog_watermark() or end_ms - int(auditlog_lookback_days * 86400 * 1000)
+    return start_ms, end_ms, explicit_range
+
+# Consultar los logs de auditoría de una ventana de tiempo
+def fetch_auditlog_window(endpoint_url, headers, params, start, end, part_path):
+    window_params = {**(params or {}), "from": start, "to": end, "sort": "timestamp"}
+    sink = NDJSONSink(part_path) if part_path else None
+    window_sink = AuditLogWindowSink([sink], start, end)
+    try:
+        success, failed, _ = paginated_api_request(
+            endpoint_url, headers,
+            f"/api/v2/auditlogs ({format_epoch_ms(start)} - {format_epoch_ms(end)})",
+            base_url=endpoint_url, params=window_params, sink=window_sink, collect=sink is None
+        )
+    finally:
+        if sink is not None:
+            sink.close()
+    return success, failed, window_sink
+
+# Consultar los logs de auditoría por ventanas de tiempo en paralelo
+def fetch_auditlogs_windowed(endpoint_url, headers, endpoint_name, params=None):
+    """
+    Divide el rango desde la marca de agua (o auditlog_from) hasta ahora en
+    ventanas que se consultan en paralelo, ordenadas por timestamp ascendente.
+    Cada ventana se escribe en un archivo parcial. Si todas se completan sin
+    errores, los parciales se añaden en orden cronológico al NDJSON acumulado
+    (que la primera ejecución, sin marca de agua, crea de nuevo) y la marca de
+    agua avanza; si alguna falla se descartan y se vuelven a pedir en la
+    siguiente ejecución. Un rango explícito se escribe en auditlogs_range.ndjson
+    sin modificar el acumulado.
+    
+    Args:
+        endpoint_url (str): URL de /api/v2/auditlogs
+        headers (dict): Headers para la consulta
+        endpoint_name (str): Nombre del endpoint para el registro
+        params (dict, optional): Parámetros adicionales (pageSize)
+    
+    Returns:
+        tuple: (éxito, fallo, None)
+    """
+    completed = skip_completed_stream(endpoint_name)
+    if completed is not None:
+        return completed[0], completed[1], None
+    
+    start_ms, end_ms, explicit_range = auditlog_range()
+    if start_ms >= end_ms:
+        log_checkpoint(f"Sin eventos nuevos en {endpoint_name} desde {format_epoch_ms(start_ms)}")
+        return 0, 0, None
+    
+    windows = plan_auditlog_windows(start_ms, end_ms)
+    workers = max(1, min(auditlog_workers, len(windows)))
+    log_checkpoint(f"Consultando {endpoint_name} desde {format_epoch_ms(start_ms)} hasta {format_epoch_ms(end_ms)} "
+                   f"en {len(windows)} ventanas con {workers} hilos")
+    
+    final_path = None
+    if ndjson_output:
+        final_path = ndjson_path_for("auditlogs_range" if explicit_range else endpoint_name)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    part_paths = [f"{final_path}.{i}.part" if final_path else None for i in range(len(windows))]
+    successful_requests = 0
+    failed_requests = 0
+    total_items = 0
+    last_event = None
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_run_stream_captured, endpoint_name, fetch_auditlog_window,
+                            endpoint_url, headers, params, start, end, part_path)
+            for (start, end), part_path in zip(windows, part_paths)
+        ]
+        
+        # Volcar la salida de las ventanas en orden cronológico
+        for future in futures:
+            (success, failed, window_sink), captured = future.result()
+            flush_captured_output(captured)
+            successful_requests += success
+            failed_requests += failed
+            if window_sink is not None:
+                total_items += window_sink.item_count
+                if window_sink.last_event is not None:
+                    last_event = max(last_event or 0, window_sink.last_event)
+    
+    # Añadir las ventanas al NDJSON en orden cronológico solo si todas se completaron;
+    # sin marca de agua (primera ejecución o rango explícito) el NDJSON empieza de cero
+    if final_path:
+        if failed_requests == 0 and (explicit_range or load_auditlog_watermark() is None) and os.path.exists(final_path):
+            os.remove(final_path)
+        for part_path in part_paths:
+            if failed_requests == 0:
+                append_ndjson(part_path, final_path)
+            elif os.path.exists(part_path):
+                os.remove(part_path)
+    
+    if audit_state is not None:
+        audit_state.record_endpoint_change(endpoint_name, "nuevos registros" if total_items else "sin cambios", total_items)
+    
+    if failed_requests == 0:
+        if not explicit_range:
+            save_auditlog_watermark(end_ms, last_event, start_ms, total_items)
+        if crawl_checkpoint is not None:
+            crawl_checkpoint.mark_completed(endpoint_name, successful_requests, 0)
+        log_checkpoint(f"Logs de auditoría: {total_items} eventos en {len(windows)} ventanas"
+                       + ("" if explicit_range else f"; marca de agua en {format_epoch_ms(end_ms)}"))
+    else:
+        log_checkpoint(f"Logs de auditoría: {failed_requests} consultas fallidas; la marca de agua no se modifica")
+    return successful_requests, failed_requests, None
+
+# Consultar un endpoint de la Environment API con el método que le corresponde
+def fetch_environment_endpoint(base_url, headers, endpoint):
+    if endpoint == "/api/v2/auditlogs" and auditlog_windowed:
+        return fetch_auditlogs_windowed(f"{base_url}{endpoint}", headers, endpoint, params=endpoint_params())
+    return fetch_paginated_endpoint(f"{base_url}{endpoint}", headers, endpoint, params=endpoint_params())
+
+# Obtener el perfil de auditoría activo completado con los valores por defecto
+def get_audit_profile():
+    if audit_profile not in audit_profiles:
+        raise ValueError(f"Perfil de auditoría desconocido: {audit_profile} (disponibles: {', '.join(audit_profiles)})")
+    return {**audit_profile_defaults, **audit_profiles[audit_profile]}
+
+# Parámetros de la primera página de un endpoint paginado según el perfil activo
+def endpoint_params():
+    return {"pageSize": str(get_audit_profile()["page_size"])}
+
+# Metadatos de /api/v2/entityTypes de la ejecución en curso, por tipo
+entity_type_metadata = {}
+
+# Campos y tamaño de página de las entidades de un tipo según el perfil activo
+def entity_query_options(entity_type):
+    """
+    Combina los campos del perfil con sus ajustes para el tipo. Si el perfil pide
+    propiedades concretas, solo se solicitan las que los metadatos del tipo
+    declaran, de modo que cada tipo descarga únicamente lo que puede devolver.
+    Con entity_store_enabled se añaden siempre las relaciones.
+    
+    Returns:
+        tuple: (valor de "fields", tamaño de página)
+    """
+    profile = get_audit_profile()
+    options = {**profile, **profile["type_overrides"].get(entity_type, {})}
+    fields = [f for f in options["entity_fields"].split(",") if f]
+    if options["entity_properties"]:
+        metadata = entity_type_metadata.get(entity_type)
+        declared = {p.get("id") for p in metadata.get("properties", [])} if metadata else None
+        fields.extend(
+            f"+properties.{name}" for name in options["entity_properties"]
+            if declared is None or name in declared
+        )
+    # El inventario en memoria necesita las relaciones para su índice related()
+    if entity_store_enabled:
+        fields.extend(f for f in ("+fromRelationships", "+toRelationships") if f not in fields)
+    return ",".join(fields), options["page_size"]
+
+# Número de entidades de cada tipo en ejecuciones anteriores
+class EntityTypeCounts:
+    """
+    Archivo JSON con el número de entidades de cada tipo y la fecha en que se
+    contó, para omitir los tipos vacíos sin consultarlos hasta que toca volver
+    a comprobarlos
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.counts = json.load(f)
+            except (OSError, ValueError):
+                self.counts = {}
+    
+    def is_known_empty(self, entity_type):
+        with self.lock:
+            entry = self.counts.get(entity_type)
+        if not entry or entry["count"] != 0:
+            return False
+        return time.time() - entry["checked"] < empty_type_recheck_hours * 3600
+    
+    def record(self, entity_type, count):
+        with self.lock:
+            self.counts[entity_type] = {"count": count, "checked": int(time.time())}
+            self.dirty = True
+    
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(dumps_json(self.counts))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+# Recuento de entidades por tipo de la ejecución en curso (se abre al usarse)
+entity_type_counts = None
+entity_type_counts_lock = threading.Lock()
+
+# Obtener (o abrir) el recuento de entidades por tipo
+def get_entity_type_counts():
+    global entity_type_counts
+    with entity_type_counts_lock:
+        if entity_type_counts is None:
+            path = entity_type_counts_path or os.path.join(output_dir, "dynatrace_entity_type_counts.json")
+            entity_type_counts = EntityTypeCounts(path)
+        return entity_type_counts
+
+# Guardar y cerrar el recuento de entidades por tipo
+def close_entity_type_counts():
+    global entity_type_counts
+    if entity_type_counts is not None:
+        entity_type_counts.save()
+        entity_type_counts = None
+
+# Aplicar a una lista de tipos de entidad los filtros del perfil activo
+def filter_entity_types(entity_types, counts):
+    """
+    Aplica los patrones de inclusión y exclusión del perfil y, con
+    skip_empty_types, omite los tipos que estaban vacíos en una ejecución reciente
+    
+    Args:
+        entity_types (list): Tipos devueltos por /api/v2/entityTypes
+        counts (EntityTypeCounts): Recuento de entidades por tipo de ejecuciones anteriores
+    
+    Returns:
+        tuple: (tipos que se consultarán en el mismo orden, tipos omitidos por estar vacíos)
+    """
+    profile = get_audit_profile()
+    include = profile["entity_types"]
+    exclude = profile["exclude_entity_types"]
+    selected = [
+        t for t in entity_types
+        if (include is None or any(fnmatch.fnmatchcase(t, p) for p in include))
+        and not any(fnmatch.fnmatchcase(t, p) for p in exclude)
+    ]
+    
+    skipped_empty = []
+    if profile["skip_empty_types"]:
+        skipped_empty = [t for t in selected if counts.is_known_empty(t)]
+        selected = [t for t in selected if t not in skipped_empty]
+    return selected, skipped_empty
+
+# Filtrar los tipos de entidad según el perfil activo
+def select_entity_types(entity_types):
+    """
+    Returns:
+        list: Tipos que se consultarán, en el mismo orden
+    """
+    selected, skipped_empty = filter_entity_types(entity_types, get_entity_type_counts())
+    if len(selected) < len(entity_types):
+        log_checkpoint(f"Perfil '{audit_profile}': {len(selected)} de {len(entity_types)} tipos de entidad seleccionados "
+                       f"({len(skipped_empty)} omitidos por estar vacíos en una ejecución reciente)")
+    return selected
+
+# Función especializada para consultar entidades para un tipo específico
+def fetch_entities_for_type(base_url, headers, entity_type):
+    """
+    Consulta todas las entidades para un tipo específico, manejando la paginación
+    
+    Args:
+        base_url (str): URL base para las consultas
+        headers (dict): Headers para la consulta
+        entity_type (str): Tipo de entidad a consultar
+    
+    Returns:
+        tuple: (éxito, fallo, entidades combinadas, o None si la salida NDJSON está activada)
+    """
+    print(f"Consultando entities para el tipo {entity_type}...")
+    
+    # El selector se codifica una sola vez al construir la URL (build_url_with_params)
+    entities_url = f"{base_url}/api/v2/entities"
+    
+    # Campos y tamaño de página según el perfil de auditoría activo
+    fields, page_size = entity_query_options(entity_type)
+    params = {
+        "pageSize": str(page_size),
+        "entitySelector": f'type("{entity_type}")'
+    }
+    if fields:
+        params["fields"] = fields
+    
+    stream = f"entities:{entity_type}"
+    completed = skip_completed_stream(stream)
+    if completed is not None:
+        return completed[0], completed[1], None
+    
+    # En modo incremental, consultar solo las entidades con actividad desde la última
+    # ejecución, salvo cuando toca la consulta completa periódica del tipo
+    id_sink = None
+    if audit_state is not None:
+        id_sink = EntityIdSink()
+        previous_state = audit_state.get_stream(stream)
+        if previous_state and not entity_full_scan_due(entity_type):
+            params["from"] = previous_state["last_run_ms"]
+    delta = "from" in params
+    
+    # En modo streaming las entidades van directamente al NDJSON del tipo; las de una
+    # consulta filtrada se guardan aparte y después se combinan con el NDJSON completo
+    ndjson_name = f"entities-delta_{entity_type}" if delta else f"entities_{entity_type}"
+    resuming = crawl_checkpoint is not None and crawl_checkpoint.in_flight(stream) is not None
+    sink = open_ndjson_sink(ndjson_name, append=resuming)
+    store_sink = EntityStoreSink(entity_store) if entity_store is not None else None
+    try:
+        if entity_type in sharded_entity_types:
+            success, failed, entities_data = fetch_entities_sharded(
+                base_url, headers, entity_type, params,
+                sinks=[sink, id_sink, store_sink],
+                collect=sink is None
+            )
+            if crawl_checkpoint is not None and failed == 0:
+                crawl_checkpoint.mark_completed(stream, success, 0)
+        else:
+            success, failed, entities_data = paginated_api_request(
+                entities_url,
+                headers,
+                f"/api/v2/entities para tipo {entity_type}",
+                base_url=entities_url,
+                params=params,
+                sink=[sink, id_sink, store_sink],
+                collect=sink is None,
+                stream=stream,
+                entity_type=entity_type
+            )
+    finally:
+        if sink is not None:
+            sink.close()
+    
+    # Calcular altas y bajas respecto a la ejecución anterior (no es posible si el tipo se reanudó)
+    if id_sink is not None and failed == 0 and not resuming:
+        added, removed = audit_state.diff_entities(entity_type, id_sink.ids, full=not delta)
+        audit_state.save_stream(stream, item_count=len(id_sink.ids))
+        if not delta:
+            audit_state.save_stream(f"entities-full:{entity_type}", item_count=len(id_sink.ids))
+        audit_state.record_entity_change(entity_type, added, removed)
+        if added or removed:
+            log_checkpoint(f"Cambios en el tipo {entity_type}: {len(added)} entidades nuevas, {len(removed)} sin actividad desde la última consulta completa")
+    
+    # Combinar las entidades con actividad reciente con el NDJSON completo del tipo
+    if sink is not None and delta and failed == 0:
+        merged = merge_entity_delta(entity_type, sink.path)
+        log_checkpoint(f"Actualizadas {sink.item_count} entidades del tipo {entity_type} ({merged} en el inventario)")
+    
+    # Registrar estadísticas
+    entity_count = None
+    if sink is not None:
+        entity_count = sink.item_count
+        log_checkpoint(f"Encontradas {sink.item_count} entidades para el tipo {entity_type}")
+    elif entities_data and "entities" in entities_data:
+        entity_count = len(entities_data["entities"])
+        log_checkpoint(f"Encontradas {entity_count} entidades para el tipo {entity_type}")
+    elif failed == 0:
+        entity_count = 0
+    
+    # El recuento solo es completo si no se filtró por fecha ni se reanudó el tipo
+    if entity_count is not None and failed == 0 and "from" not in params and not resuming:
+        get_entity_type_counts().record(entity_type, entity_count)
+    
+    return success, failed, entities_data
+
+# Comprobar si toca la consulta completa de un tipo de entidad en modo incremental
+def entity_full_scan_due(entity_type):
+    last_full = audit_state.get_stream(f"entities-full:{entity_type}")
+    if last_full is None or not incremental_entity_full_scan_hours:
+        return True
+    return time.time() * 1000 - last_full["last_run_ms"] >= incremental_entity_full_scan_hours * 3600 * 1000
+
+# Combinar las entidades de una consulta incremental con el NDJSON completo del tipo
+def merge_entity_delta(entity_type, delta_path):
+    """
+    Sustituye en el NDJSON del tipo las entidades recibidas en la consulta filtrada
+    con "from" y añade las nuevas. Las entidades sin actividad reciente conservan
+    la versión de la ejecución anterior y se añaden también al inventario en memoria.
+    
+    Returns:
+        int: Número de entidades del NDJSON resultante
+    """
+    full_path = ndjson_path_for(f"entities_{entity_type}")
+    delta_ids = set()
+    if os.path.exists(delta_path):
+        with open(delta_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    delta_ids.add(json.loads(line).get("entityId"))
+    
+    count = 0
+    kept = []
+    with open(full_path + ".tmp", 'w', encoding='utf-8', buffering=1024 * 1024) as out:
+        if os.path.exists(full_path):
+            with open(full_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entity = json.loads(line)
+                    if entity.get("entityId") in delta_ids:
+                        continue
+                    out.write(line if line.endswith("\n") else line + "\n")
+                    count += 1
+                    if entity_store is not None:
+                        kept.append(entity)
+                        if len(kept) >= 10000:
+                            entity_store.add_entities(kept)
+                            kept = []
+        if os.path.exists(delta_path):
+            with open(delta_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        out.write(line if line.endswith("\n") else line + "\n")
+                        count += 1
+    if kept:
+        entity_store.add_entities(kept)
+    os.replace(full_path + ".tmp", full_path)
+    if os.path.exists(delta_path):
+        os.remove(delta_path)
+    return count
+
+# Destino que descarta las entidades ya recibidas por otro fragmento del mismo tipo
+class DedupEntitySink(PageSink):
+    def __init__(self, sinks):
+        self.sinks = [s for s in sinks if s is not None]
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.duplicates = 0
+    
+    def write_page(self, endpoint_name, page_number, data):
+        with self.lock:
+            entities = []
+            for entity in data.get("entities", []):
+                entity_id = entity.get("entityId")
+                if entity_id in self.seen:
+                    self.duplicates += 1
+                    continue
+                self.seen.add(entity_id)
+                entities.append(entity)
+            page = {**data, "entities": entities}
+            for page_sink in self.sinks:
+                page_sink.write_page(endpoint_name, page_number, page)
+
+# Obtener los IDs de las zonas de gestión del entorno
+def fetch_management_zone_ids(base_url, headers):
+    response = api_get(f"{base_url}/api/config/v1/managementZones", headers=headers)
+    if response.status_code != 200:
+        raise Exception(f"No se pudieron obtener las zonas de gestión (código de estado: {response.status_code})")
+    return [zone["id"] for zone in response.json().get("values", [])]
+
+# Construir los selectores disjuntos de los fragmentos de un tipo de entidad
+def build_shard_selectors(base_url, headers, entity_type, shard_config):
+    """
+    Devuelve un selector por zona de gestión o por etiqueta, más un selector final
+    con las entidades que no cumplen ninguno de los criterios, de modo que la unión
+    de los fragmentos cubre todo el tipo
+    """
+    base_selector = f'type("{entity_type}")'
+    strategy = shard_config.get("strategy")
+    if strategy == "managementZone":
+        criteria = [f"mzId({zone_id})" for zone_id in fetch_management_zone_ids(base_url, headers)]
+    elif strategy == "tag":
+        criteria = [f'tag("{tag}")' for tag in shard_config.get("tags", [])]
+    else:
+        raise ValueError(f"Estrategia de fragmentación desconocida para {entity_type}: {strategy}")
+    
+    selectors = [f"{base_selector},{criterion}" for criterion in criteria]
+    selectors.append(base_selector + "".join(f",not({criterion})" for criterion in criteria))
+    return selectors
+
+# Consultar un tipo de entidad grande en fragmentos paralelos
+def fetch_entities_sharded(base_url, headers, entity_type, params, sinks, collect=False):
+    """
+    Divide el entitySelector del tipo según sharded_entity_types, consulta los
+    fragmentos en paralelo y combina sus páginas sin duplicados (una entidad puede
+    pertenecer a varias zonas de gestión o tener varias etiquetas). La salida de
+    cada fragmento se escribe en el orden de los fragmentos.
+    
+    Args:
+        base_url (str): URL base para las consultas
+        headers (dict): Headers para la consulta
+        entity_type (str): Tipo de entidad a consultar
+        params (dict): Parámetros de la consulta sin fragmentar
+        sinks (list): Destinos de las páginas ya deduplicadas
+        collect (bool, optional): Combinar también las entidades en memoria
+    
+    Returns:
+        tuple: (éxito, fallo, entidades combinadas o None)
+    """
+    entities_url = f"{base_url}/api/v2/entities"
+    try:
+        selectors = build_shard_selectors(base_url, headers, entity_type, sharded_entity_types[entity_type])
+    except Exception as e:
+        error_msg = f"Error al fragmentar el tipo {entity_type}: {str(e)}"
+        print(error_msg)
+        append_to_file(f"Excepción en /api/v2/entities para tipo {entity_type}", error_msg)
+        return 0, 1, None
+    combined = CombinedDataSink() if collect else None
+    dedup_sink = DedupEntitySink([combined, *sinks])
+    total_shards = len(selectors)
+    log_checkpoint(f"Consultando el tipo {entity_type} en {total_shards} fragmentos")
+    
+    def fetch_shard(index, selector):
+        start_output_capture()
+        endpoint_name = f"/api/v2/entities para tipo {entity_type} (fragmento {index}/{total_shards})"
+        try:
+            shard_params = {**params, "entitySelector": selector}
+            success, failed, _ = paginated_api_request(
+                entities_url, headers, endpoint_name,
+                base_url=entities_url, params=shard_params, sink=dedup_sink, collect=False,
+                entity_type=entity_type
+            )
+        except Exception as e:
+            error_msg = f"Error en consulta del fragmento {index}: {str(e)}"
+            print(error_msg)
+            append_to_file(f"Excepción en {endpoint_name}", error_msg)
+            success, failed = 0, 1
+        return success, failed, stop_output_capture()
+    
+    successful_requests = 0
+    failed_requests = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(shard_workers, total_shards))) as executor:
+        futures = [executor.submit(fetch_shard, i, selector) for i, selector in enumerate(selectors, 1)]
+        for future in futures:
+            success, failed, captured = future.result()
+            flush_captured_output(captured)
+            successful_requests += success
+            failed_requests += failed
+    
+    if dedup_sink.duplicates:
+        log_checkpoint(f"Descartadas {dedup_sink.duplicates} entidades duplicadas entre fragmentos del tipo {entity_type}")
+    return successful_requests, failed_requests, combined.data if combined is not None else None
+
+# Consulta de un tipo de entidad dentro de un hilo, capturando su salida
+def _fetch_entities_captured(base_url, headers, entity_type):
+    start_output_capture()
+    try:
+        success, failed, _ = fetch_entities_for_type(base_url, headers, entity_type)
     except Exception as e:
-        error_msg = f"Error general en consulta: {str(e)}"
+        error_msg = f"Error en consulta de entidades para el tipo {entity_type}: {str(e)}"
         print(error_msg)
-        append_to_file(f"Excepción en {endpoint_name}", error_msg)
-        failed_requests += 1
-    
-    return successful_requests, failed_requests, combined_data
+        append_to_file(f"Excepción en /api/v2/entities para tipo {entity_type}", error_msg)
+        success, failed = 0, 1
+    return success, failed, stop_output_capture()
 
-# Función especializada para consultar entidades para un tipo específico
-def fetch_entities_for_type(base_url, headers, entity_type):
+# Consultar entidades de varios tipos en paralelo con concurrencia acotada
+def fetch_entities_concurrently(base_url, headers, entity_types, max_workers=None):
     """
-    Consulta todas las entidades para un tipo específico, manejando la paginación
+    Consulta las entidades de cada tipo usando un pool de hilos. La salida de cada
+    tipo se captura en memoria y se escribe en el orden original de entity_types,
+    de modo que el archivo de resultados es determinista.
     
     Args:
         base_url (str): URL base para las consultas
         headers (dict): Headers para la consulta
-        entity_type (str): Tipo de entidad a consultar
+        entity_types (list): Tipos de entidad a consultar
+        max_workers (int, optional): Número de hilos (por defecto entity_type_workers)
     
     Returns:
-        tuple: (éxito, fallo, entidades)
+        tuple: (éxito, fallo)
     """
-    print(f"Consultando entities para el tipo {entity_type}...")
+    max_workers = max_workers or entity_type_workers
+    total_types = len(entity_types)
+    successful_requests = 0
+    failed_requests = 0
     
-    # Construir la URL con el tipo codificado correctamente y el tamaño de página
-    encoded_selector = urllib.parse.quote(f'type("{entity_type}")')
-    entities_url = f"{base_url}/api/v2/entities"
+    log_checkpoint(f"Consultando {total_types} tipos de entidad con {max_workers} hilos")
     
-    # Usar un tamaño de página grande para reducir el número de consultas necesarias
-    # pero no demasiado grande para evitar problemas de rendimiento
-    params = {
-        "pageSize": "500",  # Aumentar el tamaño de página 
-        "entitySelector": encoded_selector,
-        "fields": "+properties,+tags,+managementZones"  # Obtener datos adicionales si es necesario
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_fetch_entities_captured, base_url, headers, entity_type)
+            for entity_type in entity_types
+        ]
+        
+        # Recorrer los resultados en el orden de envío para mantener el orden de salida
+        for i, (entity_type, future) in enumerate(zip(entity_types, futures), 1):
+            success, failed, captured = future.result()
+            print(f"Procesado tipo {i}/{total_types}: {entity_type}")
+            flush_captured_output(captured)
+            successful_requests += success
+            failed_requests += failed
+    
+    return successful_requests, failed_requests
+
+# Endpoints de la Environment API que podrían tener paginación
+paginated_endpoints = [
+    "/api/v2/apiTokens",
+    "/api/v2/activeGates",
+    "/api/v2/activeGateTokens",
+    "/api/v2/auditlogs",
+    "/api/v2/credentials",
+    "/api/v2/tags",
+    "/api/config/v1/dashboards",
+    "/api/config/v1/applications/mobile",
+    "/api/v1/synthetic/monitors",
+    "/api/config/v1/applications/web",
+    "/api/v2/slo"
+]
+
+# Endpoints de la Environment API que consulta el perfil activo
+def profile_endpoints():
+    endpoints = get_audit_profile()["endpoints"]
+    return paginated_endpoints if endpoints is None else [e for e in paginated_endpoints if e in endpoints]
+
+# Endpoints de la Account Management API de la cuenta configurada
+def account_management_endpoints():
+    return [
+        f"/iam/v1/accounts/{account_id}/groups",
+        f"/iam/v1/accounts/{account_id}/users",
+        f"/sub/v2/accounts/{account_id}/subscriptions"
+    ]
+
+# URL base y headers de la Environment API
+def environment_request_context():
+    base_url = environment_base_url or f"https://{environment_id}.live.dynatrace.com"
+    headers = {
+        "Authorization": f"Api-Token {api_token}",
+        "Accept": "application/json; charset=utf-8"
+    }
+    return base_url, headers
+
+# URL base y headers de la Account Management API
+def account_request_context(bearer_token):
+    headers = {
+        "Authorization": f"Bearer {bearer_token}",
+        "Accept": "application/json"
     }
+    return account_api_base_url, headers
+
+# Obtener la lista de tipos de entidad del entorno
+def fetch_entity_types(base_url, headers):
+    """
+    Returns:
+        tuple: (éxito, fallo, tipos de entidad seleccionados por el perfil activo)
+    """
+    entity_types_url = f"{base_url}/api/v2/entityTypes"
+    print("Consultando entity types...")
+    
+    # Usar un tamaño de página grande para entity types
+    params = {"pageSize": "500"}
     
-    success, failed, entities_data = paginated_api_request(
-        entities_url,
-        headers,
-        f"/api/v2/entities para tipo {entity_type}",
-        base_url=entities_url,
+    success, failed, entity_types_data = paginated_api_request(
+        entity_types_url, 
+        headers, 
+        "/api/v2/entityTypes",
+        base_url=entity_types_url,
         params=params
     )
     
-    # Registrar estadísticas
-    if entities_data and "entities" in entities_data:
-        entity_count = len(entities_data["entities"])
-        log_checkpoint(f"Encontradas {entity_count} entidades para el tipo {entity_type}")
-    
-    return success, failed, entities_data
+    # Extraer el valor "type" de cada tipo y guardar sus metadatos
+    entity_types = []
+    if entity_types_data and "types" in entity_types_data and entity_types_data["types"]:
+        entity_types = [type_info["type"] for type_info in entity_types_data["types"]]
+        entity_type_metadata.update({type_info["type"]: type_info for type_info in entity_types_data["types"]})
+    return success, failed, select_entity_types(entity_types)
 
 # Consultar API de Dynatrace Environment
 def fetch_environment_api():
-    base_url = f"https://{environment_id}.live.dynatrace.com"
-    headers = {
-        "Authorization": f"Api-Token {api_token}",
-        "Accept": "application/json; charset=utf-8"
-    }
+    base_url, headers = environment_request_context()
     
     log_checkpoint("Iniciando consultas a Dynatrace Environment API")
     
-    # Lista de endpoints que podrían tener paginación
-    paginated_endpoints = [
-        "/api/v2/apiTokens",
-        "/api/v2/activeGates",
-        "/api/v2/activeGateTokens",
-        "/api/v2/auditlogs",
-        "/api/v2/credentials",
-        "/api/v2/tags",
-        "/api/config/v1/dashboards",
-        "/api/config/v1/applications/mobile",
-        "/api/v1/synthetic/monitors",
-        "/api/config/v1/applications/web",
-        "/api/v2/slo"
-    ]
-    
     successful_requests = 0
     failed_requests = 0
     
     # Procesar endpoints potencialmente paginados
-    for endpoint in paginated_endpoints:
-        endpoint_url = f"{base_url}{endpoint}"
-        # Usar un tamaño de página grande para cada consulta
-        params = {"pageSize": "500"}
-        success, failed, _ = paginated_api_request(endpoint_url, headers, endpoint, base_url=endpoint_url, params=params)
+    for endpoint in profile_endpoints():
+        success, failed, _ = fetch_environment_endpoint(base_url, headers, endpoint)
         successful_requests += success
         failed_requests += failed
-        # Pausa para no sobrecargar la API
-        time.sleep(1)
     
     # Caso especial para entity types y entities
     try:
         # Primero obtener todos los tipos de entidades
-        entity_types_url = f"{base_url}/api/v2/entityTypes"
-        print("Consultando entity types...")
-        
-        # Usar un tamaño de página grande para entity types
-        params = {"pageSize": "500"}
-        
-        success, failed, entity_types_data = paginated_api_request(
-            entity_types_url, 
-            headers, 
-            "/api/v2/entityTypes",
-            base_url=entity_types_url,
-            params=params
-        )
+        success, failed, entity_types = fetch_entity_types(base_url, headers)
         successful_requests += success
         failed_requests += failed
         
         # Consultar entidades para cada tipo usando nuestra función especializada
-        if entity_types_data and "types" in entity_types_data and entity_types_data["types"]:
-            total_types = len(entity_types_data["types"])
+        if entity_types:
+            total_types = len(entity_types)
             log_checkpoint(f"Consultando entidades para {total_types} tipos encontrados")
             
-            for i, type_info in enumerate(entity_types_data["types"], 1):
-                entity_type = type_info["type"]  # Extraer el valor "type" de cada tipo
-                print(f"Procesando tipo {i}/{total_types}: {entity_type}")
-                
-                # Usar nuestra función especializada para consultar entidades
-                entity_success, entity_failed, _ = fetch_entities_for_type(base_url, headers, entity_type)
-                
+            if entity_type_workers > 1:
+                entity_success, entity_failed = fetch_entities_concurrently(base_url, headers, entity_types)
                 successful_requests += entity_success
                 failed_requests += entity_failed
-                
-                # Pausa para no sobrecargar la API
-                time.sleep(1)
+            else:
+                for i, entity_type in enumerate(entity_types, 1):
+                    print(f"Procesando tipo {i}/{total_types}: {entity_type}")
+                    
+                    # Usar nuestra función especializada para consultar entidades
+                    entity_success, entity_failed, _ = fetch_entities_for_type(base_url, headers, entity_type)
+                    
+                    successful_requests += entity_success
+                    failed_requests += entity_failed
         else:
             log_checkpoint("No se encontraron tipos de entidades para consultar")
     except Exception as e:
@@ -382,68 +3005,361 @@ def fetch_environment_api():
 
 # Consultar API de Dynatrace Account Management
 def fetch_account_management_api(bearer_token):
+    if not get_audit_profile()["account"]:
+        log_checkpoint(f"Account Management API omitida por el perfil '{audit_profile}'")
+        return 0, 0
     if not bearer_token:
         log_checkpoint("No se puede consultar Account Management API: Bearer Token no disponible")
         return 0, 1
     
-    base_url = "https://api.dynatrace.com"
-    headers = {
-        "Authorization": f"Bearer {bearer_token}",
-        "Accept": "application/json"
-    }
+    base_url, headers = account_request_context(bearer_token)
     
     log_checkpoint("Iniciando consultas a Dynatrace Account Management API")
     
-    # Lista de endpoints
-    endpoints = [
-        f"/iam/v1/accounts/{account_id}/groups",
-        f"/iam/v1/accounts/{account_id}/users",
-        f"/sub/v2/accounts/{account_id}/subscriptions"
-    ]
-    
     successful_requests = 0
     failed_requests = 0
     
     # Procesar endpoints potencialmente paginados
-    for endpoint in endpoints:
+    for endpoint in account_management_endpoints():
         endpoint_url = f"{base_url}{endpoint}"
-        # Usar un tamaño de página grande para cada consulta
-        params = {"pageSize": "500"}
-        success, failed, _ = paginated_api_request(endpoint_url, headers, endpoint, base_url=endpoint_url, params=params)
+        # Tamaño de página del perfil activo
+        params = endpoint_params()
+        success, failed, _ = fetch_paginated_endpoint(endpoint_url, headers, endpoint, params=params)
         successful_requests += success
         failed_requests += failed
-        # Pausa para no sobrecargar la API
-        time.sleep(1)
     
     log_checkpoint(f"Consultas a Account Management API completadas: {successful_requests} exitosas, {failed_requests} fallidas")
     return successful_requests, failed_requests
 
-def main():
-    start_time = datetime.now()
-    print(f"Iniciando consulta unificada de APIs de Dynatrace. Los resultados se guardarán en {output_path}")
-    print(f"El log de ejecución se guardará en {log_path}")
+# Ejecutar un flujo en un hilo del motor asíncrono capturando su salida
+def _run_stream_captured(label, func, *args):
+    start_output_capture()
+    try:
+        result = func(*args)
+    except Exception as e:
+        error_msg = f"Error general en consulta: {str(e)}"
+        print(error_msg)
+        append_to_file(f"Excepción en {label}", error_msg)
+        result = (0, 1, None)
+    return result, stop_output_capture()
+
+# Motor asíncrono de la auditoría
+async def _run_async_audit(bearer_token, account):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(async_max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=async_max_concurrency, thread_name_prefix="audit-stream")
+    totals = {"env_success": 0, "env_failed": 0, "acct_success": 0, "acct_failed": 0}
+    
+    # Cada flujo se pagina en orden dentro de su hilo; el semáforo limita los flujos activos
+    async def stream(label, func, *args):
+        async with semaphore:
+            return await loop.run_in_executor(executor, _run_stream_captured, label, func, *args)
+    
+    def add(prefix, result):
+        success, failed = result[0], result[1]
+        totals[f"{prefix}_success"] += success
+        totals[f"{prefix}_failed"] += failed
+    
+    try:
+        base_url, headers = environment_request_context()
+        log_checkpoint(f"Iniciando consultas a Dynatrace Environment API (motor asíncrono, {async_max_concurrency} flujos simultáneos)")
+        env_tasks = [
+            asyncio.ensure_future(stream(endpoint, fetch_environment_endpoint, base_url, headers, endpoint))
+            for endpoint in profile_endpoints()
+        ]
+        types_task = asyncio.ensure_future(stream("/api/v2/entityTypes", fetch_entity_types, base_url, headers))
+        
+        # Las entidades se lanzan en cuanto se conocen los tipos, sin esperar a los demás endpoints
+        async def start_entity_tasks():
+            result, captured = await types_task
+            entity_types = result[2] or []
+            tasks = [
+                asyncio.ensure_future(stream(f"/api/v2/entities para tipo {entity_type}", fetch_entities_for_type,
+                                             base_url, headers, entity_type))
+                for entity_type in entity_types
+            ]
+            return result, captured, entity_types, tasks
+        
+        entities_task = asyncio.ensure_future(start_entity_tasks())
+        
+        # La Account Management API es independiente y se consulta a la vez
+        acct_tasks = []
+        if account and bearer_token:
+            acct_base_url, acct_headers = account_request_context(bearer_token)
+            acct_tasks = [
+                asyncio.ensure_future(stream(endpoint, fetch_paginated_endpoint, f"{acct_base_url}{endpoint}",
+                                             acct_headers, endpoint, endpoint_params()))
+                for endpoint in account_management_endpoints()
+            ]
+        
+        # Volcar la salida de cada flujo en el orden del recorrido secuencial
+        for task in env_tasks:
+            result, captured = await task
+            flush_captured_output(captured)
+            add("env", result)
+        
+        result, captured, entity_types, entity_tasks = await entities_task
+        flush_captured_output(captured)
+        add("env", result)
+        if entity_types:
+            total_types = len(entity_types)
+            log_checkpoint(f"Consultando entidades para {total_types} tipos encontrados")
+            for i, (entity_type, task) in enumerate(zip(entity_types, entity_tasks), 1):
+                result, captured = await task
+                print(f"Procesado tipo {i}/{total_types}: {entity_type}")
+                flush_captured_output(captured)
+                add("env", result)
+        else:
+            log_checkpoint("No se encontraron tipos de entidades para consultar")
+        log_checkpoint(f"Consultas a Environment API completadas: {totals['env_success']} exitosas, {totals['env_failed']} fallidas")
+        
+        if account:
+            if not bearer_token:
+                log_checkpoint("No se puede consultar Account Management API: Bearer Token no disponible")
+                totals["acct_failed"] += 1
+            else:
+                log_checkpoint("Iniciando consultas a Dynatrace Account Management API")
+                for task in acct_tasks:
+                    result, captured = await task
+                    flush_captured_output(captured)
+                    add("acct", result)
+                log_checkpoint(f"Consultas a Account Management API completadas: {totals['acct_success']} exitosas, {totals['acct_failed']} fallidas")
+    finally:
+        executor.shutdown(wait=True)
+    return totals["env_success"], totals["env_failed"], totals["acct_success"], totals["acct_failed"]
+
+# Consultar a la vez la Environment API y la Account Management API
+def run_async_audit(bearer_token=None, account=True):
+    """
+    Ejecuta como tareas asyncio concurrentes todos los endpoints paginados del
+    entorno, las entidades de cada tipo y los endpoints de IAM y suscripciones,
+    con un máximo de async_max_concurrency flujos simultáneos. Las entidades se
+    lanzan en cuanto responde /api/v2/entityTypes, a la vez que el resto de
+    endpoints. Cada flujo recorre sus páginas en orden sobre el pool de conexiones
+    compartido y su salida se escribe en el mismo orden que el recorrido secuencial.
+    Los hilos de ventanas del audit log y de fragmentos de un tipo no cuentan en
+    async_max_concurrency.
+    
+    Args:
+        bearer_token (str, optional): Bearer Token para la Account Management API
+        account (bool, optional): Consultar también la Account Management API
+    
+    Returns:
+        tuple: (éxito Environment API, fallo Environment API, éxito Account Management API,
+            fallo Account Management API)
+    """
+    import asyncio
+    return asyncio.run(_run_async_audit(bearer_token, account))
+
+# Exportar los NDJSON de la auditoría a archivos Parquet en output_dir/parquet
+def export_columnar():
+    if not ndjson_output:
+        log_checkpoint("Exportación columnar omitida: requiere ndjson_output = True")
+        return None
+    try:
+        import columnar_export
+        results = columnar_export.export_datasets(
+            os.path.join(output_dir, "ndjson"),
+            os.path.join(output_dir, "parquet")
+        )
+    except ImportError as e:
+        log_checkpoint(f"Exportación columnar omitida: {str(e)}")
+        return None
+    except Exception as e:
+        # Un error de pyarrow o de disco no invalida la auditoría ya completada
+        error_msg = f"Error en la exportación columnar: {str(e)}"
+        print(error_msg)
+        append_to_file("Excepción en la exportación columnar", error_msg)
+        return None
+    append_to_file("Exportación columnar (registros por conjunto de datos)", results)
+    log_checkpoint(f"Exportación columnar completada en {os.path.join(output_dir, 'parquet')}")
+    return results
+
+# Rango de logs de auditoría consultado en la última ejecución de un entorno, según su marca de agua
+def auditlog_coverage(environment_output_dir):
+    """
+    Returns:
+        dict: {"from", "to"} en epoch ms, o None si no se conoce (consulta sin ventanas o rango explícito)
+    """
+    path = auditlog_watermark_path if environment_output_dir == output_dir else None
+    path = path or os.path.join(environment_output_dir, "dynatrace_auditlog_watermark.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("range_start") is None or state.get("high_water_mark") is None:
+        return None
+    return {"from": state["range_start"], "to": state["high_water_mark"]}
+
+# Cruzar usuarios y grupos de IAM con los tokens y logs de auditoría del entorno
+def run_cross_reference(ndjson_dir=None, account_ndjson_dir=None, findings_path=None):
+    """
+    Args:
+        ndjson_dir (str, optional): NDJSON del entorno (por defecto output_dir/ndjson)
+        account_ndjson_dir (str, optional): NDJSON de la Account Management API
+            (por defecto, los del entorno)
+        findings_path (str, optional): Destino (por defecto output_dir/dynatrace_findings.json)
+    
+    Returns:
+        dict: Resumen de los hallazgos, o None si no se pudo realizar el cruce
+    """
+    if not ndjson_output:
+        log_checkpoint("Cruce de IAM, tokens y logs de auditoría omitido: requiere ndjson_output = True")
+        return None
+    import audit_analysis
+    audit_analysis.min_coverage_days = inactivity_min_coverage_days
+    ndjson_dir = ndjson_dir or os.path.join(output_dir, "ndjson")
+    findings_path = findings_path or os.path.join(output_dir, "dynatrace_findings.json")
+    try:
+        summary = audit_analysis.analyze_audit(ndjson_dir, findings_path, account_ndjson_dir=account_ndjson_dir,
+                                               coverage=auditlog_coverage(os.path.dirname(findings_path)))
+    except (OSError, ValueError) as e:
+        error_msg = f"Error en el cruce de IAM, tokens y logs de auditoría: {str(e)}"
+        print(error_msg)
+        append_to_file("Excepción en el cruce de IAM, tokens y logs de auditoría", error_msg)
+        return None
+    if summary is None:
+        log_checkpoint("Cruce de IAM, tokens y logs de auditoría omitido: no hay datos de usuarios ni de tokens")
+        return None
+    
+    append_to_file("Hallazgos del cruce de IAM, tokens y logs de auditoría", summary)
+    counts = ", ".join(f"{name}: {finding['total']}" for name, finding in summary["findings"].items())
+    log_checkpoint(f"Cruce de IAM, tokens y logs de auditoría completado ({counts}); detalle en {findings_path}")
+    coverage = summary["activity_coverage"]
+    if not coverage["inactivity_findings"]:
+        log_checkpoint(f"Usuarios y tokens sin actividad no evaluados: los logs de auditoría cubren {coverage['days']} días "
+                       f"(mínimo {coverage['minimum_days']})")
+    return summary
+
+# Completar y resumir el inventario de entidades en memoria
+def load_entity_store(resume=False):
+    """
+    Args:
+        resume (bool, optional): La ejecución se reanudó, y el inventario se carga de los NDJSON
     
+    Returns:
+        EntityStore: Inventario de la ejecución (None si no se pudo cargar)
+    """
+    global entity_store
+    if resume:
+        if not ndjson_output:
+            log_checkpoint("Inventario de entidades omitido: una ejecución reanudada requiere ndjson_output = True")
+            return None
+        from entity_store import EntityStore
+        entity_store = EntityStore.from_ndjson(os.path.join(output_dir, "ndjson"))
+    
+    stats = entity_store.stats()
+    append_to_file("Inventario de entidades en memoria", stats)
+    log_checkpoint(f"Inventario de entidades en memoria: {stats['entities']} entidades de {len(stats['types'])} tipos, "
+                   f"{stats['distinct_tags']} etiquetas y {stats['distinct_zones']} zonas distintas")
+    return entity_store
+
+# Preparar el directorio y los archivos de salida de una ejecución
+def prepare_output():
+    """
+    Returns:
+        tuple: (archivos creados correctamente, se reanuda una ejecución interrumpida)
+    """
     # Verificar si el directorio de salida existe
     if not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
         print(f"Directorio creado: {output_dir}")
     
+    # Reanudar solo si existe el progreso de una ejecución interrumpida
+    checkpoint_path = crawl_checkpoint_path or os.path.join(output_dir, "dynatrace_crawl_checkpoint.json")
+    resume = resume_mode and os.path.exists(checkpoint_path)
+    if resume_mode and not resume:
+        print("No hay ninguna ejecución interrumpida que reanudar; se inicia un recorrido completo")
+    
     # Crear archivo de resultados
-    if not create_result_file():
+    return create_result_file(resume=resume), resume
+
+# Cerrar los recursos abiertos durante una ejecución
+def close_run_resources():
+    if audit_state is not None:
+        audit_state.close()
+    if token_manager is not None:
+        token_manager.stop()
+    close_entity_type_counts()
+    close_response_cache()
+    entity_type_metadata.clear()
+    close_sessions()
+    close_writers()
+
+def main():
+    global request_metrics, entity_store
+    start_time = datetime.now()
+    request_metrics = RequestMetrics()
+    entity_store = None
+    print(f"Iniciando consulta unificada de APIs de Dynatrace. Los resultados se guardarán en {output_path}")
+    print(f"El log de ejecución se guardará en {log_path}")
+    
+    created, resume = prepare_output()
+    if not created:
         print("Error al crear archivos de resultados. Abortando.")
         sys.exit(1)
     
     try:
-        # Parte 1: Obtener Bearer Token
-        bearer_token = get_bearer_token()
+        open_crawl_checkpoint(resume=resume)
+        
+        # Abrir el estado de la ejecución anterior en modo incremental
+        if incremental_mode:
+            open_audit_state()
+        if response_cache_enabled:
+            open_response_cache()
         
-        # Parte 2: Consultas a Environment API
-        print("Consultando Environment API...")
-        env_success, env_failed = fetch_environment_api()
+        # Al reanudar, los tipos ya completados no pasan por el recorrido: el
+        # inventario se carga de los NDJSON al terminar
+        if entity_store_enabled and not resume:
+            from entity_store import EntityStore
+            entity_store = EntityStore()
         
-        # Parte 3: Consultas a Account Management API
-        print("Consultando Account Management API...")
-        acct_success, acct_failed = fetch_account_management_api(bearer_token)
+        # Parte 1: Obtener Bearer Token (solo si el perfil consulta la Account Management API)
+        profile = get_audit_profile()
+        log_checkpoint(f"Perfil de auditoría: {audit_profile}")
+        phase_start = time.time()
+        bearer_token = get_bearer_token() if profile["account"] else None
+        request_metrics.add_phase("bearer_token", time.time() - phase_start)
+        
+        if async_engine:
+            # Partes 2 y 3 a la vez con el motor asíncrono
+            print("Consultando Environment API y Account Management API (motor asíncrono)...")
+            phase_start = time.time()
+            env_success, env_failed, acct_success, acct_failed = run_async_audit(bearer_token, account=profile["account"])
+            request_metrics.add_phase("async_engine", time.time() - phase_start)
+        else:
+            # Parte 2: Consultas a Environment API
+            print("Consultando Environment API...")
+            phase_start = time.time()
+            env_success, env_failed = fetch_environment_api()
+            request_metrics.add_phase("environment_api", time.time() - phase_start)
+            
+            # Parte 3: Consultas a Account Management API
+            print("Consultando Account Management API...")
+            phase_start = time.time()
+            acct_success, acct_failed = fetch_account_management_api(bearer_token)
+            request_metrics.add_phase("account_management_api", time.time() - phase_start)
+        
+        # Informe de cambios del modo incremental
+        close_audit_state()
+        close_response_cache()
+        
+        if entity_store_enabled:
+            phase_start = time.time()
+            load_entity_store(resume)
+            request_metrics.add_phase("entity_store", time.time() - phase_start)
+        
+        if cross_reference_enabled:
+            phase_start = time.time()
+            run_cross_reference()
+            request_metrics.add_phase("cross_reference", time.time() - phase_start)
+        
+        if columnar_export_enabled:
+            phase_start = time.time()
+            export_columnar()
+            request_metrics.add_phase("columnar_export", time.time() - phase_start)
         
         # Resumen final
         end_time = datetime.now()
@@ -456,10 +3372,12 @@ Fecha y hora: {end_time.strftime('%Y-%m-%d %H:%M:%S')}
 Tiempo total de ejecución: {execution_time:.2f} segundos
 
 RESULTADOS:
-- Obtención de Bearer Token: {'Exitosa' if bearer_token else 'Fallida'}
+- Obtención de Bearer Token: {'Exitosa' if bearer_token else 'Fallida' if profile['account'] else 'Omitida'}
 - Environment API: {env_success} consultas exitosas, {env_failed} fallidas
 - Account Management API: {acct_success} consultas exitosas, {acct_failed} fallidas
 - Total: {env_success + acct_success} consultas exitosas, {env_failed + acct_failed} fallidas
+- Respuestas HTTP 429 (throttling): {sum(l.throttled_count for l in rate_limiters.values())}, tiempo en pausa: {sum(l.total_sleep for l in rate_limiters.values()):.2f} segundos
+- Reintentos por errores transitorios: {sum(b.retries for b in circuit_breakers.values())}, fallos registrados: {sum(b.total_failures for b in circuit_breakers.values())}
 
 Archivos generados:
 - Resultados: {output_path}
@@ -468,6 +3386,13 @@ Archivos generados:
         
         print(summary)
         append_to_file("RESUMEN FINAL", summary)
+        export_run_metrics()
+        
+        # Sin errores ya no hay nada que reanudar
+        if env_failed + acct_failed == 0:
+            crawl_checkpoint.finish()
+        else:
+            print("Hay consultas fallidas: ejecuta con --resume para reintentarlas")
         
         log_checkpoint("Proceso completado exitosamente")
         print(f"Proceso completado. Revisa los resultados en {output_path}")
@@ -478,7 +3403,487 @@ Archivos generados:
         append_to_file("ERROR FATAL", error_msg)
         log_checkpoint(f"Proceso terminado con errores: {str(e)}")
         return 1
+    finally:
+        close_run_resources()
+
+# Configuración que se transmite a los procesos de la auditoría multi-entorno
+environment_settings = [
+    "account_id", "client_id", "client_secret", "output_dir",
+    "account_api_base_url", "sso_token_url",
+    "entity_type_workers", "max_throttle_retries", "rate_limit_low_watermark",
+    "http_pool_connections", "http_pool_maxsize", "http_timeout",
+    "ndjson_output", "output_buffer_size", "output_flush_interval", "pretty_json",
+    "incremental_mode", "incremental_time_filtered_endpoints", "incremental_entity_full_scan_hours",
+    "resume_mode", "checkpoint_save_interval",
+    "max_request_retries", "retry_backoff_base", "retry_backoff_max",
+    "retryable_status_codes", "circuit_failure_threshold", "circuit_reset_timeout",
+    "columnar_export_enabled", "entity_store_enabled", "sharded_entity_types", "shard_workers",
+    "metrics_enabled", "metrics_duration_buckets", "async_engine", "async_max_concurrency",
+    "audit_profile", "empty_type_recheck_hours",
+    "response_cache_enabled", "response_cache_max_bytes", "response_cache_ttls",
+    "auditlog_windowed", "auditlog_window_hours", "auditlog_workers", "auditlog_lookback_days",
+    "auditlog_ingest_delay", "auditlog_from", "auditlog_to"
+]
+
+# Auditar un entorno dentro de un proceso del pool multi-entorno
+def run_environment_audit(environment, settings):
+    """
+    Ejecuta la fase de Environment API para un entorno con sus propios archivos de
+    salida en output_dir/<nombre del entorno>
+    
+    Args:
+        environment (dict): Entorno (name, environment_id, api_token, base_url)
+        settings (dict): Valores de environment_settings del proceso principal
+    
+    Returns:
+        dict: Resumen de la auditoría del entorno
+    """
+    global environment_id, api_token, environment_base_url, output_dir, output_path, log_path
+    global crawl_checkpoint_path, state_db_path, metrics_textfile_path, run_profile_path, request_metrics
+    global entity_type_counts_path, response_cache_dir, auditlog_watermark_path, entity_store
+    globals().update(settings)
+    
+    name = environment["name"]
+    environment_id = environment["environment_id"]
+    api_token = environment["api_token"]
+    environment_base_url = environment.get("base_url")
+    safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+    output_dir = os.path.join(settings["output_dir"], safe_name)
+    output_path = os.path.join(output_dir, "dynatrace_api_results.txt")
+    log_path = os.path.join(output_dir, "dynatrace_api_log.txt")
+    # El progreso y el estado incremental se guardan siempre en la carpeta del entorno
+    crawl_checkpoint_path = None
+    state_db_path = None
+    metrics_textfile_path = None
+    run_profile_path = None
+    entity_type_counts_path = None
+    response_cache_dir = None
+    auditlog_watermark_path = None
+    request_metrics = RequestMetrics()
+    entity_store = None
+    
+    start_time = time.time()
+    summary = {"name": name, "environment_id": environment_id, "output_dir": output_dir,
+               "successful": 0, "failed": 0}
+    created, resume = prepare_output()
+    if not created:
+        summary.update(failed=1, error="Error al crear archivos de resultados")
+        return summary
+    
+    try:
+        open_crawl_checkpoint(resume=resume)
+        if incremental_mode:
+            open_audit_state()
+        if response_cache_enabled:
+            open_response_cache()
+        # El inventario de entidades vive en el proceso del entorno; al proceso
+        # principal solo vuelven sus estadísticas
+        if entity_store_enabled and not resume:
+            from entity_store import EntityStore
+            entity_store = EntityStore()
+        phase_start = time.time()
+        if async_engine:
+            env_success, env_failed, _, _ = run_async_audit(account=False)
+        else:
+            env_success, env_failed = fetch_environment_api()
+        request_metrics.add_phase("environment_api", time.time() - phase_start)
+        close_audit_state()
+        close_response_cache()
+        if entity_store_enabled:
+            phase_start = time.time()
+            store = load_entity_store(resume)
+            if store is not None:
+                summary["entity_store"] = store.stats()
+            request_metrics.add_phase("entity_store", time.time() - phase_start)
+        if columnar_export_enabled:
+            export_columnar()
+        export_run_metrics()
+        if env_failed == 0:
+            crawl_checkpoint.finish()
+        summary.update(successful=env_success, failed=env_failed)
+    except Exception as e:
+        error_msg = f"Error general en la ejecución: {str(e)}"
+        append_to_file("ERROR FATAL", error_msg)
+        summary.update(failed=summary["failed"] + 1, error=str(e))
+    finally:
+        summary["seconds"] = round(time.time() - start_time, 2)
+        close_run_resources()
+    return summary
+
+# Auditar varios entornos en paralelo
+def run_multi_environment_audit(environments):
+    """
+    Audita una lista de entornos en paralelo (un proceso por entorno, con un límite
+    global de hilos de consulta) y consulta una sola vez la Account Management API
+    de la cuenta mientras tanto. Cada entorno escribe sus archivos en su propia
+    carpeta y el resumen conjunto se guarda en multi_environment_summary.json.
+    
+    Args:
+        environments (list): Entornos cargados con DynatraceConfig.load_environments
+    
+    Returns:
+        int: Código de salida
+    """
+    start_time = datetime.now()
+    print(f"Iniciando auditoría de {len(environments)} entornos. Los resultados se guardarán en {output_dir}")
+    
+    created, resume = prepare_output()
+    if not created:
+        print("Error al crear archivos de resultados. Abortando.")
+        return 1
+    
+    try:
+        open_crawl_checkpoint(resume=resume)
+        if response_cache_enabled:
+            open_response_cache()
+        
+        # Repartir el límite global de concurrencia entre los procesos
+        processes = max(1, min(len(environments), environment_workers))
+        settings = {name: globals()[name] for name in environment_settings}
+        settings["entity_type_workers"] = max(1, multi_env_max_concurrency // processes)
+        settings["async_max_concurrency"] = settings["entity_type_workers"]
+        log_checkpoint(f"Auditando {len(environments)} entornos con {processes} procesos ({settings['entity_type_workers']} hilos por entorno)")
+        
+        bearer_token = get_bearer_token() if get_audit_profile()["account"] else None
+        
+        # "spawn" evita que los procesos hereden buffers y conexiones del proceso principal
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(run_environment_audit, environment, settings) for environment in environments]
+            
+            # La Account Management API es común a todos los entornos de la cuenta
+            print("Consultando Account Management API...")
+            acct_success, acct_failed = fetch_account_management_api(bearer_token)
+            
+            results = []
+            for environment, future in zip(environments, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"name": environment["name"], "environment_id": environment["environment_id"],
+                              "successful": 0, "failed": 1, "error": str(e)}
+                results.append(result)
+                log_checkpoint(f"Entorno {result['name']} completado: {result['successful']} exitosas, {result['failed']} fallidas")
+        
+        # Cruzar los usuarios y grupos de la cuenta con los tokens y logs de cada entorno
+        if cross_reference_enabled:
+            for result in results:
+                if "output_dir" in result:
+                    run_cross_reference(
+                        ndjson_dir=os.path.join(result["output_dir"], "ndjson"),
+                        account_ndjson_dir=os.path.join(output_dir, "ndjson"),
+                        findings_path=os.path.join(result["output_dir"], "dynatrace_findings.json")
+                    )
+        
+        if columnar_export_enabled:
+            export_columnar()
+        
+        env_success = sum(r["successful"] for r in results)
+        env_failed = sum(r["failed"] for r in results)
+        end_time = datetime.now()
+        summary = {
+            "fecha": end_time.strftime('%Y-%m-%d %H:%M:%S'),
+            "tiempo_total_segundos": round((end_time - start_time).total_seconds(), 2),
+            "bearer_token": "Exitosa" if bearer_token else "Fallida",
+            "entornos": results,
+            "account_management": {"successful": acct_success, "failed": acct_failed},
+            "total": {"successful": env_success + acct_success, "failed": env_failed + acct_failed}
+        }
+        summary_path = os.path.join(output_dir, "multi_environment_summary.json")
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            f.write(dumps_json(summary, pretty=True))
+        append_to_file("RESUMEN MULTI-ENTORNO", summary)
+        
+        if acct_failed == 0:
+            crawl_checkpoint.finish()
+        
+        log_checkpoint("Proceso completado exitosamente")
+        print(f"Proceso completado. Resumen conjunto en {summary_path}")
+        return 0
+    except Exception as e:
+        error_msg = f"Error general en la ejecución: {str(e)}"
+        print(error_msg)
+        append_to_file("ERROR FATAL", error_msg)
+        log_checkpoint(f"Proceso terminado con errores: {str(e)}")
+        return 1
+    finally:
+        close_run_resources()
+
+# Correspondencia entre los parámetros de DynatraceConfig y la configuración del script
+config_settings = {
+    "environment_id": "environment_id",
+    "account_id": "account_id",
+    "client_id": "client_id",
+    "client_secret": "client_secret",
+    "api_token": "api_token",
+    "base_url": "environment_base_url",
+    "output_path": "output_dir",
+    "profile": "audit_profile"
+}
+
+# Aplicar la configuración de DynatraceConfig (argumentos, variables de entorno y .env)
+def apply_config(config):
+    """
+    Sustituye la configuración del script por los valores definidos en config;
+    los que no están definidos conservan el valor del script
+    
+    Args:
+        config (DynatraceConfig): Configuración cargada con DynatraceConfig.from_env
+    """
+    values = {name: getattr(config, param) for param, name in config_settings.items() if getattr(config, param)}
+    globals().update(values)
+    if "output_dir" in values:
+        globals().update(
+            output_path=os.path.join(output_dir, "dynatrace_api_results.txt"),
+            log_path=os.path.join(output_dir, "dynatrace_api_log.txt")
+        )
+
+# Comprobar que la configuración efectiva permite ejecutar la auditoría
+def validate_settings(multi_environment=False):
+    """
+    Los valores de ejemplo del script ("xxxxxx") cuentan como no configurados
+    
+    Args:
+        multi_environment (bool, optional): Los entornos y sus tokens vienen del archivo de entornos
+    
+    Raises:
+        ValueError: Si el perfil o las fechas de los logs de auditoría no son válidos o
+            falta algún parámetro necesario
+    """
+    def configured(name):
+        value = globals()[name]
+        return None if not value or set(str(value)) <= {"x"} else value
+    
+    account = get_audit_profile()["account"]
+    effective = DynatraceConfig(**{param: configured(name) for param, name in config_settings.items()})
+    if multi_environment:
+        effective.environment_id = effective.environment_id or "multi-entorno"
+        effective.api_token = effective.api_token or "multi-entorno"
+    effective.validate(account=account)
+    for value in (auditlog_from, auditlog_to):
+        if value:
+            parse_epoch_ms(value)
+
+# Cargar el perfil JSON de la ejecución anterior (vacío si no existe)
+def load_previous_run_profile():
+    path = run_profile_path or os.path.join(output_dir, "dynatrace_run_profile.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Páginas estimadas de los logs de auditoría del rango que se consultará
+def plan_auditlog_pages(page_size):
+    """
+    Usa el ritmo de eventos (eventos por milisegundo) de la última consulta
+    guardado con la marca de agua; sin él, una página por ventana
+    
+    Returns:
+        tuple: (número de ventanas, páginas estimadas, origen de la estimación)
+    """
+    start_ms, end_ms, _ = auditlog_range()
+    windows = plan_auditlog_windows(start_ms, end_ms)
+    state = load_auditlog_watermark_state()
+    if not state or not state.get("events") or not state.get("range_start"):
+        return len(windows), len(windows), "mínimo"
+    rate = state["events"] / max(state["high_water_mark"] - state["range_start"], 1)
+    pages = sum(max(1, -(-int(rate * (end - start)) // page_size)) for start, end in windows)
+    return len(windows), pages, "marca de agua"
+
+# Planificar las consultas de una ejecución sin llamar a la API
+def plan_audit():
+    """
+    Construye el grafo de consultas de la ejecución con la configuración actual
+    (perfil, endpoints, ventanas de los logs de auditoría, tipos de entidad y
+    fragmentación) y estima las páginas de cada flujo a partir de los archivos de
+    ejecuciones anteriores en output_dir: recuento de entidades por tipo, marca de
+    agua de los logs de auditoría y perfil de la ejecución. No consulta la API ni
+    crea archivos. Los tipos de entidad solo se conocen si hay un recuento anterior.
+    
+    Returns:
+        dict: Flujos (nombre, dependencia, páginas estimadas y origen de la
+        estimación) y totales estimados de páginas, peticiones y duración
+    """
+    profile = get_audit_profile()
+    previous = load_previous_run_profile()
+    previous_endpoints = {group["name"]: group for group in previous.get("by_endpoint", [])}
+    streams = []
+    
+    def add(name, pages, source, depends_on=None, parallel=False):
+        streams.append({"stream": name, "depends_on": depends_on, "pages": pages, "source": source,
+                        "parallel": parallel})
+    
+    def previous_pages(endpoint):
+        group = previous_endpoints.get(endpoint)
+        return (max(group["requests"], 1), "ejecución anterior") if group else (1, "mínimo")
+    
+    if profile["account"]:
+        cache_path = None
+        if token_cache_enabled:
+            cache_path = token_cache_path or os.path.join(output_dir, ".dynatrace_token_cache.json")
+        cached = TokenManager(request_sso_token, cache_path=cache_path, cache_key=f"{client_id}|{account_id}")._is_valid()
+        add("SSO /sso/oauth2/token", 0 if cached else 1, "caché del token" if cached else "mínimo")
+    
+    for endpoint in profile_endpoints():
+        if endpoint == "/api/v2/auditlogs" and auditlog_windowed:
+            windows, pages, source = plan_auditlog_pages(profile["page_size"])
+            add(f"{endpoint} ({windows} ventanas de {auditlog_window_hours} h)", pages, source, parallel=True)
+        else:
+            add(endpoint, *previous_pages(endpoint))
+    
+    add("/api/v2/entityTypes", *previous_pages("/api/v2/entityTypes"))
+    counts = EntityTypeCounts(entity_type_counts_path or os.path.join(output_dir, "dynatrace_entity_type_counts.json"))
+    entity_types, skipped_empty = filter_entity_types(sorted(counts.counts), counts)
+    for entity_type in entity_types:
+        _, page_size = entity_query_options(entity_type)
+        count = counts.counts[entity_type]["count"]
+        name = f"/api/v2/entities ({entity_type})"
+        if entity_type in sharded_entity_types:
+            name += f" [fragmentado por {sharded_entity_types[entity_type]['strategy']}]"
+        add(name, max(1, -(-count // page_size)), "recuento anterior", depends_on="/api/v2/entityTypes", parallel=True)
+    
+    if profile["account"]:
+        for endpoint in account_management_endpoints():
+            add(endpoint, *previous_pages(endpoint), depends_on="SSO /sso/oauth2/token")
+    
+    # Reintentos y duración media por petición de la ejecución anterior
+    totals = previous.get("totals") or {}
+    previous_requests = totals.get("requests") or 0
+    retry_rate = totals.get("retries", 0) / previous_requests if previous_requests else 0.0
+    seconds_per_request = (
+        sum(totals.get(field, 0.0) for field in ("ttfb_seconds", "download_seconds", "sleep_seconds")) / previous_requests
+        if previous_requests else None
+    )
+    pages = sum(stream["pages"] for stream in streams)
+    parallel_pages = sum(stream["pages"] for stream in streams if stream["parallel"])
+    if async_engine:
+        sequential_pages, parallel_pages = 0, pages
+        concurrency = async_max_concurrency
+    else:
+        sequential_pages = pages - parallel_pages
+        concurrency = entity_type_workers
+    estimated_seconds = None
+    if seconds_per_request is not None:
+        estimated_seconds = round(seconds_per_request * (sequential_pages + parallel_pages / max(concurrency, 1)), 1)
+    
+    return {
+        "profile": audit_profile,
+        "engine": "asíncrono" if async_engine else "secuencial",
+        "streams": streams,
+        "entity_types_known": bool(counts.counts),
+        "entity_types_skipped_empty": skipped_empty,
+        "totals": {
+            "streams": len(streams),
+            "pages": pages,
+            "requests": round(pages * (1 + retry_rate)),
+            "seconds": estimated_seconds
+        }
+    }
+
+# Mostrar el plan de consultas (y, con estimate, el coste estimado)
+def print_plan(plan, estimate=False, environments=None):
+    print(f"Plan de consultas (perfil {plan['profile']}, motor {plan['engine']})")
+    if environments:
+        print(f"Entornos: {', '.join(e['name'] for e in environments)} (los flujos del entorno se repiten en cada uno)")
+    for number, stream in enumerate(plan["streams"], 1):
+        line = f"  {number:3d}. {stream['stream']}"
+        if stream["depends_on"]:
+            line += f"  <- {stream['depends_on']}"
+        if estimate:
+            line += f"  ~{stream['pages']} páginas ({stream['source']})"
+        print(line)
+    if not plan["entity_types_known"]:
+        print("  Los tipos de entidad se conocerán al consultar /api/v2/entityTypes (no hay recuento anterior)")
+    if plan["entity_types_skipped_empty"]:
+        print(f"  Tipos omitidos por estar vacíos en una ejecución reciente: {', '.join(plan['entity_types_skipped_empty'])}")
+    if estimate:
+        totals = plan["totals"]
+        multiplier = len(environments) if environments else 1
+        print(f"Estimación: {totals['streams']} flujos, ~{totals['pages'] * multiplier} páginas, "
+              f"~{totals['requests'] * multiplier} peticiones (incluidos reintentos)"
+              + (f", ~{totals['seconds']:.1f} segundos por entorno" if totals["seconds"] is not None
+                 else "; sin perfil de una ejecución anterior no se estima la duración"))
+
+# Leer argumentos de línea de comandos
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Auditoría de las APIs de Dynatrace")
+    parser.add_argument("--incremental", action="store_true",
+                        help="consultar solo lo que ha cambiado desde la última ejecución")
+    parser.add_argument("--resume", action="store_true",
+                        help="continuar un recorrido interrumpido desde donde se detuvo")
+    parser.add_argument("--export-parquet", action="store_true",
+                        help="exportar entidades, usuarios, grupos, tokens y logs de auditoría a Parquet")
+    parser.add_argument("--environments", metavar="ARCHIVO",
+                        help="archivo JSON con la lista de entornos a auditar en paralelo")
+    parser.add_argument("--async", dest="async_engine", action="store_true",
+                        help="consultar todos los endpoints y tipos de entidad como tareas concurrentes")
+    parser.add_argument("--cache", action="store_true",
+                        help="reutilizar las respuestas recientes de los endpoints que cambian poco")
+    parser.add_argument("--no-cross-reference", action="store_true",
+                        help="no cruzar usuarios y grupos de IAM con los tokens y logs de auditoría")
+    parser.add_argument("--auditlog-from", metavar="FECHA",
+                        help="inicio (ISO 8601) de los logs de auditoría a consultar, sin usar ni modificar la marca de agua")
+    parser.add_argument("--auditlog-to", metavar="FECHA",
+                        help="fin (ISO 8601) de los logs de auditoría a consultar, sin modificar la marca de agua (por defecto, ahora)")
+    parser.add_argument("--profile", choices=sorted(audit_profiles), default=None,
+                        help=f"perfil de auditoría (por defecto: {audit_profile}; también DYNATRACE_AUDIT_PROFILE)")
+    parser.add_argument("--env-file", default=".env", metavar="ARCHIVO",
+                        help="archivo .env con la configuración (por defecto: .env)")
+    parser.add_argument("--output-dir", metavar="CARPETA",
+                        help="carpeta de salida (también OUTPUT_PATH)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="comprobar la configuración y mostrar el plan de consultas sin llamar a la API")
+    parser.add_argument("--plan", action="store_true",
+                        help="como --dry-run, con las páginas y peticiones estimadas de cada flujo")
+    return parser.parse_args(argv)
+
+# Punto de entrada de la línea de comandos
+def cli(argv=None):
+    """
+    Combina la configuración del script con DynatraceConfig (argumentos, variables
+    de entorno y .env), comprueba que esté completa y ejecuta la auditoría, o solo
+    muestra el plan de consultas con --dry-run / --plan
+    
+    Returns:
+        int: Código de salida
+    """
+    args = parse_args(argv)
+    try:
+        config = DynatraceConfig.from_env(args.env_file, output_path=args.output_dir,
+                                          environments_file=args.environments, profile=args.profile)
+        environments = config.get_environments()
+    except (ImportError, OSError, ValueError) as e:
+        print(f"Error en la configuración: {str(e)}")
+        return 1
+    apply_config(config)
+    
+    flags = {
+        "incremental_mode": args.incremental,
+        "resume_mode": args.resume,
+        "columnar_export_enabled": args.export_parquet,
+        "async_engine": args.async_engine,
+        "response_cache_enabled": args.cache
+    }
+    globals().update({name: True for name, enabled in flags.items() if enabled})
+    if args.no_cross_reference:
+        globals()["cross_reference_enabled"] = False
+    if args.auditlog_from:
+        globals()["auditlog_from"] = args.auditlog_from
+    if args.auditlog_to:
+        globals()["auditlog_to"] = args.auditlog_to
+    
+    try:
+        validate_settings(multi_environment=bool(environments))
+    except ValueError as e:
+        print(f"Error en la configuración: {str(e)}")
+        return 1
+    
+    if args.dry_run or args.plan:
+        print_plan(plan_audit(), estimate=args.plan, environments=environments)
+        return 0
+    if environments:
+        return run_multi_environment_audit(environments)
+    return main()
 
 if __name__ == "__main__":
-    exit_code = main()
-    sys.exit(exit_code)
+    sys.exit(cli())
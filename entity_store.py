@@ -0,0 +1,323 @@
+import glob
+import json
+import os
+import sys
+import threading
+from array import array
+
+# Longitud máxima de los valores de texto de las propiedades que se internan
+# (los valores largos y únicos no se benefician de compartirse)
+intern_max_length = 128
+
+# Tipo de los arrays de índices de entidades (enteros sin signo de 32 bits)
+index_typecode = "I"
+
+# Internar un valor de texto corto
+def _intern(value):
+    if isinstance(value, str) and len(value) <= intern_max_length:
+        return sys.intern(value)
+    return value
+
+# Clave de diccionario de una etiqueta
+def _tag_key(tag):
+    return tuple(_intern(tag.get(k)) for k in ("context", "key", "value", "stringRepresentation"))
+
+# Clave de diccionario de una zona de gestión
+def _zone_key(zone):
+    return _intern(None if zone.get("id") is None else str(zone.get("id"))), _intern(zone.get("name"))
+
+# Entidad compacta: los campos de texto repetidos están internados, las etiquetas y
+# zonas son tuplas compartidas de índices de los diccionarios del almacén y las
+# relaciones son arrays de índices de la tabla de entityId
+class EntityRecord:
+    __slots__ = ("index", "entity_id", "type", "display_name", "first_seen", "last_seen",
+                 "tags", "zones", "properties", "from_relationships", "to_relationships")
+
+    def __init__(self, index, entity_id, entity_type, display_name, first_seen, last_seen,
+                 tags, zones, properties, from_relationships, to_relationships):
+        self.index = index
+        self.entity_id = entity_id
+        self.type = entity_type
+        self.display_name = display_name
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.tags = tags
+        self.zones = zones
+        self.properties = properties
+        self.from_relationships = from_relationships
+        self.to_relationships = to_relationships
+
+    def __repr__(self):
+        return f"EntityRecord({self.entity_id!r}, {self.type!r}, {self.display_name!r})"
+
+# Almacén en memoria del inventario de entidades
+class EntityStore:
+    """
+    Guarda las entidades de /api/v2/entities en registros con __slots__ en lugar
+    de diccionarios anidados. Cada etiqueta (context, key, value,
+    stringRepresentation) y cada zona de gestión (id, name) se guarda una sola vez
+    y las entidades comparten la misma tupla de índices cuando tienen el mismo
+    conjunto de etiquetas o zonas. Los entityId se numeran en una tabla única y
+    las relaciones se guardan como arrays de esos números. Los índices por tipo,
+    etiqueta y zona permiten filtrar sin recorrer todo el inventario.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Tabla de entityId (incluidos los que solo aparecen en relaciones) y su registro
+        self.ids = []
+        self.id_types = []
+        self.id_index = {}
+        self.records = []
+        # Diccionarios de etiquetas, zonas y conjuntos de etiquetas o zonas compartidos
+        self.tags = []
+        self.tag_index = {}
+        self.zones = []
+        self.zone_index = {}
+        self.shared_sets = {}
+        # Índices de entidades por tipo, etiqueta y zona
+        self.by_type = {}
+        self.by_tag = {}
+        self.by_zone = {}
+        self.entity_count = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return self.entity_count
+
+    def _id_number(self, entity_id, entity_type=None):
+        number = self.id_index.get(entity_id)
+        if number is None:
+            number = self.id_index[entity_id] = len(self.ids)
+            self.ids.append(sys.intern(entity_id))
+            self.id_types.append(_intern(entity_type))
+            self.records.append(None)
+        elif entity_type is not None and self.id_types[number] is None:
+            self.id_types[number] = _intern(entity_type)
+        return number
+
+    def _encode(self, values, table, index, key):
+        numbers = []
+        for value in values or []:
+            if not isinstance(value, dict):
+                continue
+            encoded = key(value)
+            number = index.get(encoded)
+            if number is None:
+                number = index[encoded] = len(table)
+                table.append(encoded)
+            numbers.append(number)
+        # Las entidades con el mismo conjunto comparten la misma tupla
+        numbers = tuple(numbers)
+        return self.shared_sets.setdefault((id(table), numbers), numbers)
+
+    def _encode_relationships(self, relationships):
+        if not relationships:
+            return None
+        return {
+            sys.intern(name): array(index_typecode, (
+                self._id_number(target["id"], target.get("type")) for target in targets
+                if isinstance(target, dict) and target.get("id")
+            ))
+            for name, targets in relationships.items() if isinstance(targets, list)
+        }
+
+    def _add(self, entity):
+        entity_id = entity.get("entityId")
+        if not entity_id:
+            return
+        entity_type = _intern(entity.get("type"))
+        number = self._id_number(entity_id, entity_type)
+        if self.records[number] is not None:
+            # Entidad repetida (p. ej. al reanudar un tipo): se conserva la primera
+            self.duplicates += 1
+            return
+
+        properties = entity.get("properties")
+        if isinstance(properties, dict):
+            properties = {sys.intern(k): _intern(v) for k, v in properties.items()}
+        record = EntityRecord(
+            number,
+            self.ids[number],
+            entity_type,
+            entity.get("displayName"),
+            entity.get("firstSeenTms"),
+            entity.get("lastSeenTms"),
+            self._encode(entity.get("tags"), self.tags, self.tag_index, _tag_key),
+            self._encode(entity.get("managementZones"), self.zones, self.zone_index, _zone_key),
+            properties,
+            self._encode_relationships(entity.get("fromRelationships")),
+            self._encode_relationships(entity.get("toRelationships"))
+        )
+        self.records[number] = record
+        self.entity_count += 1
+
+        self.by_type.setdefault(entity_type, array(index_typecode)).append(number)
+        for tag in record.tags:
+            self.by_tag.setdefault(tag, array(index_typecode)).append(number)
+        for zone in record.zones:
+            self.by_zone.setdefault(zone, array(index_typecode)).append(number)
+
+    def add_entities(self, entities):
+        """
+        Añade una lista de entidades con el formato de /api/v2/entities
+        """
+        with self.lock:
+            for entity in entities:
+                if isinstance(entity, dict):
+                    self._add(entity)
+
+    def add_page(self, data):
+        """
+        Añade las entidades de una página de /api/v2/entities o del resultado
+        combinado de fetch_entities_for_type ({"entities": [...]})
+        """
+        if isinstance(data, dict):
+            self.add_entities(data.get("entities") or [])
+        elif isinstance(data, list):
+            self.add_entities(data)
+
+    @classmethod
+    def from_ndjson(cls, ndjson_dir, pattern="entities_*.ndjson"):
+        """
+        Carga los NDJSON de entidades de una auditoría
+
+        Args:
+            ndjson_dir (str): Carpeta con los NDJSON de la auditoría
+            pattern (str, optional): Patrón de los archivos de entidades
+
+        Returns:
+            EntityStore: Almacén con las entidades de todos los archivos
+        """
+        store = cls()
+        for path in sorted(glob.glob(os.path.join(ndjson_dir, pattern))):
+            with open(path, 'r', encoding='utf-8') as f:
+                batch = []
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        batch.append(json.loads(line))
+                        if len(batch) >= 10000:
+                            store.add_entities(batch)
+                            batch = []
+                store.add_entities(batch)
+        return store
+
+    def get(self, entity_id):
+        number = self.id_index.get(entity_id)
+        return None if number is None else self.records[number]
+
+    def _matching_tags(self, tag):
+        # "clave", "clave:valor" o "[CONTEXTO]clave:valor" (stringRepresentation)
+        return {
+            number for number, (_, key, value, representation) in enumerate(self.tags)
+            if tag in (representation, key) or (value is not None and tag == f"{key}:{value}")
+        }
+
+    def _matching_zones(self, zone):
+        return {number for number, (zone_id, name) in enumerate(self.zones) if zone in (zone_id, name)}
+
+    def filter(self, entity_type=None, tag=None, zone=None):
+        """
+        Entidades que cumplen todos los filtros indicados. Se parte del índice con
+        menos candidatos y el resto de filtros se comprueba en cada registro.
+
+        Args:
+            entity_type (str, optional): Tipo de entidad
+            tag (str, optional): Clave, "clave:valor" o stringRepresentation de una etiqueta
+            zone (str, optional): ID o nombre de una zona de gestión
+
+        Returns:
+            list: Registros (EntityRecord) en el orden en que se añadieron
+        """
+        with self.lock:
+            candidates = []
+            tag_numbers = zone_numbers = None
+            if entity_type is not None:
+                candidates.append(self.by_type.get(entity_type, ()))
+            if tag is not None:
+                tag_numbers = self._matching_tags(tag)
+                candidates.append(self._union(self.by_tag, tag_numbers))
+            if zone is not None:
+                zone_numbers = self._matching_zones(zone)
+                candidates.append(self._union(self.by_zone, zone_numbers))
+            if not candidates:
+                return [record for record in self.records if record is not None]
+
+            records = []
+            for number in min(candidates, key=len):
+                record = self.records[number]
+                if (entity_type is None or record.type == entity_type) \
+                        and (tag_numbers is None or not tag_numbers.isdisjoint(record.tags)) \
+                        and (zone_numbers is None or not zone_numbers.isdisjoint(record.zones)):
+                    records.append(record)
+            return records
+
+    @staticmethod
+    def _union(index, numbers):
+        if len(numbers) == 1:
+            return index.get(next(iter(numbers)), ())
+        return sorted({entity for number in numbers for entity in index.get(number, ())})
+
+    def related(self, record, relationship, direction="from"):
+        """
+        Registros relacionados con una entidad (los que no se han cargado se omiten)
+
+        Args:
+            record (EntityRecord): Entidad de origen
+            relationship (str): Nombre de la relación (p. ej. "isProcessOf")
+            direction (str, optional): "from" (fromRelationships) o "to" (toRelationships)
+        """
+        relationships = record.from_relationships if direction == "from" else record.to_relationships
+        numbers = (relationships or {}).get(relationship, ())
+        return [self.records[number] for number in numbers if self.records[number] is not None]
+
+    def to_dict(self, record):
+        """
+        Reconstruye la entidad con el formato de /api/v2/entities
+        """
+        entity = {"entityId": record.entity_id, "type": record.type, "displayName": record.display_name}
+        if record.first_seen is not None:
+            entity["firstSeenTms"] = record.first_seen
+        if record.last_seen is not None:
+            entity["lastSeenTms"] = record.last_seen
+        if record.properties is not None:
+            entity["properties"] = dict(record.properties)
+        if record.tags:
+            entity["tags"] = [
+                {k: v for k, v in zip(("context", "key", "value", "stringRepresentation"), self.tags[n]) if v is not None}
+                for n in record.tags
+            ]
+        if record.zones:
+            entity["managementZones"] = [{"id": self.zones[n][0], "name": self.zones[n][1]} for n in record.zones]
+        for key, relationships in (("fromRelationships", record.from_relationships), ("toRelationships", record.to_relationships)):
+            if relationships:
+                entity[key] = {
+                    name: [
+                        {"id": self.ids[n], "type": self.id_types[n]} for n in numbers
+                    ]
+                    for name, numbers in relationships.items()
+                }
+        return entity
+
+    def stats(self):
+        """
+        Returns:
+            dict: Número de entidades, de entidades por tipo y tamaño de los diccionarios
+        """
+        with self.lock:
+            return {
+                "entities": self.entity_count,
+                "duplicates": self.duplicates,
+                "entity_ids": len(self.ids),
+                "types": {entity_type: len(numbers) for entity_type, numbers in self.by_type.items()},
+                "distinct_tags": len(self.tags),
+                "distinct_zones": len(self.zones),
+                "shared_sets": len(self.shared_sets),
+                "relationship_edges": sum(
+                    len(numbers)
+                    for record in self.records if record is not None
+                    for relationships in (record.from_relationships, record.to_relationships) if relationships
+                    for numbers in relationships.values()
+                )
+            }
@@ -0,0 +1,70 @@
+import contextlib
+import io
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import dynatrace_api_audit as audit
+
+
+# Restaurar las variables globales de la auditoría después de cada prueba
+@pytest.fixture(autouse=True)
+def audit_globals():
+    saved = {
+        name: value for name, value in vars(audit).items()
+        if not name.startswith("__") and not isinstance(value, (types.ModuleType, types.FunctionType, type))
+    }
+    # Copias de los contenedores que main() modifica en el sitio
+    containers = {name: value.copy() for name, value in saved.items() if isinstance(value, (dict, list, set))}
+    benchmark._reset_audit_state()
+    yield
+    if audit.token_manager is not None:
+        audit.token_manager.stop()
+    for name, value in saved.items():
+        setattr(audit, name, value)
+        if isinstance(value, list):
+            value[:] = containers[name]
+        elif name in containers:
+            value.clear()
+            value.update(containers[name])
+    benchmark._reset_audit_state()
+
+
+# Servidor simulado pequeño, sin latencia y con páginas de 10 elementos
+@pytest.fixture
+def server():
+    with benchmark.MockDynatraceServer(entity_types=2, entities_per_type=20, items_per_endpoint=40,
+                                       auditlog_events_per_hour=1, max_page_size=10, latency=0.0) as mock:
+        yield mock
+
+
+# Ejecutar la auditoría completa contra el servidor simulado en tmp_path
+@pytest.fixture
+def run_audit(tmp_path):
+    def run(server, **settings):
+        return benchmark.run_benchmark(server, settings=settings, output_dir=str(tmp_path))
+    return run
+
+
+# Apuntar la auditoría a tmp_path y al servidor simulado sin ejecutarla
+@pytest.fixture
+def audit_env(tmp_path, server):
+    overrides = {
+        "environment_base_url": server.url,
+        "account_api_base_url": server.url,
+        "sso_token_url": f"{server.url}/sso/oauth2/token",
+        "output_dir": str(tmp_path),
+        "output_path": str(tmp_path / "dynatrace_api_results.txt"),
+        "log_path": str(tmp_path / "dynatrace_api_log.txt"),
+        "token_cache_enabled": False
+    }
+    for name, value in overrides.items():
+        setattr(audit, name, value)
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield tmp_path
+        audit.close_writers()
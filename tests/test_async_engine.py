@@ -0,0 +1,35 @@
+import re
+import time
+
+import benchmark
+
+
+# Líneas del archivo de resultados sin los puntos de control (que dependen del motor)
+def result_lines(output_dir):
+    text = (output_dir / "dynatrace_api_results.txt").read_text(encoding="utf-8")
+    text = re.sub(r"\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d", "T", text)
+    text = re.sub(r"RESUMEN FINAL.*", "", text, flags=re.S)
+    return [line for line in text.splitlines() if line and not line.startswith("# CHECKPOINT")]
+
+
+def test_async_output_matches_sequential_order(server, tmp_path_factory):
+    results = {}
+    for async_engine in (False, True):
+        output_dir = tmp_path_factory.mktemp(f"async_{async_engine}")
+        result = benchmark.run_benchmark(server, settings={"async_engine": async_engine}, output_dir=str(output_dir))
+        assert result["exit_code"] == 0
+        results[async_engine] = result_lines(output_dir)
+    assert results[True] == results[False]
+
+
+def test_entities_overlap_slow_endpoint(run_audit):
+    slow, entity_latency = 1.0, 0.25
+    with benchmark.MockDynatraceServer(entity_types=2, entities_per_type=10, items_per_endpoint=5, latency=0.0,
+                                       path_latency={"/api/v2/apiTokens": slow,
+                                                     "/api/v2/entities": entity_latency}) as server:
+        start = time.perf_counter()
+        result = run_audit(server, async_engine=True)
+        elapsed = time.perf_counter() - start
+    assert result["exit_code"] == 0
+    # Sin solapamiento las entidades empezarían después del endpoint lento
+    assert elapsed < slow + entity_latency * 0.8
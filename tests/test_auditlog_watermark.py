@@ -0,0 +1,40 @@
+import json
+import time
+
+import dynatrace_api_audit as audit
+
+
+# Marca de agua guardada en output_dir (None si no existe)
+def read_watermark(output_dir):
+    path = output_dir / "dynatrace_auditlog_watermark.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def test_auditlog_to_alone_is_an_explicit_range(audit_env):
+    audit.auditlog_to = "2030-01-01T00:00:00Z"
+    start_ms, end_ms, explicit_range = audit.auditlog_range()
+    assert explicit_range
+    assert end_ms == audit.parse_epoch_ms("2030-01-01T00:00:00Z")
+    assert end_ms - start_ms == audit.auditlog_lookback_days * 86400 * 1000
+
+
+def test_auditlog_to_does_not_write_watermark(server, run_audit, tmp_path):
+    result = run_audit(server, auditlog_to="2030-01-01T00:00:00Z")
+    assert result["exit_code"] == 0
+    assert read_watermark(tmp_path) is None
+    assert (tmp_path / "ndjson" / "auditlogs_range.ndjson").exists()
+
+
+def test_incremental_watermark_stays_behind_ingest_delay(server, run_audit, tmp_path):
+    result = run_audit(server)
+    assert result["exit_code"] == 0
+    state = read_watermark(tmp_path)
+    assert state["high_water_mark"] <= (time.time() - audit.auditlog_ingest_delay) * 1000
+
+
+def test_saved_watermark_is_clamped(audit_env):
+    audit.save_auditlog_watermark(audit.parse_epoch_ms("2030-01-01T00:00:00Z"), None)
+    state = read_watermark(audit_env)
+    assert state["high_water_mark"] <= (time.time() - audit.auditlog_ingest_delay) * 1000
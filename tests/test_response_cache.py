@@ -0,0 +1,36 @@
+import os
+import sqlite3
+
+import dynatrace_api_audit as audit
+
+CACHED_ENDPOINT = "/api/config/v1/dashboards"
+
+
+# Ajustes de una ejecución con caché solo para los dashboards
+def cache_settings(cache_dir):
+    return {
+        "response_cache_enabled": True,
+        "response_cache_dir": str(cache_dir),
+        "response_cache_max_bytes": 10 ** 9,
+        "response_cache_ttls": {CACHED_ENDPOINT: 3600}
+    }
+
+
+def test_partial_cache_group_is_fetched_again(server, run_audit, tmp_path_factory):
+    cache_dir = tmp_path_factory.mktemp("cache")
+    settings = cache_settings(cache_dir)
+    first = run_audit(server, **settings)
+    cached = run_audit(server, **settings)
+    assert cached["requests"] < first["requests"]
+
+    # Descarga interrumpida: solo queda la primera página y el grupo no está completo
+    with sqlite3.connect(os.path.join(cache_dir, "index.sqlite")) as db:
+        db.execute("DELETE FROM complete_groups")
+        db.execute("DELETE FROM responses WHERE key != root")
+    partial = run_audit(server, **settings)
+    assert partial["exit_code"] == 0
+    # Los dashboards (40 elementos en páginas de 10) se vuelven a pedir desde la primera página
+    assert partial["requests"] == cached["requests"] + 4
+
+    again = run_audit(server, **settings)
+    assert again["requests"] == cached["requests"]
@@ -0,0 +1,70 @@
+import json
+
+import dynatrace_api_audit as audit
+
+STREAM = "/api/v2/apiTokens"
+
+
+# Destino que falla al recibir una página concreta
+class FailingSink(audit.PageSink):
+    def __init__(self, page_number):
+        self.page_number = page_number
+
+    def write_page(self, endpoint_name, page_number, data):
+        if page_number == self.page_number:
+            raise RuntimeError("fallo simulado")
+
+
+# Recorrer el endpoint de tokens escribiendo en su NDJSON
+def crawl(server, extra_sinks=()):
+    url = f"{server.url}{STREAM}"
+    sink = audit.open_ndjson_sink(STREAM, append=audit.resume_mode)
+    try:
+        return audit.paginated_api_request(url, {}, STREAM, base_url=url, params={"pageSize": "5"},
+                                           sink=[sink, *extra_sinks], collect=False, stream=STREAM)
+    finally:
+        sink.close()
+
+
+# Identificadores escritos en el NDJSON del endpoint
+def written_ids():
+    with open(audit.ndjson_path_for(STREAM), encoding="utf-8") as f:
+        return [json.loads(line)["id"] for line in f]
+
+
+def test_resume_after_failed_page_does_not_duplicate_items(audit_env, server):
+    audit.checkpoint_save_interval = 0.0
+    audit.open_crawl_checkpoint(resume=False)
+    success, failed, _ = crawl(server, [FailingSink(5)])
+    assert failed == 1
+    assert STREAM in audit.crawl_checkpoint.state["in_flight"]
+
+    # Las páginas escritas después del último guardado se descartan al reanudar
+    audit.checkpoint_save_interval = 1000.0
+    audit.resume_mode = True
+    audit.open_crawl_checkpoint(resume=True)
+    success, failed, _ = crawl(server)
+    assert failed == 0
+    ids = written_ids()
+    assert len(ids) == len(set(ids)) == 40
+    assert STREAM not in audit.crawl_checkpoint.state["in_flight"]
+
+
+def test_rejected_next_page_key_restarts_from_first_page(audit_env, server):
+    audit.open_crawl_checkpoint(resume=False)
+    path = audit.ndjson_path_for(STREAM)
+    (audit_env / "ndjson").mkdir()
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"id": "obsoleto"}\n' * 20)
+    audit.crawl_checkpoint.state["in_flight"][STREAM] = {
+        "next_page_key": "caducado", "page": 5, "successful": 4, "files": {path: 100}
+    }
+    audit.crawl_checkpoint._save()
+
+    audit.resume_mode = True
+    audit.open_crawl_checkpoint(resume=True)
+    success, failed, _ = crawl(server)
+    assert failed == 0
+    ids = written_ids()
+    assert "obsoleto" not in ids
+    assert len(ids) == len(set(ids)) == 40
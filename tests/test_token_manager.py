@@ -0,0 +1,37 @@
+import time
+
+import dynatrace_api_audit as audit
+
+
+def test_token_is_reused_until_refresh_margin(audit_env, server):
+    manager = audit.TokenManager(audit.request_sso_token)
+    try:
+        token = manager.get_token()
+        requests = server.requests
+        # El mock emite tokens de 300 s: margen de min(token_refresh_margin, 60 s)
+        margin = manager._refresh_margin()
+        assert margin == min(audit.token_refresh_margin, 60)
+
+        manager.expires_at = time.time() + margin + 5
+        assert manager.get_token() == token
+        assert server.requests == requests
+
+        manager.expires_at = time.time() + margin - 5
+        manager.get_token()
+        assert server.requests == requests + 1
+    finally:
+        manager.stop()
+
+
+def test_short_lived_token_is_valid_after_issue():
+    # Un token de 60 s no debe considerarse caducado nada más emitirse
+    manager = audit.TokenManager(lambda: ("corto", 60))
+    try:
+        calls = []
+        manager.fetch_token = lambda: calls.append(1) or ("corto", 60)
+        manager.get_token()
+        manager.get_token()
+        assert len(calls) == 1
+        assert manager._refresh_margin() == 12
+    finally:
+        manager.stop()